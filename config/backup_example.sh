@@ -35,6 +35,67 @@ BUCKET_DIR=mydata1
 # failures and retries.
 UPLOAD_LIMIT_MB=50000
 
+# With 1, files larger than UPLOAD_LIMIT_MB are split into parts of at most
+# UPLOAD_LIMIT_MB, which are packed into sets like files. extract_archive joins the
+# parts of a file as their archives are extracted. With 0, a larger file aborts the
+# backup. Default is 0.
+SPLIT_LARGE_FILES=0
+
+# Number of threads used for crawling the backup paths. With 1, directories are crawled
+# sequentially. Higher values help on pools with many files, since listing and stat'ing
+# of directories is spread across threads.
+CRAWL_WORKERS=8
+
+# After crawling, the number and size of files found is cross-checked with an independent
+# run of find. Possible values:
+# - full (default): find runs over each backup path, which reads all metadata once more
+# - sample: find only runs over a few randomly picked subtrees of each backup path
+CRAWL_VERIFY=full
+
+# How the crawled file system is stored in the state directory. Possible values:
+# - pickle (default): The whole tree is kept in memory and pickled
+# - sqlite: The crawl is streamed into an SQLite database, which set creation queries
+#   directory by directory. Use this when the metadata of the pool does not fit into RAM.
+STATE_BACKEND=pickle
+
+# Interval in seconds in which the crawl reports its progress: directories and files per
+# second, bytes seen, current directory depth and an ETA based on the size of the
+# snapshot. The numbers are also appended to logs/crawl_stats.jsonl to compare runs.
+# 0 only reports the totals at the end of the crawl, default is 60.
+CRAWL_PROGRESS_INTERVAL_SEC=60
+
+# How backed up paths are distributed over the sets (archives). Possible values:
+# - binpacking (default): Sorts paths by size and packs as few sets as possible, but
+#   unrelated paths may end up in one set
+# - locality: Packs paths in crawl order, so a directory is stored in one set or a few
+#   adjacent ones and restoring a part of the backup needs fewer sets. Sets are filled
+#   by splitting directories where needed.
+# Each set reports a locality score: 1 if all its paths share a parent directory, 1/n
+# for n parent directories.
+PACKING_STRATEGY=binpacking
+
+# With 1, sets are filled up to UPLOAD_LIMIT_MB of predicted compressed size instead of
+# uncompressed size. Before packing, samples of each file type (by extension) are
+# compressed with zstd. The predicted ratios are multiplied by COMPRESSION_SAFETY_MARGIN
+# (default 1.25), archives of badly predicted data may still exceed the limit by a bit.
+# Default is 0.
+COMPRESSION_AWARE_SIZING=0
+COMPRESSION_SAFETY_MARGIN=1.25
+
+# With 1, already compressed files (media, archives, by extension, magic bytes or a
+# compression probe of a sample) are packed into separate sets, which are stored without
+# compression as <set>.tar.gpg. This saves the CPU time zstd would spend on them.
+# Default is 0.
+SEPARATE_INCOMPRESSIBLE=0
+
+# With 1, each set gets a fingerprint of its paths, sizes and modification times. A set
+# with the same fingerprint as an archive uploaded by an earlier backup is not uploaded
+# again, the backup references that archive in its references.json instead. Only
+# archives in the same bucket and BUCKET_DIR, with the same compressor, encryption and
+# passphrase are referenced. Restore downloads referenced archives from their backup,
+# so ./expire keeps backups which are still referenced. Default is 0.
+REUSE_UNCHANGED_SETS=0
+
 # A path where the ZFS snapshot will be mounted during backup
 SNAPSHOT_PATH=/snapshot_aws_backup
 
@@ -42,6 +103,47 @@ SNAPSHOT_PATH=/snapshot_aws_backup
 # will be DELETED and recreated there!
 BUFFER_PATH_BASE='/tmp'
 
+# Number of archives built in parallel. Helps when a single tar | zstd | gpg pipeline
+# is slower than the upload. Archives are only built ahead while the buffer has room for
+# them (sized as the uncompressed set), so more free space lets more builders run.
+# Default is 1.
+NUM_ARCHIVE_BUILDERS=1
+
+# Number of sets uploaded concurrently. A single upload may not fill the link to a
+# distant region. Archives waiting for upload need space in the buffer, so use at least
+# as many archive builders. Default is 1.
+NUM_UPLOADERS=1
+
+# With 1, archives are not stored in the buffer, the output of tar | zstd | gpg is
+# uploaded as it is built, in chunks held in memory. Saves the disk I/O of writing and
+# reading back each archive, and the buffer only needs room for the small contents
+# archives. A failed upload rebuilds the archive. Default is 0.
+STREAMING_UPLOAD=0
+
+# The codec of the archives. The compressor is one of zstd (default), gzip, xz, lz4 or
+# none. Leave the level empty for the compressor's default (3 for zstd), threads are
+# used by zstd and xz. The encryption is gpg (default) or none, which leaves the
+# archives readable by anyone with access to the bucket. The contents archive listing
+# the files of a set is built with the codec of the set as well. The codec is stored
+# with each archive, extract_archive detects it, so it can be changed between backups.
+ARCHIVE_COMPRESSOR=zstd
+ARCHIVE_COMPRESSION_LEVEL=
+ARCHIVE_COMPRESSION_THREADS=1
+ARCHIVE_ENCRYPTION=gpg
+
+# With 1, the zstd level, threads and long distance matching of each archive are
+# adapted to the measured rates: when archives are built faster than they are uploaded,
+# compression gets stronger, when uploads wait for archives, it gets faster again. The
+# settings of each set are logged. Has no effect with STREAMING_UPLOAD=1 or another
+# ARCHIVE_COMPRESSOR than zstd. Default is 0.
+ADAPTIVE_COMPRESSION=0
+
+# Size of the chunks S3 transfers are split into, and the number of chunks sent in
+# parallel per transfer. Larger chunks are used for archives which would exceed the
+# limit of 10000 parts. Defaults are 64 and 10.
+S3_MULTIPART_CHUNK_MB=64
+S3_MAX_CONCURRENCY=10
+
 # Sealing, see the README for details. Possible values:
 # - disable (default): Do not use sealing
 # - seal_after_backup: Assume that this is the final backup of each backup path. Sets
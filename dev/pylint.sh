@@ -12,6 +12,7 @@ IGNORES=(
     -d unspecified-encoding
     -d wrong-import-order
     -d too-many-arguments
+    -d too-many-positional-arguments
     -d too-many-branches
     --max-line-length=110
 )
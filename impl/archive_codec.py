@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Codecs of the archives: how the tar stream of a set is compressed and encrypted.
+
+A codec is a dict of compressor, level, threads, long (zstd's long distance matching)
+and encryption. build_archive.sh reads it from the ARCHIVE_* environment variables of
+get_codec_env(). The compressor and the encryption show in the suffix of the archive
+name, and a manifest <set>.codec.json with the whole codec is uploaded with each
+archive.
+
+  archive_codec.py detect ARCHIVE
+    Ran by extract_archive, prints the compressor and the encryption of ARCHIVE. They
+    are taken from the codec manifest next to ARCHIVE if there is one, from the suffix
+    of its name otherwise.
+
+Standalone, so it runs without the rest of the backup on restore.
+'''
+
+import json
+import os
+import sys
+
+# Name to suffix in the archive name, build_archive.sh and extract_archive know how
+# to run them
+COMPRESSORS = {'zstd': '.zstd', 'gzip': '.gz', 'xz': '.xz', 'lz4': '.lz4', 'none': ''}
+ENCRYPTIONS = {'gpg': '.gpg', 'none': ''}
+# Level None is the compressor's default. Archives of earlier versions are all zstd
+# and gpg, named .tar.zstd.gpg.
+DEFAULT_CODEC = {'compressor': 'zstd', 'level': None, 'threads': 1, 'long': False,
+                 'encryption': 'gpg'}
+CODEC_MANIFEST_SUFFIX = '.codec.json'
+
+
+def check_codec(codec):
+    if codec['compressor'] not in COMPRESSORS:
+        raise ValueError(f"Unknown compressor {codec['compressor']}, use one of"
+                         f" {', '.join(COMPRESSORS)}")
+    if codec['encryption'] not in ENCRYPTIONS:
+        raise ValueError(f"Unknown encryption {codec['encryption']}, use one of"
+                         f" {', '.join(ENCRYPTIONS)}")
+    return codec
+
+
+def get_codec_from_env(env=None):
+    '''Returns the codec configured by ARCHIVE_COMPRESSOR, ARCHIVE_COMPRESSION_LEVEL,
+    ARCHIVE_COMPRESSION_THREADS and ARCHIVE_ENCRYPTION, defaults for unset ones.'''
+    env = os.environ if env is None else env
+    level = env.get('ARCHIVE_COMPRESSION_LEVEL')
+    return check_codec({
+        'compressor': env.get('ARCHIVE_COMPRESSOR') or DEFAULT_CODEC['compressor'],
+        'level': int(level) if level else None,
+        'threads': int(env.get('ARCHIVE_COMPRESSION_THREADS') or 1),
+        'long': False,
+        'encryption': env.get('ARCHIVE_ENCRYPTION') or DEFAULT_CODEC['encryption']})
+
+
+def get_store_only_codec(codec):
+    '''The codec for incompressible data, which keeps the encryption.'''
+    return dict(codec, compressor='none', level=None, long=False)
+
+
+def get_codec_env(codec):
+    '''Returns the environment variables of build_archive.sh for codec.'''
+    return {'ARCHIVE_COMPRESSOR': codec['compressor'],
+            'ARCHIVE_COMPRESSION_LEVEL': '' if codec['level'] is None
+                                         else str(codec['level']),
+            'ARCHIVE_COMPRESSION_THREADS': str(codec['threads']),
+            'ARCHIVE_COMPRESSION_LONG': '1' if codec['long'] else '0',
+            'ARCHIVE_ENCRYPTION': codec['encryption']}
+
+
+def codec_to_string(codec):
+    if codec['compressor'] == 'none':
+        compression = 'no compression'
+    else:
+        compression = codec['compressor']
+        if codec['level'] is not None:
+            compression += f" level {codec['level']}"
+        compression += f", {codec['threads']} thread(s)"
+        if codec['long']:
+            compression += ', long'
+    return f"{compression}, {codec['encryption']} encryption"
+
+
+def get_archive_suffix(codec):
+    return f".tar{COMPRESSORS[codec['compressor']]}{ENCRYPTIONS[codec['encryption']]}"
+
+
+def get_codec_from_name(archive_name):
+    '''Returns the codec of an archive by the suffix of its name, None if it has none
+    of the known suffixes. Level and threads are not known from the name.'''
+    for compressor in COMPRESSORS:
+        for encryption in ENCRYPTIONS:
+            codec = dict(DEFAULT_CODEC, compressor=compressor, encryption=encryption)
+            if archive_name.endswith(get_archive_suffix(codec)):
+                return codec
+    return None
+
+
+def get_codec_manifest_name(archive_name):
+    '''Returns the name of the codec manifest of an archive, also for paths and keys.'''
+    head, name = os.path.split(archive_name)
+    index = name.rfind('.tar')
+    return os.path.join(head, f'{name if index < 0 else name[:index]}'
+                              f'{CODEC_MANIFEST_SUFFIX}')
+
+
+def write_codec_manifest(filename, codec):
+    with open(filename, 'wt') as f:
+        json.dump(codec, f)
+
+
+def detect_codec(archive_file):
+    '''Returns the codec of archive_file, from its manifest or its name.'''
+    manifest_file = get_codec_manifest_name(archive_file)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'rt') as f:
+            return check_codec(dict(DEFAULT_CODEC, **json.load(f)))
+    codec = get_codec_from_name(os.path.basename(archive_file))
+    if codec is None:
+        raise ValueError(f'Unknown codec of {archive_file}, it has no manifest'
+                         f' {manifest_file}')
+    return codec
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'detect':
+        detected_codec = detect_codec(sys.argv[2])
+        print(detected_codec['compressor'], detected_codec['encryption'])
+    else:
+        print('Usage: archive_codec.py detect ARCHIVE')
+        sys.exit(1)
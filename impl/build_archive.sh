@@ -8,7 +8,52 @@ shift
 shift
 shift
 
-tar -C "$SNAPSHOT_PATH" --create --exclude=*/.NO_BACKUP --exclude=*/.NO_BACKUP/* \
-  "$@" --verbatim-files-from "--files-from=$FILE_LIST" \
-  | zstd | gpg -c --cipher-algo AES256 --passphrase-file config/passphrase.txt --batch \
-  >"$ARCHIVE"
+# An archive of - is written to stdout, for streaming uploads
+if [[ "$ARCHIVE" == - ]]; then
+  ARCHIVE=/dev/stdout
+fi
+
+# Codec of the archive, set by upload_sets.py, see impl/archive_codec.py. Defaults
+# to zstd's default level and gpg.
+LEVEL="${ARCHIVE_COMPRESSION_LEVEL:-}"
+THREADS="${ARCHIVE_COMPRESSION_THREADS:-1}"
+case "${ARCHIVE_COMPRESSOR:-zstd}" in
+  zstd)
+    COMPRESS=(zstd "-${LEVEL:-3}" "-T$THREADS")
+    if [[ "${ARCHIVE_COMPRESSION_LONG:-0}" == 1 ]]; then
+      # Window of 128 MiB, which zstd decompresses without further options
+      COMPRESS+=(--long=27)
+    fi
+    ;;
+  gzip) COMPRESS=(gzip "-${LEVEL:-6}") ;;
+  xz) COMPRESS=(xz "-${LEVEL:-6}" "-T$THREADS") ;;
+  lz4) COMPRESS=(lz4 "-${LEVEL:-1}") ;;
+  none) COMPRESS=(cat) ;;
+  *)
+    echo "Unknown compressor $ARCHIVE_COMPRESSOR" >&2
+    exit 1
+    ;;
+esac
+case "${ARCHIVE_ENCRYPTION:-gpg}" in
+  # Compressing again in gpg only costs CPU time
+  gpg)
+    ENCRYPT=(gpg -c --cipher-algo AES256 --compress-algo none
+             --passphrase-file config/passphrase.txt --batch)
+    ;;
+  none) ENCRYPT=(cat) ;;
+  *)
+    echo "Unknown encryption $ARCHIVE_ENCRYPTION" >&2
+    exit 1
+    ;;
+esac
+
+# Parts of large files are appended as a second tar stream
+PARTS_FILE="${FILE_LIST%.list}.parts"
+
+{
+  tar -C "$SNAPSHOT_PATH" --create --sparse --exclude=*/.NO_BACKUP --exclude=*/.NO_BACKUP/* \
+    "$@" --verbatim-files-from "--files-from=$FILE_LIST"
+  if [[ -f "$PARTS_FILE" ]]; then
+    impl/parts.py tar "$SNAPSHOT_PATH" "$PARTS_FILE"
+  fi
+} | "${COMPRESS[@]}" | "${ENCRYPT[@]}" >"$ARCHIVE"
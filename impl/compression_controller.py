@@ -0,0 +1,94 @@
+'''
+Adapts the zstd settings of the archives to the measured build and upload rates, used
+by upload_sets.py.
+
+When archives are built faster than they are uploaded, stronger compression costs no
+time and leaves less to upload. When uploads wait for archives, compression is made
+faster again. Settings change one step at a time, and only after a set was built with
+the current ones. Only archives compressed by zstd are adapted.
+'''
+
+import os
+import threading
+
+from impl.tools import size_to_string
+
+# zstd level, threads per build and long distance matching, from fastest to strongest
+STEPS = ((1, 1, False), (3, 1, False), (6, 2, False), (9, 4, False), (12, 4, True),
+         (15, 8, True), (19, 8, True))
+DEFAULT_STEP = 1  # zstd's default level
+# Rates need to differ by this factor to change the settings
+HYSTERESIS = 1.2
+# Weight of the latest measurement in the rates
+SMOOTHING = 0.5
+
+
+def apply_settings(codec, settings):
+    '''Returns codec with the zstd settings (level, threads, long).'''
+    level, threads, long_ = settings
+    return dict(codec, level=level, threads=threads, long=long_)
+
+
+def settings_to_string(settings):
+    level, threads, long_ = settings
+    return f"zstd level {level}, {threads} thread(s){', long' if long_ else ''}"
+
+
+def _smooth(rate, new_rate):
+    return new_rate if rate is None else SMOOTHING * new_rate + (1 - SMOOTHING) * rate
+
+
+class CompressionController:
+    '''Thread-safe, builds and uploads report what they did.'''
+    def __init__(self, num_builders, num_uploaders):
+        self.num_builders = num_builders
+        self.num_uploaders = num_uploaders
+        # Builds running in parallel share the CPUs
+        self.max_threads = max(1, (os.cpu_count() or 1) // num_builders)
+        self.step = DEFAULT_STEP
+        self.build_rate = None  # Archive bytes per second of a build
+        self.upload_rate = None  # Archive bytes per second of an upload
+        self.lock = threading.Lock()
+
+    def get_settings(self):
+        '''Returns (level, threads, long) for the next build.'''
+        with self.lock:
+            return self._get_settings()
+
+    def _get_settings(self):
+        level, threads, long_ = STEPS[self.step]
+        return level, min(threads, self.max_threads), long_
+
+    def add_build(self, settings, archive_size_bytes, duration_sec):
+        with self.lock:
+            # Builds with settings of earlier steps do not tell about the current ones
+            if duration_sec <= 0 or settings[0] != STEPS[self.step][0]:
+                return
+            self.build_rate = _smooth(self.build_rate,
+                                      archive_size_bytes / duration_sec)
+            self._adapt()
+
+    def add_upload(self, archive_size_bytes, duration_sec):
+        with self.lock:
+            if duration_sec <= 0:
+                return
+            self.upload_rate = _smooth(self.upload_rate,
+                                       archive_size_bytes / duration_sec)
+            self._adapt()
+
+    def _adapt(self):
+        if self.build_rate is None or self.upload_rate is None:
+            return
+        build_rate = self.build_rate * self.num_builders
+        upload_rate = self.upload_rate * self.num_uploaders
+        if build_rate > upload_rate * HYSTERESIS and self.step < len(STEPS) - 1:
+            self.step += 1
+        elif build_rate * HYSTERESIS < upload_rate and self.step > 0:
+            self.step -= 1
+        else:
+            return
+        # Measured again with the new settings
+        self.build_rate = None
+        print(f'Archives built at {size_to_string(build_rate)}/s, uploaded at'
+              f' {size_to_string(upload_rate)}/s, switching to'
+              f' {settings_to_string(self._get_settings())}')
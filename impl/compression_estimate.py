@@ -0,0 +1,178 @@
+'''
+Estimates how well the crawled files compress, used by create_sets.py.
+
+Samples of each file type (by extension) are compressed with zstd, as the archives
+are. Sets can then be filled up to the predicted compressed size instead of the
+uncompressed one, so archives of well compressible data still reach the upload limit.
+
+Types are also classified as incompressible, by their extension, the magic bytes of
+their samples or the ratio the samples compress to. Their files can be packed into
+sets of their own, which are archived without compression.
+
+Only the types with the most data are sampled on their own, the long tail of rare
+types shares DEFAULT_TYPE.
+'''
+
+import math
+import os
+import random
+import subprocess
+
+from impl.tools import size_to_string
+
+SAMPLES_PER_TYPE = 8
+SAMPLE_BYTES = 1024 * 1024
+# Number of types sampled on their own, the others are sampled as DEFAULT_TYPE
+MAX_SAMPLED_TYPES = 32
+# Types seen while sampling, further types go directly to DEFAULT_TYPE
+MAX_TRACKED_TYPES = 1024
+# Extensions start with '.' or are empty, so this cannot clash with a type
+DEFAULT_TYPE = '*'
+# Samples compressing to more than this are considered incompressible
+INCOMPRESSIBLE_RATIO = 0.95
+# Already compressed formats, not sampled
+INCOMPRESSIBLE_TYPES = frozenset(
+    ('.7z', '.aac', '.avi', '.avif', '.bz2', '.flac', '.gif', '.gz', '.heic', '.jpeg',
+     '.jpg', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.opus', '.png',
+     '.rar', '.tgz', '.webm', '.webp', '.xz', '.zip', '.zst'))
+# Magic bytes at the start of compressed formats, for types not known by extension
+INCOMPRESSIBLE_MAGICS = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG',
+    b'GIF8',
+    b'\x1a\x45\xdf\xa3',  # Matroska, WebM
+    b'ID3',  # MP3
+    b'OggS',
+    b'fLaC',
+    b'PK\x03\x04',  # Zip, also Office documents
+    b'\x1f\x8b',  # gzip
+    b'BZh',
+    b'\xfd7zXZ\x00',
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'7z\xbc\xaf\x27\x1c',
+    b'Rar!')
+
+
+def has_incompressible_magic(data):
+    # ISO base media files (MP4, MOV, HEIC) start with the size of the ftyp box
+    return data.startswith(INCOMPRESSIBLE_MAGICS) or data[4:8] == b'ftyp'
+
+
+def get_file_type(name):
+    return os.path.splitext(name)[1].lower()
+
+
+class CompressionEstimator:
+    '''Predicts compressed sizes from a sample of files per type.
+
+    The compression ratio of a type is multiplied by safety_margin and capped at 1,
+    types without samples are assumed to be incompressible. Types not sampled on their
+    own get the ratio of DEFAULT_TYPE.
+    '''
+    def __init__(self, safety_margin):
+        self.safety_margin = safety_margin
+        self.candidates = {}  # Type to [num_seen, size_seen, sample paths]
+        self.factors = {}  # Type to factor applied to the uncompressed size
+        self.incompressible_types = set()
+
+    @staticmethod
+    def _add_to_reservoir(candidates, path):
+        candidates[0] += 1
+        # Reservoir sampling, as the number of files per type is not known upfront
+        if len(candidates[2]) < SAMPLES_PER_TYPE:
+            candidates[2].append(path)
+        else:
+            index = random.randrange(candidates[0])
+            if index < SAMPLES_PER_TYPE:
+                candidates[2][index] = path
+
+    def _add_candidate(self, path, size):
+        type_ = get_file_type(path)
+        if size == 0 or type_ in INCOMPRESSIBLE_TYPES:
+            return
+        if type_ not in self.candidates and len(self.candidates) >= MAX_TRACKED_TYPES:
+            type_ = DEFAULT_TYPE
+        candidates = self.candidates.setdefault(type_, [0, 0, []])
+        candidates[1] += size
+        self._add_to_reservoir(candidates, path)
+
+    def _merge_rare_types(self):
+        '''Keeps the MAX_SAMPLED_TYPES types with the most data, merges the samples of
+        the others into DEFAULT_TYPE.'''
+        default = self.candidates.pop(DEFAULT_TYPE, [0, 0, []])
+        types = sorted(self.candidates, key=lambda type_: self.candidates[type_][1],
+                       reverse=True)
+        for type_ in types[MAX_SAMPLED_TYPES:]:
+            _, size, paths = self.candidates.pop(type_)
+            default[1] += size
+            for path in paths:
+                self._add_to_reservoir(default, path)
+        if default[2]:
+            self.candidates[DEFAULT_TYPE] = default
+
+    def _get_sampled_type(self, name):
+        type_ = get_file_type(name)
+        if type_ in self.factors or type_ in INCOMPRESSIBLE_TYPES:
+            return type_
+        return DEFAULT_TYPE
+
+    @staticmethod
+    def _compress_samples(paths):
+        '''Returns (uncompressed, compressed) size of the concatenated samples and
+        whether all samples start with the magic bytes of a compressed format.
+
+        Samples are compressed as one stream, like the files in a tar archive.
+        '''
+        data = []
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    data.append(f.read(SAMPLE_BYTES))
+            except OSError as e:
+                print(f'WARNING: Cannot read sample {path}: {e}')
+        has_magic = bool(data) and all(map(has_incompressible_magic, data))
+        data = b''.join(data)
+        if len(data) == 0:
+            return 0, 0, False
+        cp = subprocess.run(['zstd', '-q', '-c'], input=data, stdout=subprocess.PIPE,
+                            check=True)
+        return len(data), len(cp.stdout), has_magic
+
+    def sample(self, root_node):
+        '''Picks and compresses the samples among the files below root_node.
+
+        A single zstd run per sampled type, so at most MAX_SAMPLED_TYPES + 1.
+        '''
+        nodes = [root_node]
+        while nodes:
+            node = nodes.pop()
+            path = None
+            for file_, size in node.iter_files():
+                if path is None:
+                    path = node.get_full_path()
+                self._add_candidate(os.path.join(path, file_), size)
+            nodes.extend(node.dirs.values())
+        self._merge_rare_types()
+
+        total_size = 0
+        total_compressed_size = 0
+        for type_, (_, _, paths) in sorted(self.candidates.items()):
+            size, compressed_size, has_magic = self._compress_samples(paths)
+            if size > 0:
+                self.factors[type_] = min(1.0,
+                                          compressed_size / size * self.safety_margin)
+                if has_magic or compressed_size > size * INCOMPRESSIBLE_RATIO:
+                    self.incompressible_types.add(type_)
+                total_size += size
+                total_compressed_size += compressed_size
+        print(f'Compression estimate: {len(self.factors)} file type(s),'
+              f' {size_to_string(total_size)} sampled, compressed to'
+              f' {size_to_string(total_compressed_size)}, incompressible types:'
+              f" {' '.join(sorted(self.incompressible_types)) or '-'}")
+
+    def get_size(self, name, size):
+        return math.ceil(size * self.factors.get(self._get_sampled_type(name), 1.0))
+
+    def is_incompressible(self, name):
+        type_ = self._get_sampled_type(name)
+        return type_ in INCOMPRESSIBLE_TYPES or type_ in self.incompressible_types
@@ -0,0 +1,751 @@
+'''
+The tree of the crawled file system, used by create_sets.py.
+
+MemoryPath keeps the tree in memory, DbPath in a StateDb. Their base Path packs the
+backup paths of a tree into sets of at most UPLOAD_LIMIT size, sized by ItemSizer.
+'''
+
+import abc
+import array
+import itertools
+import os
+import sys
+
+import binpacking
+
+from impl.tools import BackupException, BackupPathTrie, size_to_string
+
+ITEM_DIR, ITEM_FILE, ITEM_PART = range(3)
+PACKING_STRATEGIES = ('binpacking', 'locality')
+
+# The locality packer starts the next set once the current one is filled this much,
+# otherwise it splits a directory that does not fit to fill the current set
+LOCALITY_MIN_FILL = 0.9
+
+# With a classifier, a directory is still kept whole when the incompressible files or
+# the other files make up at most this share of its size. The directory goes to the
+# sets of its majority, so a single sidecar file does not break up a photo folder.
+MIXED_DIR_MAX_SHARE = 0.1
+
+
+class Path(abc.ABC):
+    '''A directory of the crawled file system.
+
+    The base of the trees kept in memory (MemoryPath) or in a StateDb (DbPath), which
+    store the dirs and files. Packs the backup paths of its subtree into sets.
+    '''
+    __slots__ = ('parent', 'name', 'full_path')
+    # Files larger than UPLOAD_LIMIT are split into parts instead of rejected
+    SPLIT_LARGE_FILES = False
+
+    def __init__(self, name, parent):
+        self.parent = parent
+        self.name = sys.intern(name)
+        self.full_path = None  # Lazily computed, see get_full_path()
+
+    def check_files(self, files):
+        for name, size in files:
+            if name in ('.', '..', '') or '/' in name:
+                raise BackupException(f'Invalid filename {name}')
+
+            if size > Path.UPLOAD_LIMIT and not Path.SPLIT_LARGE_FILES:
+                size_str = size_to_string(size)
+                limit_str = size_to_string(Path.UPLOAD_LIMIT)
+                raise BackupException('File size exceeds upload limit:'
+                                      f' {self.get_full_path()}/{name}'
+                                      f' (size={size_str}, upload_limit={limit_str})')
+
+    @abc.abstractmethod
+    def add_files(self, files):
+        '''Adds a sequence of (name, size) tuples, names must be unique within it.'''
+
+    def add_file(self, name, size):
+        self.add_files(((name, size),))
+
+    @abc.abstractmethod
+    def iter_files(self):
+        '''Yields the (name, size) tuples of the files directly in this directory.'''
+
+    @property
+    def files(self):
+        return list(self.iter_files())
+
+    @abc.abstractmethod
+    def get_dir(self, name):
+        '''Returns the subdirectory name, which is created if it does not exist.'''
+
+    def get_full_path(self):
+        '''Returns the path, which is materialized once per node.'''
+        if self.full_path is None:
+            # Iterative, trees may be deeper than the recursion limit
+            nodes = []
+            node = self
+            while node.parent is not None and node.full_path is None:
+                nodes.append(node)
+                node = node.parent
+            if node.full_path is None:  # Root
+                node.full_path = node.name
+            for child in reversed(nodes):
+                child.full_path = os.path.join(node.full_path, child.name)
+                node = child
+        return self.full_path
+
+    @abc.abstractmethod
+    def get_size(self):
+        '''Returns the size of the subtree.'''
+
+    def get_node(self, path):
+        if self.parent is None:
+            path = os.path.relpath(path, self.name)
+        node = self
+        if len(path) > 0 and path != '.':  # relpath returns '.' for top level dir
+            comps = path.split('/')
+            for comp in comps:
+                node = node.get_dir(comp)
+        return node
+
+    @abc.abstractmethod
+    def get_num_dirs_files(self):
+        '''Returns the number of dirs and files in the subtree.'''
+
+    @abc.abstractmethod
+    def set_estimated_sizes(self, predicted_size, incompressible_size):
+        '''Stores the sizes of the subtree estimated by ItemSizer.'''
+
+    @abc.abstractmethod
+    def get_estimated_sizes(self):
+        '''Returns (predicted_size, incompressible_size) of the subtree.'''
+
+    def iter_links(self):
+        '''Yields (size, owner_path, paths) per hardlinked inode, see RootPath.'''
+        return iter(())
+
+    def _get_borrowed_sizes(self):
+        '''Returns the size of the hardlinked inodes a path links to but does not own.
+
+        A path containing a link whose inode is owned (and sized) outside of it needs
+        the inode's size on top of its own when it is archived without the owner.
+        '''
+        borrowed = {}
+        for size, owner_path, paths in self.iter_links():
+            borrowing_paths = set()
+            for path in paths:
+                if path == owner_path:
+                    continue
+                common_path = os.path.commonpath((path, owner_path))
+                while path != common_path and path not in borrowing_paths:
+                    borrowing_paths.add(path)
+                    path = os.path.dirname(path)
+            for path in borrowing_paths:
+                borrowed[path] = borrowed.get(path, 0) + size
+        return borrowed
+
+    def _group_linked_items(self, items, borrowed):
+        '''Returns the packing units for items, as (items, weight, size) tuples.
+
+        Items sharing hardlinked inodes are kept in one unit if they fit, so all links
+        end up in the same set and tar stores each inode once. Otherwise the items are
+        packed separately, each sized including the inodes it does not own.
+        '''
+        # Split files are archived as parts, which do not share inodes
+        item_indices = {item[0]: index for index, item in enumerate(items)
+                        if item[2] != ITEM_PART}
+        groups = list(range(len(items)))  # Union-find over the item indices
+
+        def find_group(index):
+            while groups[index] != index:
+                groups[index] = groups[groups[index]]
+                index = groups[index]
+            return index
+
+        for _, _, paths in self.iter_links():
+            first_group = None
+            for path in paths:
+                # Find the item containing the link
+                index = item_indices.get(path)
+                while index is None and path != os.path.dirname(path):
+                    path = os.path.dirname(path)
+                    index = item_indices.get(path)
+                if index is None:
+                    continue
+                group = find_group(index)
+                if first_group is None:
+                    first_group = group
+                elif group != first_group:
+                    groups[group] = first_group
+
+        group_items = {}
+        for index, item in enumerate(items):
+            group_items.setdefault(find_group(index), []).append(item)
+        units = []
+        for items_ in group_items.values():
+            weight = sum(item[4] for item in items_)
+            if len(items_) > 1 and weight <= Path.UPLOAD_LIMIT:
+                units.append((items_, weight, sum(item[1] for item in items_)))
+            else:
+                for item in items_:
+                    size_borrowed = 0
+                    if item[2] != ITEM_PART:
+                        size_borrowed = borrowed.get(item[0], 0)
+                    units.append(
+                        ([item], item[4] + size_borrowed, item[1] + size_borrowed))
+        return units
+
+    @staticmethod
+    def _pack_locality(units, make_unit):
+        '''Packs the units into sets in path order, next-fit.
+
+        Consecutive units go to the same set, so siblings and subtrees stay together
+        and a directory is spread over adjacent sets at most. A single directory that
+        does not fit into a set that is still mostly empty is split into its files
+        and subdirectories to fill it, make_unit creates their units.
+        '''
+        bins = []
+        bin_ = []
+        bin_size = 0
+        pending = list(reversed(units))
+        while pending:
+            unit = pending.pop()
+            unit_items, unit_weight, _ = unit
+            if bin_size + unit_weight <= Path.UPLOAD_LIMIT:
+                bin_.append(unit)
+                bin_size += unit_weight
+                continue
+
+            if (len(unit_items) == 1 and unit_items[0][2] == ITEM_DIR
+                    and bin_size < LOCALITY_MIN_FILL * Path.UPLOAD_LIMIT):
+                path, _, _, node, _ = unit_items[0]
+                children = []
+                for file_, size in node.iter_files():
+                    children.append(make_unit(os.path.join(path, file_), size,
+                                              ITEM_FILE, None))
+                for dir_ in node.dirs.values():
+                    children.append(make_unit(dir_.get_full_path(), dir_.get_size(),
+                                              ITEM_DIR, dir_))
+                pending.extend(reversed(children))
+                continue
+
+            if bin_:
+                # Try again with an empty set, a directory may then be split
+                bins.append(bin_)
+                bin_ = []
+                bin_size = 0
+                pending.append(unit)
+                continue
+            # A unit heavier than the limit that cannot be split gets a set of its own
+            bins.append([unit])
+        if bin_:
+            bins.append(bin_)
+        return bins
+
+    def _collect_items(self, backup_paths, sizer):
+        '''Adds the items of the backup paths to sizer, whole directories where
+        possible.'''
+        backup_path_trie = BackupPathTrie(backup_paths)
+        descend = BackupPathTrie.descend
+        is_inside = BackupPathTrie.is_inside
+        # Depth-first in the same order as a recursive traversal, but without
+        # recursion since trees may be deeper than the recursion limit.
+        # Each node comes with its position in backup_path_trie.
+        nodes = [(self, backup_path_trie.root)]
+        while nodes:
+            node, position = nodes.pop()
+            size = node.get_size()
+
+            # When the path fits, we still cannot simply zip it up fully
+            # since only a subset of entries may be in the backup_paths.
+            if (sizer.get_dir_weight(node, size) <= Path.UPLOAD_LIMIT
+                    and is_inside(position) and sizer.can_add_dir(node, size)):
+                sizer.add_item(node.get_full_path(), size, ITEM_DIR, node)
+                continue
+
+            path = None
+            for file_, size in node.iter_files():
+                if is_inside(descend(position, file_)):
+                    if path is None:
+                        path = node.get_full_path()
+                    sizer.add_file_item(os.path.join(path, file_), size)
+            for dir_ in reversed(node.dirs.values()):
+                dir_position = descend(position, dir_.name)
+                # Nothing to back up below a path that is not a parent of a backup path
+                if dir_position is not None:
+                    nodes.append((dir_, dir_position))
+
+    def _pack_units(self, units, packing_strategy, sizer):
+        '''Returns the bins of units, with their store_only flag.'''
+        # Units are (items, weight, size), with their store_only flag
+        unit_groups = [(units, False)]
+        if sizer.classifier is not None:
+            unit_groups = [([], False), ([], True)]
+            for unit in units:
+                unit_groups[all(map(sizer.is_incompressible, unit[0]))][0].append(unit)
+        bins = []
+        for units_, store_only in unit_groups:
+            if not units_:
+                continue
+            if packing_strategy == 'locality':
+                bins_ = self._pack_locality(units_, sizer.make_unit)
+            else:
+                bins_ = binpacking.to_constant_volume(units_, Path.UPLOAD_LIMIT,
+                                                      weight_pos=1)
+            bins.extend((bin_, store_only) for bin_ in bins_)
+        return bins
+
+    @staticmethod
+    def _write_bins(set_writer, bins, is_predicted):
+        '''Writes a set per bin, with the predicted size if is_predicted.'''
+        for bin_index, (bin_, store_only) in enumerate(bins):
+            paths = []
+            parts = []
+            total_size = 0
+            total_weight = 0
+            num_dirs = 0
+            num_files = 0
+            for unit_items, unit_weight, unit_size in bin_:
+                total_size += unit_size
+                total_weight += unit_weight
+                for path, size, type_, node, _ in unit_items:
+                    if type_ == ITEM_PART:
+                        parts.append((path, node[0], size, node[1]))
+                    else:
+                        paths.append(path)
+                    if type_ == ITEM_DIR:
+                        num_dirs_node, num_files_node = node.get_num_dirs_files()
+                        num_dirs += num_dirs_node
+                        num_files += num_files_node
+                    else:
+                        num_files += 1
+            predicted_size = total_weight if is_predicted else None
+            set_writer.write_set(bin_index, len(bins), paths, total_size, num_dirs,
+                                 num_files, predicted_size, parts, store_only)
+
+    def create_backup_sets(self, set_writer, backup_paths,
+                           packing_strategy='binpacking', estimator=None,
+                           classifier=None):
+        '''Packs the backup paths into sets and writes them via set_writer.
+
+        The items of the sets are sized by an ItemSizer: With a CompressionEstimator as
+        estimator by their predicted compressed size. With one as classifier,
+        incompressible files are packed into store-only sets of their own.
+        '''
+        borrowed = self._get_borrowed_sizes()
+        sizer = ItemSizer(self, borrowed, estimator, classifier)
+        self._collect_items(backup_paths, sizer)
+        if len(sizer.items) > 0:
+            units = self._group_linked_items(sizer.items, borrowed)
+            bins = self._pack_units(units, packing_strategy, sizer)
+            self._write_bins(set_writer, bins, estimator is not None)
+
+
+class ItemSizer:
+    '''Creates and sizes the items packed into sets by Path.create_backup_sets().
+
+    Items are (path, size, type, node, weight) tuples. The weight is the size sets are
+    packed by: The uncompressed size or, with a CompressionEstimator, the predicted
+    compressed size. Files larger than the upload limit are split into part items,
+    their node is (offset, file size). borrowed are the sizes of the hardlinked inodes
+    a path links to but does not own.
+
+    With a CompressionEstimator as classifier, directories mixing incompressible files
+    with other files are not added as a whole unless the minority stays within
+    MIXED_DIR_MAX_SHARE of their size.
+
+    The predicted and incompressible sizes of the directories are stored in their
+    nodes, see estimate_tree_sizes().
+    '''
+    def __init__(self, root_node, borrowed, estimator=None, classifier=None):
+        self.borrowed = borrowed
+        self.estimator = estimator
+        self.classifier = classifier
+        self.items = []
+        if estimator is not None:
+            estimator.sample(root_node)
+        if classifier is not None and classifier is not estimator:
+            classifier.sample(root_node)
+        if estimator is not None or classifier is not None:
+            self.estimate_tree_sizes(root_node)
+
+    def _get_file_sizes(self, node):
+        '''Returns the predicted and incompressible size of the files of node.'''
+        predicted_size = 0
+        incompressible_size = 0
+        for name, size in node.iter_files():
+            if self.estimator is not None:
+                predicted_size += self.estimator.get_size(name, size)
+            else:
+                predicted_size += size
+            if self.classifier is not None and self.classifier.is_incompressible(name):
+                incompressible_size += size
+        return predicted_size, incompressible_size
+
+    def estimate_tree_sizes(self, root_node):
+        '''Stores the predicted and incompressible size of each subtree in its node.'''
+        # Post-order without recursion: The files of a node are sized when it is
+        # entered, its sizes are added to its parent's when it is left
+        frames = [[root_node, iter(root_node.dirs.values()),
+                   *self._get_file_sizes(root_node)]]
+        while frames:
+            frame = frames[-1]
+            dir_ = next(frame[1], None)
+            if dir_ is not None:
+                frames.append([dir_, iter(dir_.dirs.values()),
+                               *self._get_file_sizes(dir_)])
+                continue
+            node, _, predicted_size, incompressible_size = frames.pop()
+            node.set_estimated_sizes(predicted_size, incompressible_size)
+            if frames:
+                frames[-1][2] += predicted_size
+                frames[-1][3] += incompressible_size
+
+    def get_dir_weight(self, node, size):
+        weight = size if self.estimator is None else node.get_estimated_sizes()[0]
+        if self.borrowed:
+            weight += self.borrowed.get(node.get_full_path(), 0)
+        return weight
+
+    @staticmethod
+    def is_incompressible_dir(node, size):
+        '''None when the directory mixes both kinds too much to be kept whole.'''
+        incompressible_size = node.get_estimated_sizes()[1]
+        if min(incompressible_size, size - incompressible_size) \
+                > size * MIXED_DIR_MAX_SHARE:
+            return None
+        return incompressible_size * 2 > size
+
+    def can_add_dir(self, node, size):
+        return (self.classifier is None
+                or self.is_incompressible_dir(node, size) is not None)
+
+    def is_incompressible(self, item):
+        path, size, type_, node, _ = item
+        if type_ == ITEM_DIR:
+            return self.is_incompressible_dir(node, size)
+        return self.classifier.is_incompressible(path)
+
+    def make_item(self, path, size, type_, node):
+        if self.estimator is None:
+            weight = size
+        elif type_ == ITEM_DIR:
+            weight = node.get_estimated_sizes()[0]
+        else:
+            weight = self.estimator.get_size(path, size)
+        return path, size, type_, node, weight
+
+    def add_item(self, path, size, type_, node):
+        self.items.append(self.make_item(path, size, type_, node))
+
+    def add_file_item(self, path, size):
+        item = self.make_item(path, size, ITEM_FILE, None)
+        if (not Path.SPLIT_LARGE_FILES
+                or item[4] + self.borrowed.get(path, 0) <= Path.UPLOAD_LIMIT):
+            self.items.append(item)
+            return
+        # Parts are byte ranges of the file, so split by its length rather than
+        # the data size of a sparse file. An inode not owned is archived in full
+        # as well, so split it too.
+        file_size = os.lstat(path).st_size
+        for offset in range(0, file_size, Path.UPLOAD_LIMIT):
+            length = min(Path.UPLOAD_LIMIT, file_size - offset)
+            self.add_item(path, length, ITEM_PART, (offset, file_size))
+
+    def make_unit(self, path, size, type_, node):
+        '''Returns the packing unit of a single item, see Path._pack_locality().'''
+        # Inodes that are not owned are not compressed in the prediction
+        size_borrowed = self.borrowed.get(path, 0)
+        item = self.make_item(path, size, type_, node)
+        return [item], item[4] + size_borrowed, size + size_borrowed
+
+
+class MemoryPath(Path):
+    '''A directory of the crawled file system, kept in memory.
+
+    Crawls can contain tens of millions of files, so nodes are kept compact: The
+    names of the files in a directory are stored in a single string separated by '/'
+    (which cannot occur in a filename), their sizes in an array. Files added to a
+    non-empty directory are kept in a dict of names to sizes in place of _file_names
+    until the next access, which merges them.
+
+    The size and the number of dirs/files of the subtree are updated on each change,
+    so reading them is O(1). The estimated sizes are not pickled, they are set again
+    for each packing.
+    '''
+    __slots__ = ('dirs', 'tree_size', 'tree_dirs', 'tree_files', '_file_names',
+                 '_file_sizes', '_estimated_sizes')
+
+    def __init__(self, name, parent):
+        super().__init__(name, parent)
+        self.dirs = {}
+        self.tree_size = 0
+        self.tree_dirs = 1  # Including current dir
+        self.tree_files = 0
+        self._file_names = ''
+        self._file_sizes = array.array('Q')
+        self._estimated_sizes = None
+
+    def __getstate__(self):
+        self._merge_pending()
+        return (self.parent, self.name, self.dirs, self.tree_size, self.tree_dirs,
+                self.tree_files, self._file_names, self._file_sizes)
+
+    def __setstate__(self, state):
+        parent, name, *state = state
+        super().__init__(name, parent)
+        (self.dirs, self.tree_size, self.tree_dirs, self.tree_files, self._file_names,
+         self._file_sizes) = state
+        self._estimated_sizes = None
+
+    def _set_files(self, files):
+        names = []
+        sizes = array.array('Q')
+        for name, size in files:
+            names.append(name)
+            sizes.append(size)
+        self._file_names = '/'.join(names)
+        self._file_sizes = sizes
+
+    def _has_pending(self):
+        return isinstance(self._file_names, dict)
+
+    def _merge_pending(self):
+        if self._has_pending():
+            self._set_files(self._file_names.items())
+
+    def _split_file_names(self):
+        if len(self._file_sizes) == 0:
+            return []
+        return self._file_names.split('/')
+
+    def _add_to_tree_stats(self, size, num_dirs, num_files):
+        node = self
+        while node is not None:
+            node.tree_size += size
+            node.tree_dirs += num_dirs
+            node.tree_files += num_files
+            node = node.parent
+
+    def add_files(self, files):
+        self.check_files(files)
+        if len(self._file_sizes) == 0 and not self._has_pending():
+            self._set_files(files)
+            num_files = len(files)
+            size = sum(file_size for _, file_size in files)
+        else:
+            if not self._has_pending():
+                self._file_names = dict(zip(self._split_file_names(), self._file_sizes))
+            pending = self._file_names
+            num_files = 0
+            size = 0
+            for name, file_size in files:
+                old_size = pending.get(name)
+                if old_size is None:
+                    num_files += 1
+                    old_size = 0
+                size += file_size - old_size
+                pending[name] = file_size
+        self._add_to_tree_stats(size, 0, num_files)
+
+    def iter_files(self):
+        self._merge_pending()
+        return zip(self._split_file_names(), self._file_sizes)
+
+    def get_num_files(self):
+        self._merge_pending()
+        return len(self._file_sizes)
+
+    def get_files_size(self):
+        self._merge_pending()
+        return sum(self._file_sizes)
+
+    def get_dir(self, name):
+        if name in ('.', '..', ''):
+            raise BackupException(f'Invalid dirname {name}')
+
+        node = self.dirs.get(name)
+        if node is None:
+            node = self.dirs[name] = MemoryPath(name, self)
+            self._add_to_tree_stats(0, 1, 0)
+        return node
+
+    def remove_dir(self, name):
+        node = self.dirs.pop(name)
+        self._add_to_tree_stats(-node.tree_size, -node.tree_dirs, -node.tree_files)
+
+    def get_size(self):
+        return self.tree_size
+
+    def __str__(self):
+        out = ''
+        for dir_ in self.dirs.values():
+            out += str(dir_)
+        if self.get_num_files() > 0:
+            path = self.get_full_path()
+            out += ''.join(os.path.join(path, file_[0]) + '\n'
+                           for file_ in self.iter_files())
+        return out
+
+    def get_num_dirs_files(self):
+        return self.tree_dirs, self.tree_files
+
+    def set_estimated_sizes(self, predicted_size, incompressible_size):
+        self._estimated_sizes = (predicted_size, incompressible_size)
+
+    def get_estimated_sizes(self):
+        return self._estimated_sizes
+
+
+class RootPath(MemoryPath):
+    '''The root directory of a crawl, which also tracks the hardlinked files.
+
+    links maps (st_dev, st_ino) to [size, owner_path, path, path, ...] with the paths
+    of all links to the inode. The owner is the link with the smallest path, only
+    it is sized in the tree.
+    '''
+    __slots__ = ('links',)
+
+    def __init__(self, name):
+        super().__init__(name, None)
+        self.links = {}
+
+    def __getstate__(self):
+        return super().__getstate__() + (self.links,)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-1])
+        self.links = state[-1]
+
+    def add_link(self, key, path, size):
+        '''Records a link to an inode, returns the previous owner path or None.'''
+        link = self.links.get(key)
+        if link is None:
+            self.links[key] = [size, path, path]
+            return None
+        owner_path = link[1]
+        link.append(path)
+        if path < owner_path:
+            link[1] = path
+        return owner_path
+
+    def get_link_owner(self, key):
+        link = self.links.get(key)
+        return None if link is None else link[1]
+
+    def iter_links(self):
+        for link in self.links.values():
+            yield link[0], link[1], link[2:]
+
+
+class DbPath(Path):
+    '''A directory of the crawled file system, stored in a StateDb.
+
+    Nodes are created on access and only hold their own statistics, so the tree is
+    never fully loaded. Changes to the subtree statistics are applied to all
+    ancestors in the database. Nodes created by get_dir() read them lazily, nodes
+    created by listing the dirs of their parent get them from the listing.
+    '''
+    __slots__ = ('db', 'id', 'tree_size', 'tree_dirs', 'tree_files', '_estimated_sizes')
+
+    def __init__(self, db, row, parent):
+        dir_id, name, self.tree_size, self.tree_dirs, self.tree_files = row
+        super().__init__(name, parent)
+        self.db = db
+        self.id = dir_id
+        self._estimated_sizes = None
+
+    @staticmethod
+    def create_root(db, snapshot_path):
+        return DbPath(db, (db.add_root(snapshot_path), snapshot_path, None, None, None),
+                      None)
+
+    @staticmethod
+    def load_root(db):
+        return DbPath(db, db.get_root(), None)
+
+    @property
+    def dirs(self):
+        return {row[1]: DbPath(self.db, row, self) for row in self.db.get_dirs(self.id)}
+
+    def _add_to_tree_stats(self, size, num_dirs, num_files):
+        dir_ids = []
+        node = self
+        while node is not None:
+            dir_ids.append(node.id)
+            node = node.parent
+        self.db.add_to_tree_stats(dir_ids, size, num_dirs, num_files)
+
+    def add_files(self, files):
+        self.check_files(files)
+        if self.db.get_files_stats(self.id)[0] == 0:
+            num_files = len(files)
+            size = sum(file_size for _, file_size in files)
+        else:
+            existing = dict(self.db.get_files(self.id))
+            num_files = 0
+            size = 0
+            for name, file_size in files:
+                old_size = existing.get(name)
+                if old_size is None:
+                    num_files += 1
+                    old_size = 0
+                size += file_size - old_size
+        self.db.add_files(self.id, files)
+        self._add_to_tree_stats(size, 0, num_files)
+
+    def iter_files(self):
+        return self.db.get_files(self.id)
+
+    def get_num_files(self):
+        return self.db.get_files_stats(self.id)[0]
+
+    def get_files_size(self):
+        return self.db.get_files_stats(self.id)[1]
+
+    def get_dir(self, name):
+        if name in ('.', '..', ''):
+            raise BackupException(f'Invalid dirname {name}')
+
+        dir_id, created = self.db.get_or_add_dir(self.id, name)
+        if created:
+            self._add_to_tree_stats(0, 1, 0)
+        return DbPath(self.db, (dir_id, name, None, None, None), self)
+
+    def remove_dir(self, name):
+        node = self.get_dir(name)
+        num_dirs, num_files = node.get_num_dirs_files()
+        self._add_to_tree_stats(-node.get_size(), -num_dirs, -num_files)
+        self.db.remove_dir(node.id)
+
+    def _load_tree_stats(self):
+        if self.tree_size is None:
+            stats = self.db.get_tree_stats(self.id)
+            self.tree_size, self.tree_dirs, self.tree_files = stats
+
+    def get_size(self):
+        self._load_tree_stats()
+        return self.tree_size
+
+    def get_num_dirs_files(self):
+        self._load_tree_stats()
+        return self.tree_dirs, self.tree_files
+
+    def set_estimated_sizes(self, predicted_size, incompressible_size):
+        self._estimated_sizes = (predicted_size, incompressible_size)
+        self.db.set_estimated_sizes(self.id, predicted_size, incompressible_size)
+
+    def get_estimated_sizes(self):
+        if self._estimated_sizes is None:
+            self._estimated_sizes = self.db.get_estimated_sizes(self.id)
+        return self._estimated_sizes
+
+    def add_link(self, key, path, size):
+        owner_path = self.db.get_link_owner(*key)
+        self.db.add_link(*key, path, size)
+        return owner_path
+
+    def get_link_owner(self, key):
+        return self.db.get_link_owner(*key)
+
+    def iter_links(self):
+        for _, rows in itertools.groupby(self.db.get_links(), key=lambda row: row[:2]):
+            rows = list(rows)
+            paths = [row[2] for row in rows]
+            yield rows[0][3], min(paths), paths
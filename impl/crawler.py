@@ -0,0 +1,581 @@
+'''
+Crawls the backup paths of the snapshot into a tree, used by create_sets.py.
+
+Directories are listed by os.scandir, optionally by a pool of threads, and the
+counts and sizes of the crawl are verified against find. Sparse files are sized by
+their data regions, hardlinked inodes once.
+'''
+
+import array
+import copy
+import datetime
+import errno
+import fcntl
+import json
+import os
+import queue
+import random
+import re
+import stat
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from impl.crawl_tree import RootPath
+from impl.tools import (GDAB_SEALED_MARKER, NO_BACKUP_MARKER, BackupException,
+                        size_to_string)
+
+
+class DualCounter:
+    def __init__(self, title, name1, name2):
+        self.title = title
+        self.name1 = name1
+        self.name2 = name2
+        self.count1 = 0
+        self.count2 = 0
+
+    def add_counter1(self, count_):
+        self.count1 += count_
+
+    def add_counter2(self, count_):
+        self.count2 += count_
+
+    def get(self):
+        self.verify()
+        return self.count1
+
+    def verify(self):
+        if self.count1 != self.count2:
+            msg = (f'Mismatch: {self.title}: {self.name1}={self.count1}, '
+                   f'{self.name2}={self.count2}, '
+                   f'diff: {self.count1 - self.count2}')
+            raise BackupException(msg)
+
+    def __add__(self, rhs):
+        result = copy.deepcopy(self)
+        result.count1 += rhs.count1
+        result.count2 += rhs.count2
+        return result
+
+
+# Smaller files are always sized by their length, even if sparse
+SPARSE_MIN_SIZE = 1024 * 1024
+# Files with more allocated than this share of their length are sized by their length.
+# File system compression (ZFS, btrfs) also shrinks the allocation, but rarely by this
+# much, so most files are not scanned for holes on a compressed file system.
+SPARSE_MAX_ALLOCATED_RATIO = 0.125
+
+# With parallel listing, directories listed or waiting to be processed per worker
+MAX_LISTINGS_PER_WORKER = 4
+
+
+def is_sparse_candidate(size, blocks):
+    '''Whether a regular file may have holes, so its data regions need to be sized.
+
+    Fewer allocated blocks than the length can also be caused by file system
+    compression, so it only makes a file a candidate. Files are only sized when far
+    less is allocated than their length, otherwise their length is counted, which can
+    only overestimate the archive.
+    '''
+    return size >= SPARSE_MIN_SIZE and blocks * 512 < size * SPARSE_MAX_ALLOCATED_RATIO
+
+
+def get_data_size(file_path, size):
+    '''Returns the number of bytes in the data regions of a file.
+
+    tar --sparse only archives these, found via SEEK_DATA/SEEK_HOLE as well. If the
+    file system cannot report holes, the whole file is data.
+    '''
+    fd = os.open(file_path, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        data_size = 0
+        offset = 0
+        while offset < size:
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # No data after offset
+                    break
+                if e.errno == errno.EINVAL:  # Not supported
+                    return size
+                raise
+            offset = min(os.lseek(fd, data_start, os.SEEK_HOLE), size)
+            data_size += offset - data_start
+        return data_size
+    finally:
+        os.close(fd)
+
+
+def escape_find_pattern(path):
+    return re.sub(r'([][*?\\])', r'\\\1', path)
+
+
+def run_find(path, skipped_paths, seen_inodes):
+    '''Counts files and symlinks below path, independently of the crawl.
+
+    A single find pass delivers both the number and the total size of the files,
+    which are summed up here. Files with several hard links are sized once per
+    inode: Inodes already in seen_inodes are not sized again, new ones are added to
+    it with their size. Sparse files are sized like in the crawl, by their data
+    regions. Returns (num_files, size_files, cmd).
+    '''
+    cmd = ['find', path]
+    if skipped_paths:
+        cmd.append('(')
+        for index, skipped_path in enumerate(sorted(skipped_paths)):
+            if index > 0:
+                cmd.append('-o')
+            cmd.extend(('-path', escape_find_pattern(skipped_path)))
+        cmd.extend((')', '-prune', '-o'))
+    # Paths may contain newlines, so records are separated by NUL
+    cmd.extend(('(', '-type', 'f', '-o', '-type', 'l', ')', '-printf',
+                '%y %D %i %n %b %s %p\\0'))
+
+    num_files = 0
+    size_files = 0
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        buffer = b''
+        while chunk := proc.stdout.read(1 << 16):
+            records = (buffer + chunk).split(b'\0')
+            buffer = records.pop()
+            for record in records:
+                type_, dev, ino, nlink, blocks, size, file_path = record.split(b' ', 6)
+                dev, ino, nlink, size = int(dev), int(ino), int(nlink), int(size)
+                if type_ == b'f' and is_sparse_candidate(size, int(blocks)):
+                    size = get_data_size(file_path, size)
+                num_files += 1
+                if nlink > 1:
+                    key = (dev, ino)
+                    if key in seen_inodes:
+                        continue
+                    seen_inodes[key] = size
+                size_files += size
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return num_files, size_files, cmd
+
+
+def update_find_counters(path, skipped_paths, sub_num_files, sub_size_files,
+                         seen_inodes):
+    num_files, size_files, cmd = run_find(path, skipped_paths, seen_inodes)
+    sub_num_files.add_counter2(num_files)
+    sub_size_files.add_counter2(size_files)
+    try:
+        sub_num_files.verify()
+        sub_size_files.verify()
+    except BackupException:
+        print(f'Exception during verify, {cmd=}')
+        raise
+
+
+class VerifySampler:
+    '''Picks random directories of a crawl, their subtrees are verified via find.
+
+    Uses reservoir sampling, so every crawled directory has the same chance of being
+    picked without having to keep a list of all of them.
+    '''
+    NUM_SAMPLES = 10
+
+    def __init__(self):
+        self.samples = []
+        self.num_seen = 0
+
+    def add(self, dir_path, node):
+        self.num_seen += 1
+        if len(self.samples) < VerifySampler.NUM_SAMPLES:
+            self.samples.append((dir_path, node))
+        else:
+            index = random.randrange(self.num_seen)
+            if index < VerifySampler.NUM_SAMPLES:
+                self.samples[index] = (dir_path, node)
+
+    def verify(self, skipped_paths, root_node):
+        for dir_path, node in self.samples:
+            sample_num_files = DualCounter('samplefiles', 'walk', 'find')
+            sample_size_files = DualCounter('samplesize', 'walk', 'find')
+            _, num_files = node.get_num_dirs_files()
+            sample_num_files.add_counter1(num_files)
+            sample_size_files.add_counter1(node.get_size())
+            sample_skipped_paths = [
+                skipped_path for skipped_path in skipped_paths
+                if skipped_path.startswith(os.path.join(dir_path, ''))
+            ]
+            seen_inodes = {}
+            num_files, size_files, cmd = run_find(dir_path, sample_skipped_paths,
+                                                  seen_inodes)
+            # The subtree is only sized with the hardlinked inodes whose owning link
+            # is inside of it, find sizes all of them
+            dir_prefix = os.path.join(dir_path, '')
+            for key, size in seen_inodes.items():
+                owner_path = root_node.get_link_owner(key)
+                if owner_path is not None and not owner_path.startswith(dir_prefix):
+                    sample_size_files.add_counter1(size)
+            sample_num_files.add_counter2(num_files)
+            sample_size_files.add_counter2(size_files)
+            try:
+                sample_num_files.verify()
+                sample_size_files.verify()
+            except BackupException:
+                print(f'Exception during verify, {cmd=}')
+                raise
+
+
+# _IOR('f', 1, long) from linux/fs.h
+FS_IOC_GETFLAGS = (2 << 30) | (struct.calcsize('l') << 16) | (ord('f') << 8) | 1
+FS_IMMUTABLE_FL = 0x10
+
+
+def is_immutable(dir_path):
+    '''Reads the immutable flag in-process, as lsattr does.
+
+    Returns None when the file system does not support reading the flags.
+    '''
+    fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        flags = array.array('l', [0])
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags, True)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    return bool(flags[0] & FS_IMMUTABLE_FL)
+
+
+def get_archived_size(file_path, info):
+    '''Returns the size of a file in the archive, for sparse files without holes.'''
+    if stat.S_ISREG(info.st_mode) and is_sparse_candidate(info.st_size, info.st_blocks):
+        return get_data_size(file_path, info.st_size)
+    return info.st_size
+
+
+def scan_dir(dir_path, seal_action):
+    '''Lists a single directory, may be called from crawler worker threads.
+
+    Does not touch the Path tree, the results are applied by the crawling thread.
+    Returns (skip_msg, files, dirs, links), where files is a list of (name, size)
+    tuples for all non-directories (including symlinks to directories) and dirs the
+    names of all subdirectories in listing order. links holds (index in files,
+    (st_dev, st_ino)) for the files with more than one hard link. The sealed and
+    .NO_BACKUP markers are detected from the listing, before any entry is stat'ed.
+    '''
+    with os.scandir(dir_path) as it:
+        entries = list(it)
+
+    is_sealed = False
+    is_excluded = False
+    for entry in entries:
+        if entry.name == GDAB_SEALED_MARKER:
+            is_sealed = entry.is_symlink()
+        elif entry.name == NO_BACKUP_MARKER:
+            is_excluded = entry.is_file()
+    if is_sealed and seal_action.is_skip_sealed():
+        if not is_immutable(dir_path):
+            print(f'WARNING: Directory {dir_path} contains a sealed marker but is not'
+                  ' immutable!')
+        return f'Directory {dir_path} is sealed, skipping', (), (), ()
+    if is_excluded:
+        return f'Directory {dir_path} is excluded from backup, skipping', (), (), ()
+
+    files = []
+    dirs = []
+    links = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            dirs.append(entry.name)
+        else:
+            info = entry.stat(follow_symlinks=False)  # Do not follow symlinks
+            if info.st_nlink > 1:
+                links.append((len(files), (info.st_dev, info.st_ino)))
+            files.append((entry.name, get_archived_size(entry.path, info)))
+    return None, files, dirs, links
+
+
+def get_snapshot_referenced(snapshot):
+    '''Returns the bytes referenced by the ZFS snapshot or None if unknown.
+
+    The used space of a fresh snapshot is close to zero, the referenced space is the
+    amount of data in it. It is the allocated and possibly compressed size, so it only
+    approximates the apparent sizes seen by the crawl.
+    '''
+    if not snapshot:
+        return None
+    try:
+        cp = subprocess.run(['zfs', 'list', '-Hp', '-o', 'referenced', snapshot],
+                            capture_output=True, check=False)
+    except OSError:
+        return None
+    if cp.returncode != 0:
+        return None
+    try:
+        return int(cp.stdout.decode().strip())
+    except ValueError:
+        return None
+
+
+class PeriodicThread:
+    '''Calls function every interval seconds from a background thread until stopped.'''
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.function()
+
+
+class CrawlProgress:
+    '''Reports the progress of the crawl from a background thread.
+
+    The counts are only updated by the crawling thread. Every interval, a line with
+    the rates since the last report is printed and, if stats_file is set, the same
+    numbers are appended to it as a JSON line, in which counts and info are reported
+    under their keys.
+    '''
+    def __init__(self, snapshot_path, interval, snapshot=None, stats_file=None):
+        self.base_depth = os.path.normpath(snapshot_path).count(os.sep)
+        self.stats_file = stats_file
+        self.info = {'snapshot': snapshot, 'total_bytes': None}
+        self.counts = {'dirs': 0, 'files': 0, 'bytes': 0, 'depth': 0, 'max_depth': 0}
+        self.start_time = None
+        self.last = None  # (time, counts) of the last report
+        self.reporter = PeriodicThread(interval, self.report) if interval > 0 else None
+
+    def update(self, dir_path, num_files, num_bytes):
+        counts = self.counts
+        counts['dirs'] += 1
+        counts['files'] += num_files
+        counts['bytes'] += num_bytes
+        counts['depth'] = dir_path.count(os.sep) - self.base_depth
+        counts['max_depth'] = max(counts['max_depth'], counts['depth'])
+
+    def __enter__(self):
+        self.info['total_bytes'] = get_snapshot_referenced(self.info['snapshot'])
+        self.start_time = time.monotonic()
+        self.last = (self.start_time, dict(self.counts))
+        if self.reporter is not None:
+            self.reporter.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.reporter is not None:
+            self.reporter.stop()
+        self.report(final=True)
+
+    def report(self, final=False):
+        now = time.monotonic()
+        counts = dict(self.counts)
+        last_time, last_counts = self.last
+        self.last = (now, counts)
+        if final:
+            # Averages over the whole crawl
+            last_time, last_counts = self.start_time, dict.fromkeys(counts, 0)
+        duration = max(now - last_time, 1e-9)
+        elapsed = now - self.start_time
+
+        eta = None
+        total_bytes = self.info['total_bytes']
+        if total_bytes is not None and counts['bytes'] > 0:
+            eta = max(total_bytes - counts['bytes'], 0) * elapsed / counts['bytes']
+        stats = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                 'final': final,
+                 'elapsed_sec': round(elapsed, 3),
+                 **self.info,
+                 **counts,
+                 'dirs_per_sec': round((counts['dirs'] - last_counts['dirs'])
+                                       / duration, 1),
+                 'files_per_sec': round((counts['files'] - last_counts['files'])
+                                        / duration, 1),
+                 'bytes_per_sec': round((counts['bytes'] - last_counts['bytes'])
+                                        / duration),
+                 'eta_sec': None if eta is None else round(eta)}
+
+        eta_str = '?' if eta is None else str(datetime.timedelta(seconds=round(eta)))
+        print(f'  {"Crawled" if final else "Progress"}: {counts["dirs"]} dirs'
+              f' ({stats["dirs_per_sec"]}/s), {counts["files"]} files'
+              f' ({stats["files_per_sec"]}/s),'
+              f' {size_to_string(counts["bytes"])}'
+              f' ({size_to_string(stats["bytes_per_sec"])}/s),'
+              f' depth {counts["depth"]} (max {counts["max_depth"]}), ETA {eta_str}')
+        if self.stats_file:
+            with open(self.stats_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(stats) + '\n')
+
+
+def crawl_dir(path, root_node, seal_action, process_files, skipped_paths,
+              num_workers=1):
+    '''Crawls the directory tree at path, calls process_files for each directory.
+
+    Each directory is listed via os.scandir, which delivers the entry types without
+    extra syscalls. The node of a directory is created by its parent and handed down
+    together with its path, so nodes are never looked up from the root.
+
+    With num_workers > 1, directories are listed by a pool of threads. At most
+    MAX_LISTINGS_PER_WORKER * num_workers directories are listed or wait to be
+    processed at a time, the others wait on the stack, so the memory held by listings
+    does not grow with the width of the tree. The tree is only modified by the calling
+    thread and nodes are created in listing order, so the resulting tree does not
+    depend on the number of workers.
+    '''
+    executor = None
+    results = queue.Queue()  # Parallel: Listed directories
+    pending = []  # Stack of directories to be listed
+    num_in_flight = 0  # Parallel: Directories submitted, but not processed yet
+
+    def submit(dir_path, node):
+        future = executor.submit(scan_dir, dir_path, seal_action)
+        future.add_done_callback(lambda future: results.put((future, dir_path, node)))
+
+    def get_listed():
+        nonlocal num_in_flight
+        if executor is None:
+            dir_path, node = pending.pop()
+            return scan_dir(dir_path, seal_action), dir_path, node
+        while pending and num_in_flight < MAX_LISTINGS_PER_WORKER * num_workers:
+            submit(*pending.pop())
+            num_in_flight += 1
+        future, dir_path, node = results.get()
+        num_in_flight -= 1
+        return future.result(), dir_path, node
+
+    if num_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        # The node of the top directory is only created when it is not skipped
+        pending.append((path, None))
+        while pending or num_in_flight > 0:
+            (skip_msg, files, dirs, links), dir_path, node = get_listed()
+            if skip_msg:
+                print(skip_msg)
+                skipped_paths.add(dir_path)
+                if node is not None:
+                    node.parent.remove_dir(node.name)
+                continue
+            if node is None:
+                node = root_node.get_node(dir_path)
+            process_files(dir_path, node, files, links)
+            dir_nodes = [
+                (os.path.join(dir_path, dir_), node.get_dir(dir_)) for dir_ in dirs
+            ]
+            # Depth-first in listing order, as os.walk. This also keeps the stack
+            # small, it only holds the siblings along the current path.
+            dir_nodes.reverse()
+            pending.extend(dir_nodes)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def add_crawled_files(root_node, dir_path, node, files, links):
+    '''Adds the files of a crawled directory, sizing each hardlinked inode once.
+
+    Of all links to an inode, the one with the smallest path carries its size, the
+    others have size 0. Choosing by path keeps the tree independent of the crawl
+    order. Returns the size of the files, counting inodes seen before as 0.
+    '''
+    size = sum(file_size for _, file_size in files)
+    if not links:
+        node.add_files(files)
+        return size
+
+    files = list(files)
+    owned = {}  # Name to size of the links that now carry the size of their inode
+    previous_owner_paths = []
+    for index, key in links:
+        name, file_size = files[index]
+        files[index] = (name, 0)
+        path = os.path.join(dir_path, name)
+        owner_path = root_node.add_link(key, path, file_size)
+        if owner_path is not None:
+            size -= file_size  # Inode already counted
+        if owner_path is None or path <= owner_path:
+            owned[name] = file_size
+            if owner_path is not None and owner_path != path:
+                previous_owner_paths.append(owner_path)
+
+    node.add_files(files)
+    for owner_path in previous_owner_paths:
+        owner_dir_path, owner_name = os.path.split(owner_path)
+        if owner_dir_path == dir_path and owner_name in owned:
+            del owned[owner_name]
+        else:
+            root_node.get_node(owner_dir_path).add_file(owner_name, 0)
+    if owned:
+        node.add_files(list(owned.items()))
+    return size
+
+
+def crawl(snapshot_path, backup_paths, seal_action, num_workers=1, verify_mode='full',
+          root_node=None, progress=None):
+    if root_node is None:
+        root_node = RootPath(snapshot_path)
+
+    num_files = DualCounter('files', 'walk', 'find')
+    size_files = DualCounter('size', 'walk', 'find')
+    seen_inodes = {}  # Hardlinked inodes counted by find, over all backup paths
+
+    for path in backup_paths:
+        path = os.path.join(snapshot_path, path)
+        print(f'Crawling {path}')
+
+        sub_num_files = DualCounter('subfiles', 'walk', 'find')
+        sub_size_files = DualCounter('subsize', 'walk', 'find')
+        skipped_paths = set()
+        sampler = VerifySampler()
+
+        def process_files(dir_path, node, files, links):
+            sampler.add(dir_path, node)  # pylint: disable=cell-var-from-loop
+            dir_size = add_crawled_files(root_node, dir_path, node, files, links)
+            sub_num_files.add_counter1(len(files))  # pylint: disable=cell-var-from-loop
+            sub_size_files.add_counter1(dir_size)  # pylint: disable=cell-var-from-loop
+            if progress is not None:
+                progress.update(dir_path, len(files), dir_size)
+
+        if not os.path.isdir(path):
+            if seal_action.is_seal_after_backup():
+                raise BackupException('Sealing of files not supported, please move'
+                                      f' file {path} to an extra directory and adjust'
+                                      ' the backup config to point to it instead of the'
+                                      ' file')
+            dir_path, name = os.path.split(path)
+            node = root_node.get_node(dir_path)
+            info = os.lstat(path)  # Do not follow symlinks
+            links = [(0, (info.st_dev, info.st_ino))] if info.st_nlink > 1 else []
+            file_size = add_crawled_files(root_node, dir_path, node,
+                                          [(name, get_archived_size(path, info))],
+                                          links)
+            sub_num_files.add_counter1(1)
+            sub_size_files.add_counter1(file_size)
+        else:
+            crawl_dir(path, root_node, seal_action, process_files, skipped_paths,
+                      num_workers)
+
+        if verify_mode == 'sample' and sampler.num_seen > 0:
+            # Only the sampled subtrees are checked against find, take over the walk
+            # counts for the whole path
+            sampler.verify(skipped_paths, root_node)
+            sub_num_files.add_counter2(sub_num_files.count1)
+            sub_size_files.add_counter2(sub_size_files.count1)
+        else:
+            update_find_counters(path, skipped_paths, sub_num_files, sub_size_files,
+                                 seen_inodes)
+
+        num_files += sub_num_files
+        size_files += sub_size_files
+
+        print(f'  {size_to_string(sub_size_files.get())}, {sub_num_files.get()} files')
+
+    num_files.verify()
+    size_files.verify()
+
+    return root_node
@@ -11,7 +11,8 @@ SNAPSHOT_PATH is where the ZFS snapshot is mounted.
 Sets are processed later by upload_sets.py.
 '''
 
-import copy
+import gzip
+import hashlib
 import json
 import os
 import pickle
@@ -19,22 +20,73 @@ import re
 import stat
 import subprocess
 import sys
-from functools import lru_cache
-
-import binpacking
 
+from impl.compression_estimate import CompressionEstimator
+from impl.crawl_tree import PACKING_STRATEGIES, DbPath, Path
+from impl.crawler import CrawlProgress, crawl
+from impl.set_manifest import SetManifest
+from impl.state_db import StateDb, is_state_db
 from impl.tools import (GDAB_SEALED_MARKER, NO_BACKUP_MARKER, BackupException,
-                        SealAction, glob_backup_paths_and_check, make_set_info_filename,
-                        size_to_string)
+                        SealAction, glob_backup_paths_and_check, make_set_list_filename,
+                        make_set_parts_filename, size_to_string)
 
 SEAL_AFTER_BACKUP, SKIP_SEALED = range(2)
 
 
+def get_locality_score(paths):
+    '''1 for a set whose paths share a parent directory, 1/n for n parents.'''
+    return 1 / len({os.path.dirname(path) for path in paths})
+
+
+def get_set_fingerprint(snapshot_path, items, parts):
+    '''Hashes path, type, mode, owner, size and mtime of everything in a set.
+
+    Sets with the same fingerprint produce the same archive content, so upload_sets.py
+    can reference the archive uploaded by an earlier backup instead. Like tar in
+    build_archive.sh, entries named .NO_BACKUP and their content are left out.
+
+    This walks the directories of the set a second time after the crawl, at the cost
+    of one lstat per archived entry and one scandir per directory, so it is only done
+    with REUSE_UNCHANGED_SETS.
+    '''
+    hash_ = hashlib.sha256()
+
+    def add_entry(path, st):
+        rel_path = os.path.relpath(path, snapshot_path)
+        target = os.readlink(path) if stat.S_ISLNK(st.st_mode) else ''
+        hash_.update(f'{rel_path}\0{st.st_mode}\0{st.st_uid}\0{st.st_gid}\0'
+                     f'{st.st_size}\0{st.st_mtime_ns}\0{target}\n'.encode(
+                         errors='surrogateescape'))
+
+    # Depth-first without recursion, entries sorted by name
+    for item in sorted(items):
+        paths = [item]
+        while paths:
+            path = paths.pop()
+            st = os.lstat(path)
+            add_entry(path, st)
+            if stat.S_ISDIR(st.st_mode):
+                with os.scandir(path) as it:
+                    names = sorted(entry.name
+                                   for entry in it
+                                   if entry.name != NO_BACKUP_MARKER)
+                paths.extend(os.path.join(path, name) for name in reversed(names))
+    for path, offset, length, _ in parts:
+        hash_.update(f'part\0{offset}\0{length}\0'.encode())
+        add_entry(path, os.lstat(path))
+    return hash_.hexdigest()
+
+
 class SetWriter():
-    def __init__(self, snapshot_path, set_path, zfs_pool):
+    '''Writes the .list files of the sets and adds them to the set manifest.
+
+    With fingerprint, the info contains a fingerprint of the set's content.
+    '''
+    def __init__(self, snapshot_path, set_path, zfs_pool, fingerprint=False):
         self.snapshot_path = snapshot_path
         self.set_path = set_path
         self.zfs_pool = zfs_pool
+        self.fingerprint = fingerprint
 
     def _make_archive_name(self, items):
         if len(items) == 1:
@@ -54,329 +106,102 @@ class SetWriter():
         name = name.rstrip('_')
         return name
 
-    def write_set(self, set_index, num_sets, items, size, num_dirs, num_files):
+    def write_set(self, set_index, num_sets, items, size, num_dirs, num_files,
+                  predicted_size=None, parts=(), store_only=False):
+        '''parts are (path, offset, length, size) tuples of split files. Sets of
+        incompressible files are store_only, they are archived without compression.'''
+        part_paths = [part[0] for part in parts]
+        locality = get_locality_score(items + part_paths)
         print(f'Set {set_index+1}/{num_sets}: {len(items)} path(s), {size_to_string(size)}'
-              f', {num_dirs} dir(s), {num_files} file(s)')
-        archive_name = self._make_archive_name(items)
-
-        counter = 0
-        while True:
-            list_filename = os.path.join(self.set_path,
-                                         f'{archive_name}_{counter:03d}.list')
-            if not os.path.exists(list_filename):
-                break
-            counter += 1
-
-        print(f'  Archive name: {archive_name}_{counter:03d}')
-
-        num_files_printed = 0
-        with open(list_filename, 'wt') as list_file:
-            for item in items:
-                item = os.path.relpath(item, self.snapshot_path)
-                if num_files_printed < 10:
-                    print(f'  {item}')
-                    num_files_printed += 1
-                print(item, file=list_file)
-        if len(items) > num_files_printed:
-            print(f'  ... ({len(items)-num_files_printed} more)')
-
-        info_filename = make_set_info_filename(list_filename)
-        with open(info_filename, 'wt') as info_file:
-            info = {'size_bytes': size}
-            json.dump(info, info_file)
-
-
-class Path():
-    def __init__(self, name, parent):
-        self.parent = parent
-        self.name = name
-        self.files = set()
-        self.dirs = {}
-        self.size = None  # Lazily computed
-
-    def add_file(self, name, size):
-        if name in ('.', '..', ''):
-            raise BackupException(f'Invalid filename {name}')
-
-        if size > Path.UPLOAD_LIMIT:
-            raise BackupException('File size exceeds upload limit:'
-                                  f' {self.get_full_path()}/{name}'
-                                  f' (size={size_to_string(size)},'
-                                  f' upload_limit={size_to_string(Path.UPLOAD_LIMIT)})')
-        self.files.add((name, size))
-
-    def get_dir(self, name):
-        if name in ('.', '..', ''):
-            raise BackupException(f'Invalid dirname {name}')
-
-        return self.dirs.setdefault(name, Path(name, self))
-
-    @lru_cache
-    def get_snapshot_path(self):
-        node = self
-        while node.parent is not None:
-            node = node.parent
-        return node.name
-
-    def get_full_path(self):
-        if self.parent is None:
-            return self.name
-        return os.path.join(self.parent.get_full_path(), self.name)
-
-    def get_size(self):
-        if self.size is None:
-            size = 0
-            for file_ in self.files:
-                size += file_[1]
-            for dir_ in self.dirs.values():
-                size += dir_.get_size()
-            self.size = size
-        return self.size
-
-    def __str__(self):
-        out = ''
-        for dir_ in self.dirs.values():
-            out += str(dir_)
-        if len(self.files) > 0:
-            path = self.get_full_path()
-            out += '\n'.join(map(lambda file_: os.path.join(path, file_[0]),
-                                 self.files)) + '\n'
-        return out
-
-    def _is_inside_backup_paths(self, backup_paths, path):
-        snapshot_path = self.get_snapshot_path()
-        rel_path = os.path.relpath(path, snapshot_path)
-        for backup_path in backup_paths:
-            exact_match = backup_path == rel_path  # File or path
-            path_prefix_match = rel_path.startswith(os.path.join(backup_path, ''))
-            if exact_match or path_prefix_match:
-                return True
-        return False
-
-    def get_node(self, path):
-        if self.parent is None:
-            path = os.path.relpath(path, self.name)
-        node = self
-        if len(path) > 0 and path != '.':  # relpath returns '.' for top level dir
-            comps = path.split('/')
-            for comp in comps:
-                node = node.get_dir(comp)
-        return node
-
-    def get_num_dirs_files(self):
-        num_dirs = 1  # Including current dir
-        num_files = len(self.files)
-        for dir_node in self.dirs.values():
-            num_dirs_subdir, num_files_subdir = dir_node.get_num_dirs_files()
-            num_dirs += num_dirs_subdir
-            num_files += num_files_subdir
-        return num_dirs, num_files
-
-    def create_backup_sets(self, set_writer, backup_paths):
-        items = []
-
-        path = self.get_full_path()
-        size = self.get_size()
-
-        DIR, FILE = 0, 1
-        # When the path fits, we still cannot simply zip it up fully
-        # since only a subset of entries may be in the backup_paths.
-        if (size <= Path.UPLOAD_LIMIT
-                and self._is_inside_backup_paths(backup_paths, path)):
-            items.append((path, size, DIR))
-        else:
-            for file_, size in self.files:
-                file_path = os.path.join(path, file_)
-                if self._is_inside_backup_paths(backup_paths, file_path):
-                    items.append((file_path, size, FILE))
-            for dir_ in self.dirs.values():
-                if dir_.get_size() > Path.UPLOAD_LIMIT:
-                    dir_items = dir_.create_backup_sets(set_writer, backup_paths)
-                    items.extend(dir_items)
-                else:
-                    dir_path = os.path.join(path, dir_.name)
-                    if self._is_inside_backup_paths(backup_paths, dir_path):
-                        items.append((dir_path, dir_.get_size(), DIR))
-                    else:
-                        dir_items = dir_.create_backup_sets(set_writer, backup_paths)
-                        items.extend(dir_items)
-
-        if self.parent is not None:
-            return items
-
-        if len(items) > 0:
-            bins = binpacking.to_constant_volume(items, Path.UPLOAD_LIMIT, weight_pos=1)
-            for bin_index, bin_ in enumerate(bins):
-                paths = []
-                total_size = 0
-                num_dirs = 0
-                num_files = 0
-                for path, size, type_ in bin_:
-                    paths.append(path)
-                    total_size += size
-                    if type_ == DIR:
-                        node = self.get_node(path)
-                        num_dirs_subdir, num_files_subdir = node.get_num_dirs_files()
-                        num_dirs += num_dirs_subdir
-                        num_files += num_files_subdir
-                    else:
-                        num_files += 1
-                set_writer.write_set(bin_index, len(bins), paths, total_size, num_dirs,
-                                     num_files)
-
-        return None
-
-
-class DualCounter:
-    def __init__(self, title, name1, name2):
-        self.title = title
-        self.name1 = name1
-        self.name2 = name2
-        self.count1 = 0
-        self.count2 = 0
-
-    def add_counter1(self, count_):
-        self.count1 += count_
-
-    def add_counter2(self, count_):
-        self.count2 += count_
-
-    def get(self):
-        self.verify()
-        return self.count1
-
-    def verify(self):
-        if self.count1 != self.count2:
-            msg = (f'Mismatch: {self.title}: {self.name1}={self.count1}, '
-                   f'{self.name2}={self.count2}, '
-                   f'diff: {self.count1 - self.count2}')
-            raise BackupException(msg)
-
-    def __add__(self, rhs):
-        result = copy.deepcopy(self)
-        result.count1 += rhs.count1
-        result.count2 += rhs.count2
-        return result
-
-
-def update_find_counters(path, skipped_paths, sub_num_files, sub_size_files):
-    skipped_paths_str = ' '.join(f"-not -path '{skipped_path}*'"
-                                 for skipped_path in skipped_paths)
-    cmd = fr"find '{path}' \( -type f -o -type l \) {skipped_paths_str} | wc -l"
-    output = subprocess.check_output(cmd, shell=True).decode()
-    sub_num_files.add_counter2(int(output.strip()))
-    try:
-        sub_num_files.verify()
-    except BackupException:
-        print(f'Exception during verify, {cmd=}')
-        raise
-
-    cmd = (fr"find '{path}' \( -type f -o -type l \) {skipped_paths_str} -printf '%s\n'"
-           f" | awk '{{sum+=$1}} END {{print sum}}'")
-    output = subprocess.check_output(cmd, shell=True).decode()
-    output = output.strip()
-    if len(output) == 0:
-        size = 0
-    else:
-        size = int(output.strip())
-    sub_size_files.add_counter2(size)
-    try:
-        sub_size_files.verify()
-    except BackupException:
-        print(f'Exception during verify, {cmd=}')
-        raise
-
-
-def is_sealed(dir_):
-    if os.path.islink(os.path.join(dir_, GDAB_SEALED_MARKER)):
-        out = subprocess.check_output(['lsattr', '-d', dir_]).decode()
-        if 'i' not in out.split(' ', maxsplit=1)[0]:
-            print(f'WARNING: Directory {dir_} contains a sealed marker but is not'
-                  ' immutable!')
-        return True
-    return False
-
-
-def crawl(snapshot_path, backup_paths, seal_action):
-    root_node = Path(snapshot_path, None)
-
-    num_files = DualCounter('files', 'walk', 'find')
-    size_files = DualCounter('size', 'walk', 'find')
-
-    for path in backup_paths:
-        path = os.path.join(snapshot_path, path)
-        print(f'Crawling {path}')
-
-        sub_num_files = DualCounter('subfiles', 'walk', 'find')
-        sub_size_files = DualCounter('subsize', 'walk', 'find')
-        skipped_paths = set()
-
-        def process_file(node, file_path, file_):
-            info = os.lstat(file_path)  # Do not follow symlinks
-            sub_num_files.add_counter1(1)  # pylint: disable=cell-var-from-loop
-            file_size = info[stat.ST_SIZE]
-            sub_size_files.add_counter1(file_size)  # pylint: disable=cell-var-from-loop
-
-            node.add_file(file_, file_size)
-
-        if not os.path.isdir(path):
-            if seal_action.is_seal_after_backup():
-                raise BackupException('Sealing of files not supported, please move'
-                                      f' file {path} to an extra directory and adjust'
-                                      ' the backup config to point to it instead of the'
-                                      ' file')
-            node = root_node.get_node(os.path.dirname(path))
-            process_file(node, path, os.path.basename(path))
-        else:
-
-            def raise_error(error):
-                raise error
-
-            for root, dirs, files in os.walk(path, topdown=True, onerror=raise_error,
-                                             followlinks=False):
-                skip_msg = None
-                if seal_action.is_skip_sealed() and is_sealed(root):
-                    skip_msg = f'Directory {root} is sealed, skipping'
-                elif os.path.isfile(os.path.join(root, NO_BACKUP_MARKER)):
-                    skip_msg = f'Directory {root} is excluded from backup, skipping'
-                if skip_msg:
-                    print(skip_msg)
-                    dirs[:] = []
-                    skipped_paths.add(root)
-                    continue
-                node = root_node.get_node(root)
-                for file_ in files:
-                    process_file(node, os.path.join(root, file_), file_)
-                # os.walk returns symlinks to directories in dirs
-                for dir_ in dirs:
-                    dir_path = os.path.join(root, dir_)
-                    if os.path.islink(dir_path):
-                        process_file(node, dir_path, dir_)
-
-        update_find_counters(path, skipped_paths, sub_num_files, sub_size_files)
-
-        num_files += sub_num_files
-        size_files += sub_size_files
-
-        print(f'  {size_to_string(sub_size_files.get())}, {sub_num_files.get()} files')
-
-    num_files.verify()
-    size_files.verify()
-
-    return root_node
-
-
-def crawl_and_write(snapshot_path, backup_paths, seal_action, state_file):
-    root_node = crawl(snapshot_path, backup_paths, seal_action)
-    with open(state_file, 'wb') as f:
-        pickle.dump(root_node, f)
-
-
-def load(state_file, set_writer, backup_paths):
-    with open(state_file, 'rb') as f:
+              f', {num_dirs} dir(s), {num_files} file(s), locality {locality:.2f}')
+        if parts:
+            print(f'  {len(parts)} part(s) of split files')
+        if predicted_size is not None:
+            print(f'  Predicted compressed size: {size_to_string(predicted_size)}')
+        if store_only:
+            print('  Incompressible, stored without compression')
+        archive_name = self._make_archive_name(items + part_paths)
+
+        manifest = SetManifest(self.set_path)
+        try:
+            name, name_index = manifest.get_free_name(archive_name)
+            print(f'  Archive name: {name}')
+
+            list_filename = make_set_list_filename(self.set_path, name)
+            rel_items = [os.path.relpath(item, self.snapshot_path) for item in items]
+            for item in rel_items[:10]:
+                print(f'  {item}')
+            if len(rel_items) > 10:
+                print(f'  ... ({len(rel_items)-10} more)')
+            with open(list_filename, 'wt') as list_file:
+                list_file.writelines(f'{item}\n' for item in rel_items)
+
+            self._write_parts(list_filename, parts)
+
+            info = {'locality': locality}
+            if predicted_size is not None:
+                info['predicted_size_bytes'] = predicted_size
+            if store_only:
+                info['store_only'] = True
+            if self.fingerprint:
+                info['fingerprint'] = get_set_fingerprint(self.snapshot_path, items,
+                                                          parts)
+            manifest.add_set(name, archive_name, name_index, size, num_dirs, num_files,
+                             info)
+        finally:
+            manifest.close()
+
+    def _write_parts(self, list_filename, parts):
+        if not parts:
+            return
+        with open(make_set_parts_filename(list_filename), 'wt') as parts_file:
+            for path, offset, length, file_size in parts:
+                path = os.path.relpath(path, self.snapshot_path)
+                print(f'  {path}: part at offset {offset},'
+                      f' {size_to_string(length)} of {size_to_string(file_size)}')
+                json.dump({'path': path, 'offset': offset, 'length': length,
+                           'size': file_size}, parts_file)
+                parts_file.write('\n')
+
+
+def crawl_and_write(snapshot_path, backup_paths, seal_action, state_file, num_workers=1,
+                    verify_mode='full', state_backend='pickle', progress=None):
+    if state_backend == 'sqlite':
+        db = StateDb(state_file, create=True)
+        try:
+            root_node = DbPath.create_root(db, snapshot_path)
+            crawl(snapshot_path, backup_paths, seal_action, num_workers, verify_mode,
+                  root_node, progress)
+        finally:
+            db.close()
+        return
+
+    root_node = crawl(snapshot_path, backup_paths, seal_action, num_workers,
+                      verify_mode, progress=progress)
+    # The pickled names compress well, the fastest level is sufficient
+    with gzip.open(state_file, 'wb', compresslevel=1) as f:
+        pickle.dump(root_node, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load(state_file, set_writer, backup_paths, packing_strategy='binpacking',
+         estimator=None, classifier=None):
+    if is_state_db(state_file):
+        db = StateDb(state_file)
+        try:
+            root_node = DbPath.load_root(db)
+            print('Total size of backed up files:'
+                  f' {size_to_string(root_node.get_size())}')
+            root_node.create_backup_sets(set_writer, backup_paths, packing_strategy,
+                                         estimator, classifier)
+        finally:
+            db.close()
+        return
+
+    with gzip.open(state_file, 'rb') as f:
         root_node = pickle.load(f)
     print(f'Total size of backed up files: {size_to_string(root_node.get_size())}')
-    root_node.create_backup_sets(set_writer, backup_paths)
+    root_node.create_backup_sets(set_writer, backup_paths, packing_strategy, estimator,
+                                 classifier)
 
 
 if __name__ == '__main__':
@@ -386,6 +211,26 @@ if __name__ == '__main__':
     state_file = os.environ['STATE_FILE']
     set_path = os.path.normpath(os.environ['SET_PATH'])
     Path.UPLOAD_LIMIT = int(os.environ['UPLOAD_LIMIT_MB']) * 1024 * 1024
+    Path.SPLIT_LARGE_FILES = os.environ.get('SPLIT_LARGE_FILES') == '1'
+    num_crawl_workers = int(os.environ.get('CRAWL_WORKERS', 1))
+    crawl_verify_mode = os.environ.get('CRAWL_VERIFY', 'full').lower()
+    if crawl_verify_mode not in ('full', 'sample'):
+        raise BackupException(f'Invalid crawl verify mode {crawl_verify_mode}')
+    state_backend = os.environ.get('STATE_BACKEND', 'pickle').lower()
+    if state_backend not in ('pickle', 'sqlite'):
+        raise BackupException(f'Invalid state backend {state_backend}')
+    packing_strategy = os.environ.get('PACKING_STRATEGY', 'binpacking').lower()
+    if packing_strategy not in PACKING_STRATEGIES:
+        raise BackupException(f'Invalid packing strategy {packing_strategy}')
+    estimator = None
+    if os.environ.get('COMPRESSION_AWARE_SIZING') == '1':
+        estimator = CompressionEstimator(
+            float(os.environ.get('COMPRESSION_SAFETY_MARGIN', 1.25)))
+    classifier = None
+    if os.environ.get('SEPARATE_INCOMPRESSIBLE') == '1':
+        classifier = estimator or CompressionEstimator(1.0)
+    progress_interval = float(os.environ.get('CRAWL_PROGRESS_INTERVAL_SEC', 60))
+    crawl_stats_file = os.environ.get('CRAWL_STATS_FILE')
     seal_action = SealAction()
 
     backup_paths = glob_backup_paths_and_check(backup_paths_unglobbed, snapshot_path)
@@ -420,6 +265,10 @@ if __name__ == '__main__':
                 cp.check_returncode()
 
     # Save state after crawling file system, so can be resumed later
-    crawl_and_write(snapshot_path, backup_paths, seal_action, state_file)
-    set_writer = SetWriter(snapshot_path, set_path, zfs_pool)
-    load(state_file, set_writer, backup_paths)
+    with CrawlProgress(snapshot_path, progress_interval, os.environ.get('SNAPSHOT'),
+                       crawl_stats_file) as progress:
+        crawl_and_write(snapshot_path, backup_paths, seal_action, state_file,
+                        num_crawl_workers, crawl_verify_mode, state_backend, progress)
+    set_writer = SetWriter(snapshot_path, set_path, zfs_pool,
+                           os.environ.get('REUSE_UNCHANGED_SETS') == '1')
+    load(state_file, set_writer, backup_paths, packing_strategy, estimator, classifier)
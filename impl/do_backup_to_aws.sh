@@ -41,14 +41,19 @@ fi
 SNAPSHOT=$ZFS_POOL@snapshot-aws-$TIMESTAMP
 SET_PATH=state/sets
 STATE_FILE=state/fs.state
+SET_INDEX_FILE=state/set_index.json
+UPLOAD_STATE_PATH=state/uploads
+CRAWL_STATS_FILE=logs/crawl_stats.jsonl
 
 BUFFER_PATH="$BUFFER_PATH_BASE/backup_aws_buffer"
-rm -rf "$BUFFER_PATH"
+# On resume, the buffer holds archives whose upload is continued
+if [[ "$MODE" != resume ]]; then
+    rm -rf "$BUFFER_PATH"
+fi
 mkdir -p "$BUFFER_PATH"
 
 function cleanup()
 {
-    rm -rf "$BUFFER_PATH"
     sudo umount "$SNAPSHOT_PATH" || true
     if [[ -f "$RESUME_FILE" ]]; then
         echo
@@ -57,6 +62,7 @@ function cleanup()
             "and run './backup_resume' to retry. If you do not want to" \
             "resume, please destroy the snapshot manually."
     else
+        rm -rf "$BUFFER_PATH"
         echo "Destroying snapshot $SNAPSHOT"
         sudo zfs destroy "$SNAPSHOT"
     fi
@@ -66,6 +72,7 @@ if [[ "$MODE" == scratch ]] || [[ "$MODE" == duplicity_full ]] || [[ "$MODE" ==
     rm -f "$RESUME_FILE"
     rm -f "$SET_PATH"/*
     mkdir -p "$SET_PATH"
+    rm -rf "$UPLOAD_STATE_PATH"
     rm -f "$STATE_FILE"
 
     sudo zfs snapshot "$SNAPSHOT"
@@ -84,14 +91,20 @@ elif [[ "$MODE" == duplicity_incremental ]]; then
 
     impl/duplicity_backup.py incremental "${BACKUP_PATHS[@]}"
 else
-    export SET_PATH SETTINGS SNAPSHOT_PATH STATE_FILE UPLOAD_LIMIT_MB SEAL_ACTION ZFS_POOL
+    export COMPRESSION_AWARE_SIZING COMPRESSION_SAFETY_MARGIN CRAWL_PROGRESS_INTERVAL_SEC \
+        CRAWL_STATS_FILE CRAWL_VERIFY CRAWL_WORKERS PACKING_STRATEGY REUSE_UNCHANGED_SETS \
+        SEPARATE_INCOMPRESSIBLE SET_PATH SETTINGS SNAPSHOT SNAPSHOT_PATH SPLIT_LARGE_FILES \
+        STATE_BACKEND STATE_FILE UPLOAD_LIMIT_MB SEAL_ACTION ZFS_POOL
 
     if [[ "$MODE" == scratch ]]; then
         impl/create_sets.py "${BACKUP_PATHS[@]}"
         echo -e "SETTINGS=\"$SETTINGS\"\\nTIMESTAMP=\"$TIMESTAMP\"" >"$RESUME_FILE"
     fi
 
-    export BUCKET_DIR BUFFER_PATH S3_BUCKET TIMESTAMP
+    export ADAPTIVE_COMPRESSION ARCHIVE_COMPRESSION_LEVEL ARCHIVE_COMPRESSION_THREADS \
+        ARCHIVE_COMPRESSOR ARCHIVE_ENCRYPTION BUCKET_DIR BUFFER_PATH NUM_ARCHIVE_BUILDERS \
+        NUM_UPLOADERS S3_BUCKET S3_MAX_CONCURRENCY S3_MULTIPART_CHUNK_MB SET_INDEX_FILE \
+        STREAMING_UPLOAD TIMESTAMP UPLOAD_STATE_PATH
     impl/upload_sets.py
     rm "$RESUME_FILE"
 fi
@@ -7,54 +7,70 @@ import time
 from queue import Queue
 from threading import Thread
 
+from impl.archive_codec import get_codec_manifest_name
+from impl.s3_client import S3_ERRORS, get_error_code, get_s3_client
 from impl.tools import BackupException
 
 # Number of days the object stays available for download after restore.
 # If there is lots of data to download, the default may have to be increased.
 RESTORATION_PERIOD_DAYS = 3
+# Restores take hours, no need to check them more often
+RESTORE_POLL_INTERVAL_SEC = 60
 
 
 def get_files(s3_bucket, bucket_dir, timestamp):
     prefix = f'{bucket_dir.strip("/")}/{timestamp.strip("/")}'
-    cmd = ('aws', 's3api', 'list-objects-v2', '--bucket', s3_bucket, '--prefix', prefix,
-           '--query', "Contents[?StorageClass=='DEEP_ARCHIVE'].[Key, Size]",
-           '--no-paginate', '--output', 'json')
-    cp = subprocess.run(cmd, capture_output=True, check=True)
-    cp.check_returncode()
-    file_list = json.loads(cp.stdout.decode())
+    file_list = [[object_['Key'], object_['Size']]
+                 for object_ in get_s3_client(s3_bucket).list_objects(prefix)
+                 if object_.get('StorageClass') == 'DEEP_ARCHIVE']
 
     return file_list
 
 
+def get_referenced_files(s3_bucket, bucket_dir, timestamp):
+    '''Returns the archive keys of earlier backups referenced by unchanged sets.'''
+    prefix = '/'.join(dir_ for dir_ in (bucket_dir.strip('/'), timestamp.strip('/'))
+                      if dir_)
+    content = get_s3_client(s3_bucket).get_object(f'{prefix}/references.json')
+    if content is None:
+        return []
+    references = json.loads(content.decode())
+    return sorted(set(references.values()))
+
+
 def request_restore(s3_bucket, file_, days, restore_tier, files_to_restore):
-    restore_request = """{ "Days": %d, "GlacierJobParameters": { "Tier": "%s" } }""" \
-                      % (days, restore_tier) # pylint: disable=consider-using-f-string
     print(f"Requesting restore for '{file_}', tier '{restore_tier}'")
-    cmd = ('aws', 's3api', 'restore-object', '--bucket', s3_bucket, '--key', file_,
-           '--restore-request', restore_request)
     try:
-        subprocess.run(cmd, capture_output=True, check=True)
-    except subprocess.CalledProcessError as e:
-        if not 'RestoreAlreadyInProgress' in e.stderr.decode():
+        get_s3_client(s3_bucket).restore_object(file_, days, restore_tier)
+    except S3_ERRORS as e:
+        if get_error_code(e) != 'RestoreAlreadyInProgress':
             raise
     files_to_restore.append(file_)
 
 
 # Thread 1
 def wait_for_restore(s3_bucket, files_to_restore):
+    s3_client = get_s3_client(s3_bucket)
     while len(files_to_restore) > 0:
         restored_files = []
         for file_ in files_to_restore:
-            cmd = ('aws', 's3api', 'head-object', '--bucket', s3_bucket, '--key', file_)
-            cp = subprocess.run(cmd, capture_output=True, check=True)
-            cp.check_returncode()
-            status = json.loads(cp.stdout.decode())
-            restore_status = status['Restore']
+            restore_status = s3_client.head_object(file_)['Restore']
             if 'ongoing-request="false"' in restore_status:
                 restored_files.append(file_)
         for restored_file in restored_files:
             files_to_restore.remove(restored_file)
             download_queue.put(restored_file)
+        if len(files_to_restore) > 0:
+            time.sleep(RESTORE_POLL_INTERVAL_SEC)
+
+
+def download_codec_manifest(s3_bucket, archive_key, archive_local_path):
+    '''Downloads the codec manifest next to the archive, where extract_archive looks
+    for it. Archives of earlier versions have none, their codec is told by name.'''
+    content = get_s3_client(s3_bucket).get_object(get_codec_manifest_name(archive_key))
+    if content is not None:
+        with open(get_codec_manifest_name(archive_local_path), 'wb') as f:
+            f.write(content)
 
 
 download_in_progress = False
@@ -67,22 +83,21 @@ def download_and_extract(s3_bucket, num_total_files, buffer_path, extract_path):
     while not download_queue.empty() or len(files_to_restore) > 0:
         archive_path = download_queue.get()
         download_in_progress = True
-        bucket_path = f's3://{s3_bucket}/{archive_path}'
-        cmd = ('aws', 's3', 'cp', bucket_path, buffer_path)
+        archive_name = os.path.basename(archive_path)
+        archive_local_path = os.path.join(buffer_path, archive_name)
         download_success = False
         for i in range(3):
             print(f'{num_processed_files+1}/{num_total_files}:'
                   f' Downloading {archive_path}, attempt {i+1}')
             try:
-                subprocess.run(cmd, check=True)
+                get_s3_client(s3_bucket).download_file(archive_path, archive_local_path)
+                download_codec_manifest(s3_bucket, archive_path, archive_local_path)
                 download_success = True
                 break
-            except subprocess.CalledProcessError as e:
+            except S3_ERRORS as e:
                 print(f'Error during download: {e}')
         if not download_success:
             raise BackupException('Download failed, see above. Exiting.')
-        archive_name = os.path.basename(archive_path)
-        archive_local_path = os.path.join(buffer_path, archive_name)
         cmd = ('./extract_archive', archive_local_path, extract_path)
         subprocess.run(cmd, check=True)
         download_in_progress = False
@@ -101,8 +116,12 @@ os.makedirs(extract_path, exist_ok=True)
 files_to_restore = []
 download_queue = Queue()
 
-files = get_files(s3_bucket, bucket_dir, timestamp)
-if files is None:
+files = get_files(s3_bucket, bucket_dir, timestamp) or []
+referenced_files = get_referenced_files(s3_bucket, bucket_dir, timestamp)
+if referenced_files:
+    print(f'Found {len(referenced_files)} archive(s) of earlier backups referenced')
+    files.extend([key, None] for key in referenced_files)
+if len(files) == 0:
     raise BackupException('No files found in bucket. Please check whether the path'
                           ' specified as TIMESTAMP in your restore config exists in'
                           ' your bucket (it may contain slashes as well for'
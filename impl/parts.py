@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Parts of files larger than the upload limit, which are spread over several sets.
+
+  parts.py tar SNAPSHOT_PATH PARTS_FILE
+    Ran by build_archive.sh, writes a tar stream with the parts listed in PARTS_FILE
+    to stdout. It is appended to the archive after the regular files.
+
+  parts.py join PARTS_PATH DEST_PATH
+    Ran by extract_archive, writes the parts extracted to PARTS_PATH into their files
+    below DEST_PATH and deletes them. Parts can be joined in any order, as their
+    archives arrive.
+
+Parts are stored as PARTS_DIR/<path>/<offset>-<length>-<size> with the mode and the
+modification time of the file. The parts file lists them as JSON lines.
+
+Standalone, so it runs without the rest of the backup on restore.
+'''
+
+import json
+import os
+import shutil
+import stat
+import sys
+import tarfile
+
+PARTS_DIR = '.gdab_parts'
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def make_part_name(path, offset, length, size):
+    return f'{PARTS_DIR}/{path}/{offset:020d}-{length}-{size}'
+
+
+def parse_part_name(name):
+    '''Returns (offset, length, size).'''
+    offset, length, size = name.split('-')
+    return int(offset), int(length), int(size)
+
+
+def write_parts_tar(snapshot_path, parts_filename, out):
+    with open(parts_filename, 'rt') as parts_file, \
+            tarfile.open(fileobj=out, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+        for line in parts_file:
+            part = json.loads(line)
+            file_path = os.path.join(snapshot_path, part['path'])
+            with open(file_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_size != part['size']:
+                    raise RuntimeError(f'Size of {file_path} changed from'
+                                       f' {part["size"]} to {st.st_size}')
+                info = tarfile.TarInfo(
+                    make_part_name(part['path'], part['offset'], part['length'],
+                                   part['size']))
+                info.size = part['length']
+                info.mode = stat.S_IMODE(st.st_mode)
+                info.mtime = st.st_mtime
+                info.uid = st.st_uid
+                info.gid = st.st_gid
+                f.seek(part['offset'])
+                # Streams the part, tarfile copies exactly info.size bytes
+                tar.addfile(info, f)
+
+
+def join_part(part_path, file_path):
+    offset, length, size = parse_part_name(os.path.basename(part_path))
+    st = os.stat(part_path)
+    if st.st_size != length:
+        raise RuntimeError(f'Part {part_path} is truncated')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    if os.path.exists(file_path):
+        # Parts joined before have set the mode of the file already
+        os.chmod(file_path, stat.S_IMODE(os.stat(file_path).st_mode) | stat.S_IWUSR)
+    # Not truncated on open, other archives may be joining their parts concurrently
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o600)
+    with open(fd, 'wb') as f, open(part_path, 'rb') as part_file:
+        # Missing parts stay holes until their archive is extracted
+        if os.fstat(fd).st_size < size:
+            f.truncate(size)
+        f.seek(offset)
+        shutil.copyfileobj(part_file, f, COPY_BUFFER_SIZE)
+    if os.geteuid() == 0:
+        os.chown(file_path, st.st_uid, st.st_gid)
+    os.chmod(file_path, stat.S_IMODE(st.st_mode))
+    os.utime(file_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.unlink(part_path)
+
+
+def join_parts(parts_path, dest_path):
+    '''Joins the parts below parts_path into the files below dest_path.'''
+    if not os.path.isdir(parts_path):
+        return
+    for dir_path, _, files in os.walk(parts_path, topdown=False):
+        rel_path = os.path.relpath(dir_path, parts_path)
+        for name in sorted(files):
+            join_part(os.path.join(dir_path, name), os.path.join(dest_path, rel_path))
+        os.rmdir(dir_path)
+    try:
+        os.rmdir(os.path.dirname(parts_path))
+    except OSError:
+        pass  # Still used by another extraction
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'tar':
+        write_parts_tar(sys.argv[2], sys.argv[3], sys.stdout.buffer)
+    elif len(sys.argv) == 4 and sys.argv[1] == 'join':
+        join_parts(sys.argv[2], sys.argv[3])
+    else:
+        print('Usage: parts.py tar SNAPSHOT_PATH PARTS_FILE'
+              ' | parts.py join PARTS_PATH DEST_PATH')
+        sys.exit(1)
@@ -0,0 +1,254 @@
+'''
+S3 access of upload and restore, in-process instead of running the AWS CLI per call.
+
+There is one client per bucket, shared by all threads. Its connection pool keeps
+credentials and TLS sessions across requests. Transfers are split into
+S3_MULTIPART_CHUNK_MB chunks, S3_MAX_CONCURRENCY of them are sent in parallel per
+transfer. boto3 honors AWS_ENDPOINT_URL, which points it to a local S3-compatible
+server.
+
+Resumable uploads keep their upload ID and the ETags of the confirmed parts in a state
+file, so a failed upload continues with the missing parts, also after a restart.
+'''
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.exceptions import Boto3Error
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+from impl.tools import write_json_atomic
+
+# Raised by S3Client methods on failure
+S3_ERRORS = (BotoCoreError, ClientError, Boto3Error)
+
+DEFAULT_CHUNK_SIZE_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 10
+MAX_NUM_PARTS = 10000
+
+
+def get_error_code(e):
+    '''Returns the S3 error code of an exception, like NoSuchKey, or None.'''
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def get_extra_args(storage_class):
+    return {} if storage_class is None else {'StorageClass': storage_class}
+
+
+class S3Client:
+    def __init__(self, s3_bucket, chunk_size_bytes=DEFAULT_CHUNK_SIZE_BYTES,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.s3_bucket = s3_bucket
+        self.chunk_size_bytes = chunk_size_bytes
+        self.max_concurrency = max_concurrency
+        # Room for several transfers running concurrently
+        config = Config(max_pool_connections=4 * max_concurrency,
+                        retries={'mode': 'standard'})
+        self.client = boto3.session.Session().client('s3', config=config)
+
+    def _get_transfer_config(self, size_bytes=0):
+        # Larger chunks for objects which would exceed the part limit of S3
+        chunk_size_bytes = max(self.chunk_size_bytes, -(-size_bytes // MAX_NUM_PARTS))
+        return TransferConfig(multipart_threshold=chunk_size_bytes,
+                              multipart_chunksize=chunk_size_bytes,
+                              max_concurrency=self.max_concurrency)
+
+    def is_reachable(self):
+        '''False only if S3 cannot be connected, other errors are left to the
+        actual requests.'''
+        try:
+            self.client.head_bucket(Bucket=self.s3_bucket)
+        except BotoConnectionError:
+            return False
+        except S3_ERRORS:
+            pass
+        return True
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.s3_bucket, Key=key)
+        except ClientError:
+            return False
+        return True
+
+    def head_object(self, key):
+        return self.client.head_object(Bucket=self.s3_bucket, Key=key)
+
+    def upload_file(self, file_, key, storage_class=None):
+        extra_args = get_extra_args(storage_class)
+        self.client.upload_file(
+            file_, self.s3_bucket, key, ExtraArgs=extra_args,
+            Config=self._get_transfer_config(os.path.getsize(file_)))
+
+    def upload_stream(self, stream, key, expected_size_bytes, storage_class=None):
+        '''Uploads a readable stream of unknown length.
+
+        It is read in chunks, up to 10 are held in memory until uploaded.
+        expected_size_bytes must not be too low, as the chunk size is chosen from it.
+        '''
+        extra_args = get_extra_args(storage_class)
+        self.client.upload_fileobj(
+            stream, self.s3_bucket, key, ExtraArgs=extra_args,
+            Config=self._get_transfer_config(expected_size_bytes))
+
+    def upload_file_resumable(self, file_, key, state_file, storage_class=None):
+        '''Multipart upload, continuing the one recorded in state_file if any.
+
+        state_file is removed once the upload is complete. Parts confirmed by S3 are
+        not uploaded again, if the file still has the same size.
+        '''
+        size_bytes = os.path.getsize(file_)
+        chunk_size_bytes = self._get_transfer_config(size_bytes).multipart_chunksize
+        num_parts = max(1, -(-size_bytes // chunk_size_bytes))
+        state = self._load_upload_state(state_file, key, size_bytes, chunk_size_bytes)
+        if state is None:
+            extra_args = get_extra_args(storage_class)
+            response = self.client.create_multipart_upload(Bucket=self.s3_bucket,
+                                                           Key=key, **extra_args)
+            state = {'key': key, 'upload_id': response['UploadId'],
+                     'size_bytes': size_bytes, 'chunk_size_bytes': chunk_size_bytes,
+                     'parts': {}}
+            write_json_atomic(state_file, state)
+        elif state['parts']:
+            print(f"Resuming upload of {key}, {len(state['parts'])}/{num_parts} parts"
+                  ' confirmed')
+
+        lock = threading.Lock()
+
+        def upload_part(part_number):
+            with open(file_, 'rb') as f:
+                f.seek((part_number - 1) * chunk_size_bytes)
+                data = f.read(chunk_size_bytes)
+            response = self.client.upload_part(Bucket=self.s3_bucket, Key=key,
+                                               UploadId=state['upload_id'],
+                                               PartNumber=part_number, Body=data)
+            with lock:
+                state['parts'][str(part_number)] = response['ETag']
+                write_json_atomic(state_file, state)
+
+        missing_part_numbers = [number for number in range(1, num_parts + 1)
+                                if str(number) not in state['parts']]
+        # Reads the chunks only when uploading them, so at most max_concurrency are
+        # held in memory
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            list(executor.map(upload_part, missing_part_numbers))
+
+        parts = [{'PartNumber': part_number, 'ETag': state['parts'][str(part_number)]}
+                 for part_number in sorted(map(int, state['parts']))]
+        self.client.complete_multipart_upload(Bucket=self.s3_bucket, Key=key,
+                                              UploadId=state['upload_id'],
+                                              MultipartUpload={'Parts': parts})
+        os.unlink(state_file)
+
+    def _load_upload_state(self, state_file, key, size_bytes, chunk_size_bytes):
+        '''Returns the state of the upload to continue, with the parts confirmed by S3,
+        or None to start a new upload.'''
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file, 'rt') as f:
+            state = json.load(f)
+        if (state['key'] != key or state['size_bytes'] != size_bytes
+                or state['chunk_size_bytes'] != chunk_size_bytes):
+            print(f'Not resuming upload of {key}, file or chunk size changed')
+            self._abort_upload(state)
+            return None
+        try:
+            paginator = self.client.get_paginator('list_parts')
+            confirmed = {}
+            for page in paginator.paginate(Bucket=self.s3_bucket, Key=key,
+                                           UploadId=state['upload_id']):
+                confirmed.update((str(part['PartNumber']), part['ETag'])
+                                 for part in page.get('Parts', ()))
+        except ClientError as e:
+            if get_error_code(e) != 'NoSuchUpload':
+                raise
+            print(f'Not resuming upload of {key}, it does not exist anymore')
+            return None
+        state['parts'] = {part_number: etag
+                          for part_number, etag in state['parts'].items()
+                          if confirmed.get(part_number) == etag}
+        return state
+
+    def _abort_upload(self, state):
+        try:
+            self.abort_multipart_upload(state['key'], state['upload_id'])
+        except ClientError as e:
+            if get_error_code(e) != 'NoSuchUpload':
+                raise
+
+    def download_file(self, key, file_):
+        self.client.download_file(self.s3_bucket, key, file_,
+                                  Config=self._get_transfer_config())
+
+    def get_object(self, key):
+        '''Returns the content of a small object, None if it does not exist.'''
+        try:
+            response = self.client.get_object(Bucket=self.s3_bucket, Key=key)
+        except ClientError as e:
+            if get_error_code(e) in ('NoSuchKey', '404'):
+                return None
+            raise
+        with response['Body'] as body:
+            return body.read()
+
+    def list_objects(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix):
+            yield from page.get('Contents', ())
+
+    def restore_object(self, key, days, tier):
+        self.client.restore_object(
+            Bucket=self.s3_bucket, Key=key,
+            RestoreRequest={'Days': days, 'GlacierJobParameters': {'Tier': tier}})
+
+    def list_multipart_uploads(self):
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.s3_bucket):
+            yield from page.get('Uploads', ())
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.s3_bucket, Key=key,
+                                           UploadId=upload_id)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_s3_client(s3_bucket):
+    '''Returns the shared client of s3_bucket.'''
+    with _clients_lock:
+        if s3_bucket not in _clients:
+            chunk_size_mb = int(os.environ.get('S3_MULTIPART_CHUNK_MB', 0))
+            chunk_size_bytes = chunk_size_mb * 1024**2 or DEFAULT_CHUNK_SIZE_BYTES
+            max_concurrency = (int(os.environ.get('S3_MAX_CONCURRENCY', 0))
+                               or DEFAULT_MAX_CONCURRENCY)
+            _clients[s3_bucket] = S3Client(s3_bucket, chunk_size_bytes, max_concurrency)
+        return _clients[s3_bucket]
+
+
+def get_resumable_upload_ids(upload_state_path):
+    upload_ids = set()
+    for name in os.listdir(upload_state_path):
+        if name.endswith('.json'):
+            with open(os.path.join(upload_state_path, name), 'rt') as f:
+                upload_ids.add(json.load(f)['upload_id'])
+    return upload_ids
+
+
+def clean_multipart_uploads(s3_bucket, keep_upload_ids=()):
+    '''Aborts the multipart uploads except keep_upload_ids, which are resumed later.'''
+    s3_client = get_s3_client(s3_bucket)
+    for upload in list(s3_client.list_multipart_uploads()):
+        if upload['UploadId'] in keep_upload_ids:
+            print(f"Keeping multipart {upload['Key']} for resume")
+            continue
+        print(f"Cleaning remaining multipart {upload['Key']}")
+        s3_client.abort_multipart_upload(upload['Key'], upload['UploadId'])
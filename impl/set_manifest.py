@@ -0,0 +1,93 @@
+'''
+Manifest of the sets in SET_PATH, written by create_sets.py, used by upload_sets.py.
+
+A single SQLite database holds name, size, dir/file counts and upload status of all
+sets. Names are allocated from it and status updates are single transactions, so
+resuming and progress accounting do not need to scan SET_PATH. The files of a set are
+listed in <name>.list (and <name>.parts for parts of split files).
+'''
+
+import json
+import os
+import sqlite3
+
+MANIFEST_FILENAME = 'sets.db'
+SET_PENDING, SET_UPLOADED, SET_REFERENCED = range(3)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sets (
+    name TEXT PRIMARY KEY,
+    base_name TEXT NOT NULL,
+    name_index INTEGER NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    num_dirs INTEGER NOT NULL,
+    num_files INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    reference TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS sets_base_name ON sets (base_name, name_index);
+CREATE INDEX IF NOT EXISTS sets_status ON sets (status);
+'''
+
+
+class SetManifest:
+    '''Can be used from several threads, if they serialize their calls.'''
+    def __init__(self, set_path):
+        self.connection = sqlite3.connect(os.path.join(set_path, MANIFEST_FILENAME),
+                                          check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get_free_name(self, base_name):
+        '''Returns (name, name_index) of the next set named after base_name.'''
+        row = self.connection.execute(
+            'SELECT MAX(name_index) FROM sets WHERE base_name = ?',
+            (base_name,)).fetchone()
+        name_index = 0 if row[0] is None else row[0] + 1
+        return f'{base_name}_{name_index:03d}', name_index
+
+    def add_set(self, name, base_name, name_index, size_bytes, num_dirs, num_files,
+                info):
+        '''info is a dict of further properties, stored as JSON.'''
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO sets (name, base_name, name_index, size_bytes, num_dirs,'
+                ' num_files, info) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (name, base_name, name_index, size_bytes, num_dirs, num_files,
+                 json.dumps(info)))
+
+    def get_info(self, name):
+        '''Returns the info dict of a set, including size_bytes, num_dirs and
+        num_files.'''
+        size_bytes, num_dirs, num_files, info = self.connection.execute(
+            'SELECT size_bytes, num_dirs, num_files, info FROM sets WHERE name = ?',
+            (name,)).fetchone()
+        info = json.loads(info)
+        info.update(size_bytes=size_bytes, num_dirs=num_dirs, num_files=num_files)
+        return info
+
+    def get_pending(self):
+        '''Returns the names of the sets not uploaded yet.'''
+        return [row[0] for row in self.connection.execute(
+            'SELECT name FROM sets WHERE status = ? ORDER BY name', (SET_PENDING,))]
+
+    def get_pending_size(self):
+        row = self.connection.execute(
+            'SELECT SUM(size_bytes) FROM sets WHERE status = ?',
+            (SET_PENDING,)).fetchone()
+        return row[0] or 0
+
+    def set_status(self, name, status, reference=None):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE sets SET status = ?, reference = ? WHERE name = ?',
+                (status, reference, name))
+
+    def get_references(self):
+        '''Returns the archive keys referenced by unchanged sets, by set name.'''
+        return dict(self.connection.execute(
+            'SELECT name, reference FROM sets WHERE status = ? ORDER BY name',
+            (SET_REFERENCED,)))
@@ -0,0 +1,155 @@
+'''
+On-disk storage of the crawled file system, used by create_sets.py.
+
+The crawl streams directories and files into an SQLite database instead of building
+the whole tree in memory. Set creation then queries it one directory at a time, so
+pools whose metadata does not fit into RAM can be backed up.
+
+Names and paths are stored as BLOB of their file system bytes, since they need not be
+valid UTF-8. The crawl passes them as str with surrogate escapes, as os does.
+'''
+
+import os
+import sqlite3
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+SCHEMA = '''
+CREATE TABLE dirs (
+    id INTEGER PRIMARY KEY,
+    parent_id INTEGER,
+    name BLOB NOT NULL,
+    tree_size INTEGER NOT NULL DEFAULT 0,
+    tree_dirs INTEGER NOT NULL DEFAULT 1,
+    tree_files INTEGER NOT NULL DEFAULT 0,
+    predicted_size INTEGER,
+    incompressible_size INTEGER
+);
+CREATE UNIQUE INDEX dirs_parent_name ON dirs (parent_id, name);
+CREATE TABLE files (
+    dir_id INTEGER NOT NULL,
+    name BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (dir_id, name)
+) WITHOUT ROWID;
+CREATE TABLE links (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    path BLOB NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX links_inode ON links (dev, ino);
+'''
+
+
+def decode_dir_row(row):
+    dir_id, name, *stats = row
+    return dir_id, os.fsdecode(name), *stats
+
+
+def is_state_db(state_file):
+    with open(state_file, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+class StateDb:
+    def __init__(self, state_file, create=False):
+        if create and os.path.exists(state_file):
+            os.unlink(state_file)
+        self.connection = sqlite3.connect(state_file)
+        # The state can always be recreated by crawling again, so durability is not
+        # needed
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        if create:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get_root(self):
+        row = self.connection.execute('SELECT id, name, tree_size, tree_dirs, tree_files'
+                                      ' FROM dirs WHERE parent_id IS NULL').fetchone()
+        return decode_dir_row(row)
+
+    def add_root(self, name):
+        cursor = self.connection.execute(
+            'INSERT INTO dirs (parent_id, name) VALUES (NULL, ?)', (os.fsencode(name),))
+        return cursor.lastrowid
+
+    def get_or_add_dir(self, parent_id, name):
+        '''Returns (id, created).'''
+        name = os.fsencode(name)
+        row = self.connection.execute(
+            'SELECT id FROM dirs WHERE parent_id = ? AND name = ?',
+            (parent_id, name)).fetchone()
+        if row is not None:
+            return row[0], False
+        cursor = self.connection.execute(
+            'INSERT INTO dirs (parent_id, name) VALUES (?, ?)', (parent_id, name))
+        return cursor.lastrowid, True
+
+    def get_tree_stats(self, dir_id):
+        return self.connection.execute(
+            'SELECT tree_size, tree_dirs, tree_files FROM dirs WHERE id = ?',
+            (dir_id,)).fetchone()
+
+    def set_estimated_sizes(self, dir_id, predicted_size, incompressible_size):
+        self.connection.execute(
+            'UPDATE dirs SET predicted_size = ?, incompressible_size = ? WHERE id = ?',
+            (predicted_size, incompressible_size, dir_id))
+
+    def get_estimated_sizes(self, dir_id):
+        return self.connection.execute(
+            'SELECT predicted_size, incompressible_size FROM dirs WHERE id = ?',
+            (dir_id,)).fetchone()
+
+    def add_to_tree_stats(self, dir_ids, size, num_dirs, num_files):
+        placeholders = ', '.join('?' * len(dir_ids))
+        self.connection.execute(
+            'UPDATE dirs SET tree_size = tree_size + ?, tree_dirs = tree_dirs + ?,'
+            f' tree_files = tree_files + ? WHERE id IN ({placeholders})',
+            (size, num_dirs, num_files, *dir_ids))
+
+    def remove_dir(self, dir_id):
+        # Only called for directories skipped during crawl, which have no entries
+        self.connection.execute('DELETE FROM dirs WHERE id = ?', (dir_id,))
+
+    def get_dirs(self, parent_id):
+        cursor = self.connection.execute(
+            'SELECT id, name, tree_size, tree_dirs, tree_files FROM dirs'
+            ' WHERE parent_id = ? ORDER BY id', (parent_id,))
+        return map(decode_dir_row, cursor)
+
+    def add_files(self, dir_id, files):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO files (dir_id, name, size) VALUES (?, ?, ?)',
+            ((dir_id, os.fsencode(name), size) for name, size in files))
+
+    def get_files(self, dir_id):
+        cursor = self.connection.execute('SELECT name, size FROM files WHERE dir_id = ?',
+                                         (dir_id,))
+        return ((os.fsdecode(name), size) for name, size in cursor)
+
+    def get_files_stats(self, dir_id):
+        num_files, size = self.connection.execute(
+            'SELECT COUNT(*), SUM(size) FROM files WHERE dir_id = ?',
+            (dir_id,)).fetchone()
+        return num_files, size or 0
+
+    def get_link_owner(self, dev, ino):
+        # The smallest as str, as in RootPath. Escaped bytes sort differently as BLOB.
+        cursor = self.connection.execute(
+            'SELECT path FROM links WHERE dev = ? AND ino = ?', (dev, ino))
+        return min((os.fsdecode(row[0]) for row in cursor), default=None)
+
+    def add_link(self, dev, ino, path, size):
+        self.connection.execute(
+            'INSERT INTO links (dev, ino, path, size) VALUES (?, ?, ?, ?)',
+            (dev, ino, os.fsencode(path), size))
+
+    def get_links(self):
+        cursor = self.connection.execute(
+            'SELECT dev, ino, path, size FROM links ORDER BY dev, ino')
+        return ((dev, ino, os.fsdecode(path), size) for dev, ino, path, size in cursor)
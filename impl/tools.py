@@ -1,7 +1,7 @@
+import fnmatch
 import json
 import os
-import pathlib
-import subprocess
+import re
 import sys
 
 NO_BACKUP_MARKER = '.NO_BACKUP'
@@ -47,17 +47,154 @@ def size_to_string(size):
     return size_to_string_factor(size, factor, unit)
 
 
+RECURSIVE_GLOB = '**'
+
+
+def split_glob_pattern(pattern):
+    '''Splits a pattern into literal names, RECURSIVE_GLOB and compiled matchers.'''
+    if os.path.isabs(pattern):
+        raise BackupException(f'Backup path {pattern} must be relative')
+    comps = []
+    for comp in pattern.split('/'):
+        if comp in ('', '.'):
+            continue
+        if comp == RECURSIVE_GLOB:
+            comps.append(RECURSIVE_GLOB)
+        elif '*' in comp or '?' in comp or '[' in comp:
+            comps.append(re.compile(fnmatch.translate(comp)).fullmatch)
+        else:
+            comps.append(comp)
+    if len(comps) == 0:
+        raise BackupException(f'Invalid backup path {pattern}')
+    return comps
+
+
+def _list_dir(dir_path):
+    try:
+        with os.scandir(dir_path) as it:
+            return list(it)
+    except PermissionError:
+        return []
+
+
+def _entry_is_dir(entry, follow_symlinks=True):
+    try:
+        return entry.is_dir(follow_symlinks=follow_symlinks)
+    except OSError:
+        return False
+
+
+def _get_closure(patterns, states):
+    '''Returns the states to match against the entries of a directory and the
+    patterns matching the directory itself.
+
+    ** also matches the directory itself, so the states after it are added and a
+    pattern ending in ** matches the directory.
+    '''
+    closure = []
+    matched_patterns = []
+    todo = list(states)
+    while todo:
+        state = todo.pop()
+        if state in closure:
+            continue
+        closure.append(state)
+        p, i = state
+        if patterns[p][i] is RECURSIVE_GLOB:
+            if i + 1 < len(patterns[p]):
+                todo.append((p, i + 1))
+            else:
+                matched_patterns.append(p)
+    return closure, matched_patterns
+
+
+def _match_component(dir_path, entries, comp, is_last):
+    '''Yields (name, is_match) for the entries of dir_path matching a component.
+
+    is_match is True for entries matched by the last component of a pattern, False
+    for directories to descend into. A literal component is looked up directly,
+    entries are only used for the others.
+    '''
+    if comp is RECURSIVE_GLOB:
+        for entry in entries:
+            if _entry_is_dir(entry, follow_symlinks=False):
+                yield entry.name, False
+    elif isinstance(comp, str):
+        path = os.path.join(dir_path, comp)
+        if is_last:
+            if os.path.exists(path):
+                yield comp, True
+        elif os.path.isdir(path):
+            yield comp, False
+    else:
+        for entry in entries:
+            if not comp(entry.name):
+                continue
+            if is_last:
+                yield entry.name, True
+            elif _entry_is_dir(entry):
+                yield entry.name, False
+
+
 def glob_backup_paths(backup_paths_unglobbed, snapshot_path):
+    '''Expands all backup path patterns in a single traversal of the snapshot.
+
+    Matches like pathlib's glob: ** matches directories recursively without following
+    symlinks, all other components are matched with fnmatch. Literal components are
+    looked up directly instead of listing their parent directory, and every directory
+    is listed at most once for all patterns. Duplicate and nested matches are
+    collapsed, so the crawl visits each path only once. Below a match, only patterns
+    without any match so far are evaluated further, to warn about the others.
+    '''
+    patterns = [split_glob_pattern(path) for path in backup_paths_unglobbed]
+    num_matches = [0] * len(patterns)
     backup_paths = []
+
+    # (relative path, states, inside match), a state (p, i) means that component i of
+    # pattern p is matched against the entries of the directory
+    stack = [('', [(p, 0) for p in range(len(patterns))], False)]
+    while stack:
+        rel_path, states, inside = stack.pop()
+        dir_path = os.path.join(snapshot_path, rel_path)
+
+        closure, matched_patterns = _get_closure(patterns, states)
+        for p in matched_patterns:
+            num_matches[p] += 1
+            if not inside:
+                backup_paths.append(rel_path or '.')
+                inside = True
+
+        entries = None
+        children = {}  # Name to states, in order of discovery
+        matched = set()  # Names of matched children
+        for p, i in closure:
+            if inside and num_matches[p] > 0:
+                continue  # Cannot contribute any new path
+            comp = patterns[p][i]
+            is_literal = isinstance(comp, str) and comp is not RECURSIVE_GLOB
+            if entries is None and not is_literal:
+                entries = _list_dir(dir_path)
+            # ** stays at the same component for the subdirectories
+            next_i = i if comp is RECURSIVE_GLOB else i + 1
+            for name, is_match in _match_component(dir_path, entries, comp,
+                                                   next_i == len(patterns[p])):
+                if not is_match:
+                    children.setdefault(name, []).append((p, next_i))
+                    continue
+                num_matches[p] += 1
+                if not inside and name not in matched:
+                    backup_paths.append(os.path.join(rel_path, name))
+                    matched.add(name)
+
+        for name, child_states in reversed(children.items()):
+            child_inside = inside or name in matched
+            stack.append((os.path.join(rel_path, name), child_states, child_inside))
+
     num_warnings = 0
-    base_path = pathlib.Path(snapshot_path)
-    for path_unglobbed in backup_paths_unglobbed:
-        paths_globbed = tuple(base_path.glob(path_unglobbed))
-        if len(paths_globbed) == 0:
+    for path_unglobbed, num_path_matches in zip(backup_paths_unglobbed, num_matches):
+        if num_path_matches == 0:
             print(f'WARNING: Path {path_unglobbed} does not exist and will be ignored!')
             num_warnings += 1
-        for path_globbed in paths_globbed:
-            backup_paths.append(os.fspath(path_globbed.relative_to(base_path)))
     return backup_paths, num_warnings
 
 
@@ -74,21 +211,58 @@ def glob_backup_paths_and_check(backup_paths_unglobbed, snapshot_path):
     return backup_paths
 
 
-def clean_multipart_uploads(s3_bucket):
-    cmd = ('aws', 's3api', 'list-multipart-uploads', '--bucket', s3_bucket)
-    parts_json = subprocess.check_output(cmd)
-    if len(parts_json) > 0:
-        parts = json.loads(parts_json)
-        for upload in parts['Uploads']:
-            print(f"Cleaning remaining multipart {upload['Key']}")
-            cmd = ('aws', 's3api', 'abort-multipart-upload', '--bucket', s3_bucket,
-                   '--key', upload['Key'], '--upload-id', upload['UploadId'])
-            subprocess.run(cmd, check=True)
+class BackupPathTrie:
+    '''Prefix tree over the path components of the (globbed) backup paths.
+
+    A position in the trie is passed down while traversing a directory tree, so
+    checking whether an entry is inside the backup paths is a single dict lookup and
+    does not need the path of the entry. Positions are a dict of the child
+    components, INSIDE when a backup path has been reached or None when the entry is
+    neither inside nor a parent of any backup path.
+    '''
+    INSIDE = True
+
+    def __init__(self, backup_paths):
+        self.root = {}
+        for backup_path in backup_paths:
+            comps = [comp for comp in backup_path.split('/') if comp not in ('', '.')]
+            if len(comps) == 0:
+                self.root = BackupPathTrie.INSIDE
+                break
+            node = self.root
+            for comp in comps[:-1]:
+                node = node.setdefault(comp, {})
+                if node is BackupPathTrie.INSIDE:
+                    break
+            else:
+                # Replaces any longer backup paths below this one
+                node[comps[-1]] = BackupPathTrie.INSIDE
+
+    @staticmethod
+    def descend(position, name):
+        if position is BackupPathTrie.INSIDE or position is None:
+            return position
+        return position.get(name)
+
+    @staticmethod
+    def is_inside(position):
+        return position is BackupPathTrie.INSIDE
+
+
+def make_set_list_filename(set_path, name):
+    return os.path.join(set_path, f'{name}.list')
+
+
+def make_set_parts_filename(list_file):
+    parts_file = os.path.splitext(list_file)[0] + '.parts'
+    return parts_file
 
 
-def make_set_info_filename(list_file):
-    info_file = os.path.splitext(list_file)[0] + '.info'
-    return info_file
+def write_json_atomic(filename, data):
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'wt') as f:
+        json.dump(data, f)
+    os.replace(tmp_filename, filename)
 
 
 def normalize_bucket_dir(bucket_dir):
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import contextlib
+import hashlib
 import json
 import os
 import queue
@@ -8,103 +10,365 @@ import subprocess
 import sys
 import threading
 import time
-
-from impl.tools import (BackupException, SealAction, clean_multipart_uploads,
-                        make_set_info_filename, normalize_bucket_dir, size_to_string,
-                        size_to_string_factor, size_to_unit)
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from impl.archive_codec import (DEFAULT_CODEC, codec_to_string, detect_codec,
+                                get_archive_suffix, get_codec_env, get_codec_from_env,
+                                get_codec_manifest_name, get_store_only_codec,
+                                write_codec_manifest)
+from impl.compression_controller import CompressionController, apply_settings
+from impl.s3_client import (S3_ERRORS, clean_multipart_uploads,
+                            get_resumable_upload_ids, get_s3_client)
+from impl.set_manifest import SET_REFERENCED, SET_UPLOADED, SetManifest
+from impl.tools import (BackupException, SealAction, make_set_list_filename,
+                        make_set_parts_filename, normalize_bucket_dir, size_to_string,
+                        size_to_string_factor, size_to_unit, write_json_atomic)
 
 NUM_UPLOAD_RETRIES = 3
+# Raised by failed uploads, which are retried
+UPLOAD_ERRORS = (subprocess.CalledProcessError, *S3_ERRORS)
+REFERENCES_FILENAME = 'references.json'
+PASSPHRASE_FILE = 'config/passphrase.txt'
+
+
+def get_pending_list_files(set_path, manifest):
+    return [make_set_list_filename(set_path, name) for name in manifest.get_pending()]
 
 
 def get_list_files(set_path):
-    list_files = []
+    manifest = SetManifest(set_path)
+    try:
+        return get_pending_list_files(set_path, manifest)
+    finally:
+        manifest.close()
 
-    def raise_error(error):
-        raise error
 
-    for root, _, files in os.walk(set_path, topdown=False, onerror=raise_error,
-                                  followlinks=False):
-        for file_ in files:
-            if os.path.splitext(file_)[1] == '.list':
-                list_file = os.path.join(root, file_)
-                list_files.append(list_file)
+def get_set_name(list_file):
+    return os.path.splitext(os.path.basename(list_file))[0]
 
-    list_files.sort()
 
-    return list_files
+def get_archive_name(list_file, codec=None):
+    codec = DEFAULT_CODEC if codec is None else codec
+    return f'{get_set_name(list_file)}{get_archive_suffix(codec)}'
 
 
-def build_archive(snapshot_path, list_file, buffer_path, tar_extra_args=None):
-    stem = os.path.splitext(os.path.basename(list_file))[0]
-    archive_name = f'{stem}.tar.zstd.gpg'
-    buffer_file = os.path.join(buffer_path, archive_name)
-    cmd = ['impl/build_archive.sh', snapshot_path, list_file, buffer_file]
+def get_set_codec(codec, info):
+    '''Sets of incompressible files are stored without compression.'''
+    return get_store_only_codec(codec) if info.get('store_only') else codec
+
+
+def get_build_archive_cmd(snapshot_path, list_file, archive_file, tar_extra_args=None,
+                          build_env=None):
+    '''An archive_file of - writes the archive to stdout.'''
+    cmd = ['impl/build_archive.sh', snapshot_path, list_file, archive_file]
+    if build_env:
+        cmd = ['env', *(f'{key}={value}' for key, value in build_env.items()), *cmd]
     if tar_extra_args:
         cmd.extend(tar_extra_args)
+    return cmd
+
+
+def build_archive(snapshot_path, list_file, buffer_path, tar_extra_args=None,
+                  codec=None):
+    codec = DEFAULT_CODEC if codec is None else codec
+    archive_name = get_archive_name(list_file, codec)
+    buffer_file = os.path.join(buffer_path, archive_name)
+    cmd = get_build_archive_cmd(snapshot_path, list_file, buffer_file, tar_extra_args,
+                                get_codec_env(codec))
     print(f"Running '{' '.join(cmd)}'")
     subprocess.run(cmd, check=True)
 
     return archive_name, buffer_file
 
 
-def get_set_info_for(list_file):
-    info_file = make_set_info_filename(list_file)
-    with open(info_file, 'rt') as info_file:
-        info = json.load(info_file)
-        return info
+class CommandOutput:
+    '''Readable stdout of a running command, counting the bytes read.
 
+    The command runs while the context is entered, leaving it kills the command if
+    it is still running and reaps it. Reading the end of the output of a failed
+    command raises CalledProcessError, so a truncated stream cannot be mistaken for a
+    complete one.
+    '''
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.process = None
+        self.num_bytes = 0
+        self.exit_stack = contextlib.ExitStack()
+
+    def __enter__(self):
+        with contextlib.ExitStack() as exit_stack:
+            self.process = exit_stack.enter_context(
+                subprocess.Popen(self.cmd, stdout=subprocess.PIPE))
+            exit_stack.callback(self._kill)
+            self.exit_stack = exit_stack.pop_all()
+        return self
 
-def archiver(archive_queue, snapshot_path, list_files, buffer_path, tar_extra_args):
+    def __exit__(self, type_, value_, traceback_):
+        return self.exit_stack.__exit__(type_, value_, traceback_)
+
+    def _kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and size != 0 and self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.cmd)
+        self.num_bytes += len(data)
+        return data
+
+
+def remove_set_files(list_file):
+    os.unlink(list_file)
+    parts_file = make_set_parts_filename(list_file)
+    if os.path.exists(parts_file):
+        os.unlink(parts_file)
+
+
+class SetIndex:
+    '''Maps set fingerprints to the keys of their uploaded archives.
+
+    Kept across backups, so unchanged sets can reference the archive of an earlier
+    backup instead of being uploaded again. The keys are kept per scope, the bucket and
+    BUCKET_DIR, so only archives of the same backups are referenced. They are looked up
+    by the fingerprint together with the compressor and encryption of the codec and a
+    digest of the passphrase: Archives written with another codec or passphrase are not
+    what this backup would restore. The compression level does not matter.
+    '''
+    def __init__(self, index_file, scope='', passphrase_file=None):
+        self.index_file = index_file
+        self.scopes = {}
+        if os.path.exists(index_file):
+            with open(index_file, 'rt') as f:
+                self.scopes = json.load(f)
+        self.keys = self.scopes.setdefault(scope, {})
+        self.passphrase_digest = None
+        if passphrase_file is not None:
+            with open(passphrase_file, 'rb') as f:
+                self.passphrase_digest = hashlib.sha256(f.read()).hexdigest()
+
+    def _get_index_key(self, fingerprint, codec):
+        data = json.dumps((fingerprint, codec['compressor'], codec['encryption'],
+                           self.passphrase_digest))
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, fingerprint, codec):
+        return self.keys.get(self._get_index_key(fingerprint, codec))
+
+    def add(self, fingerprint, codec, key):
+        self.keys[self._get_index_key(fingerprint, codec)] = key
+        write_json_atomic(self.index_file, self.scopes)
+
+    def remove(self, fingerprint, codec):
+        del self.keys[self._get_index_key(fingerprint, codec)]
+        write_json_atomic(self.index_file, self.scopes)
+
+
+def reuse_unchanged_sets(manifest, list_files, set_index, uploader, codec):
+    '''Returns the list files of the sets which need to be uploaded.
+
+    Sets with the fingerprint of an archive uploaded before with the same codec
+    reference the key of that archive in the manifest instead.
+    '''
+    remaining_list_files = []
+    reused_bytes = 0
+    for list_file in list_files:
+        info = manifest.get_info(get_set_name(list_file))
+        fingerprint = info.get('fingerprint')
+        set_codec = get_set_codec(codec, info)
+        key = None if fingerprint is None else set_index.get(fingerprint, set_codec)
+        if key is not None and not uploader.exists(key):
+            print(f'Archive {key} of unchanged set does not exist anymore')
+            set_index.remove(fingerprint, set_codec)
+            key = None
+        if key is None:
+            remaining_list_files.append(list_file)
+            continue
+
+        print(f'Set {get_set_name(list_file)} is unchanged, referencing {key}')
+        manifest.set_status(get_set_name(list_file), SET_REFERENCED, key)
+        remove_set_files(list_file)
+        reused_bytes += info['size_bytes']
+
+    num_reused = len(list_files) - len(remaining_list_files)
+    if num_reused > 0:
+        print(f'Reusing {num_reused} unchanged set(s), {size_to_string(reused_bytes)}')
+    return remaining_list_files
+
+
+def build_set(snapshot_path, list_file, buffer_path, tar_extra_args, streaming=False,
+              codec=None):
+    '''Builds the archive of a set and its contents archive.
+
+    Returns (archive_name, archive_file, archive_size_bytes, list_list_filepath,
+    contents_archive_name, contents_archive_file, codec), removes partial files on
+    failure. When streaming, only the contents archive is built, archive_file is None
+    and the archive is built during upload. The codec manifest of the archive is
+    written next to it, an archive kept for resuming its upload is reused with the
+    codec in its manifest. The contents archive is built with the codec of the set as
+    well.
+    '''
+    codec = DEFAULT_CODEC if codec is None else codec
     archive_file = None
     list_list_filepath = None
     contents_archive_file = None
+    archive_name = get_archive_name(list_file, codec)
+    codec_manifest_file = os.path.join(buffer_path,
+                                       get_codec_manifest_name(archive_name))
     try:
-        for index, list_file in enumerate(list_files, 1):
-            while archive_queue.full():
-                time.sleep(5)
-
-            print(f"Set {index}/{len(list_files)}: Packing from list '{list_file}'")
-
-            t0 = time.time()
+        if streaming:
+            archive_size_bytes = 0
+        elif os.path.exists(os.path.join(buffer_path, archive_name)):
+            archive_file = os.path.join(buffer_path, archive_name)
+            codec = detect_codec(archive_file)
+            print(f'Reusing {archive_file}, kept for resuming its upload'
+                  f' ({codec_to_string(codec)})')
+            archive_size_bytes = os.path.getsize(archive_file)
+        else:
             archive_name, archive_file = build_archive(snapshot_path, list_file,
-                                                       buffer_path, tar_extra_args)
-            archive_time_sec = time.time() - t0
+                                                       buffer_path, tar_extra_args,
+                                                       codec)
             archive_size_bytes = os.path.getsize(archive_file)
-
-            info = get_set_info_for(list_file)
-            archived_bytes = info['size_bytes']
-
-            stem = os.path.basename(list_file)
-            list_list_filename = f'{stem}_contents.txt'
-            list_list_filepath = os.path.join(buffer_path, list_list_filename)
-            with open(list_list_filepath, 'wt') as f:
-                print(list_file, file=f)
-            contents_archive_name, contents_archive_file = build_archive('.',
-                                                                        list_list_filepath,
-                                                                        buffer_path)
-
-            archive_queue.put((list_file, archive_name, archive_file, archive_time_sec,
-                               archive_size_bytes, archived_bytes, list_list_filepath,
-                               contents_archive_name, contents_archive_file))
-            archive_file = None
-            list_list_filepath = None
-            contents_archive_file = None
-
-        archive_queue.put(True)  # All processed, success
-    except:  # pylint: disable=bare-except
-        if archive_file is not None:
-            os.unlink(archive_file)
-        if list_list_filepath is not None:
-            os.unlink(list_list_filepath)
-        if contents_archive_file is not None:
-            os.unlink(contents_archive_file)
-        archive_queue.put(False)  # Failure
+        write_codec_manifest(codec_manifest_file, codec)
+
+        stem = os.path.basename(list_file)
+        list_list_filename = f'{stem}_contents.txt'
+        list_list_filepath = os.path.join(buffer_path, list_list_filename)
+        parts_file = make_set_parts_filename(list_file)
+        with open(list_list_filepath, 'wt') as f:
+            print(list_file, file=f)
+            if os.path.exists(parts_file):
+                print(parts_file, file=f)
+        contents_archive_name, contents_archive_file = build_archive(
+            '.', list_list_filepath, buffer_path, codec=codec)
+    except:
+        for file_ in (archive_file, codec_manifest_file, list_list_filepath,
+                      contents_archive_file):
+            if file_ is not None and os.path.exists(file_):
+                os.unlink(file_)
+        raise
+    return (archive_name, archive_file, archive_size_bytes, list_list_filepath,
+            contents_archive_name, contents_archive_file, codec)
+
+
+def get_free_buffer_space(buffer_path, builds):
+    '''Returns the free space in buffer_path minus what running builds will still
+    write, builds are (list_file, archive_file, reserved_bytes) tuples.'''
+    bytes_free = shutil.disk_usage(buffer_path).free
+    for _, archive_file, reserved_bytes in builds:
+        try:
+            written_bytes = os.path.getsize(archive_file)
+        except FileNotFoundError:
+            written_bytes = 0
+        bytes_free -= max(0, reserved_bytes - written_bytes)
+    return bytes_free
+
+
+def run_builds(archive_queue, snapshot_path, list_files, set_sizes, buffer_path,
+               tar_extra_args, num_builders, streaming, controller, codecs):
+    '''The build loop of archiver(), returns whether all builds succeeded.'''
+    pending = list(reversed(list_files))
+    builds = {}  # Future to (list_file, archive_file, reserved_bytes)
+    build_starts = {}  # Future to (start time, compression settings)
+    success = True
+    busy_start = None  # Since when builds are running, without a result reported
+    with ThreadPoolExecutor(max_workers=num_builders) as executor:
+        while builds or (pending and success):
+            if success and pending and len(builds) < num_builders:
+                list_file = pending[-1]
+                codec = codecs.get(list_file, DEFAULT_CODEC)
+                archive_file = os.path.join(buffer_path,
+                                            get_archive_name(list_file, codec))
+                # An archive kept for resuming its upload is reused by build_set(),
+                # it needs no space and tells nothing about the compression settings
+                reused = not streaming and os.path.exists(archive_file)
+                reserved_bytes = 0 if streaming or reused else set_sizes[list_file]
+                is_idle = not builds and archive_queue.empty()
+                if is_idle or (get_free_buffer_space(buffer_path, builds.values())
+                               >= reserved_bytes):
+                    pending.pop()
+                    index = len(list_files) - len(pending)
+                    compression = None
+                    if (controller is not None and not reused
+                            and codec['compressor'] == 'zstd'):
+                        compression = controller.get_settings()
+                        codec = apply_settings(codec, compression)
+                    print(f"Set {index}/{len(list_files)}: Packing from list"
+                          f" '{list_file}' ({codec_to_string(codec)})")
+                    if not builds:
+                        busy_start = time.time()
+                    future = executor.submit(build_set, snapshot_path, list_file,
+                                             buffer_path, tar_extra_args, streaming,
+                                             codec)
+                    build_starts[future] = (time.time(), compression)
+                    builds[future] = (list_file, archive_file, reserved_bytes)
+                    continue
+
+            if not builds:
+                time.sleep(5)  # Waiting for uploads to free buffer space
+                continue
+            done, _ = wait(builds, timeout=5, return_when=FIRST_COMPLETED)
+            for future in done:
+                list_file = builds.pop(future)[0]
+                build_start, compression = build_starts.pop(future)
+                # Wall time with builds running, so parallel builds are not counted
+                # multiple times
+                now = time.time()
+                archive_time_sec = now - busy_start
+                busy_start = now
+                try:
+                    (archive_name, archive_file, archive_size_bytes, list_list_filepath,
+                     contents_archive_name, contents_archive_file,
+                     codec) = future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    print(f"Error packing from list '{list_file}': {e}")
+                    success = False
+                    continue
+                if compression is not None:
+                    controller.add_build(compression, archive_size_bytes,
+                                         now - build_start)
+                archive_queue.put(
+                    (list_file, archive_name, archive_file, archive_time_sec,
+                     archive_size_bytes, set_sizes[list_file], list_list_filepath,
+                     contents_archive_name, contents_archive_file, codec))
+
+    return success
+
+
+def archiver(archive_queue, snapshot_path, list_files, set_sizes, buffer_path,
+             tar_extra_args, num_builders, streaming=False, controller=None,
+             codecs=None):
+    '''Builds the archives with up to num_builders in parallel.
+
+    A build starts when the buffer has room for its archive, which is assumed to be
+    as large as the uncompressed set. The free space is measured before each start,
+    as archives get uploaded and deleted. Without builds running or archives waiting
+    for upload, a build always starts. When streaming, only the small contents
+    archives are built here. codecs are the codecs of the sets by list file, the
+    default codec for missing ones. The controller chooses the zstd settings of those
+    compressed by zstd. The results end with the codec each archive was built with,
+    which for an archive kept for resuming its upload is the one of its manifest.
+
+    Ends the queue with True on success, with False on any failure, so the upload
+    workers never wait forever.
+    '''
+    success = False
+    try:
+        success = run_builds(archive_queue, snapshot_path, list_files, set_sizes,
+                             buffer_path, tar_extra_args, num_builders, streaming,
+                             controller, codecs or {})
+    finally:
+        archive_queue.put(success)  # All processed
 
 
 class Uploader:
-    def __init__(self, s3_bucket, bucket_dir, timestamp):
+    '''With upload_state_path, multipart uploads of files are resumable. Their state
+    is kept there until they complete.'''
+    def __init__(self, s3_bucket, bucket_dir, timestamp, upload_state_path=None):
         self.s3_bucket = s3_bucket
-        self.bucket_path_prefix = f's3://{s3_bucket}/{bucket_dir}{timestamp}'
+        self.s3_client = get_s3_client(s3_bucket)
+        self.key_prefix = f'{bucket_dir}{timestamp}'
+        self.upload_state_path = upload_state_path
 
     def __enter__(self):
         return self
@@ -112,47 +376,92 @@ class Uploader:
     def __exit__(self, type_, value_, traceback_):
         # During upload, files will be temporarily stored in S3 standard storage.
         # Failed uploads leave orphans behind, which will cause quite high costs.
-        # So drop them here.
-        clean_multipart_uploads(self.s3_bucket)
-
-    @staticmethod
-    def _is_internet_reachable():
-        command = ('aws', 'sts', 'get-caller-identity')
-        cp = subprocess.run(command, check=False, capture_output=True, text=True)
-        output = (cp.stdout + cp.stderr).lower()
-        if cp.returncode == 0 or 'could not connect' not in output:
-            return True
-        return False
-
-    @staticmethod
-    def _wait_for_internet():
-        while not Uploader._is_internet_reachable():
+        # So drop them here, except the ones to be resumed.
+        keep_upload_ids = ()
+        if self.upload_state_path is not None:
+            keep_upload_ids = get_resumable_upload_ids(self.upload_state_path)
+        clean_multipart_uploads(self.s3_bucket, keep_upload_ids)
+
+    def _wait_for_internet(self):
+        while not self.s3_client.is_reachable():
             print('Internet connection to AWS does not work, waiting...')
             time.sleep(5)
 
+    def get_key(self, archive_name):
+        return f'{self.key_prefix}/{archive_name}'
+
+    def exists(self, key):
+        return self.s3_client.exists(key)
+
+    def get_upload_state_file(self, archive_name):
+        return os.path.join(self.upload_state_path, f'{archive_name}.json')
+
+    def is_resumable(self, archive_name):
+        '''Whether a failed upload of archive_name can be continued.'''
+        return (self.upload_state_path is not None
+                and os.path.exists(self.get_upload_state_file(archive_name)))
+
     def upload(self, file_, archive_name, deep_archive):
-        bucket_path = f'{self.bucket_path_prefix}/{archive_name}'
-        cmd = ['aws', 's3', 'cp', file_, bucket_path]
-        if deep_archive:
-            cmd.extend(['--storage-class', 'DEEP_ARCHIVE'])
-        print(f"Running '{' '.join(cmd)}'")
+        key = self.get_key(archive_name)
+        storage_class = 'DEEP_ARCHIVE' if deep_archive else None
+        print(f"Uploading '{file_}' to s3://{self.s3_bucket}/{key}")
         t0 = time.time()
         try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError:
-            Uploader._wait_for_internet()
+            if (self.upload_state_path is not None
+                    and os.path.getsize(file_) > self.s3_client.chunk_size_bytes):
+                self.s3_client.upload_file_resumable(
+                    file_, key, self.get_upload_state_file(archive_name),
+                    storage_class)
+            else:
+                self.s3_client.upload_file(file_, key, storage_class)
+        except S3_ERRORS:
+            self._wait_for_internet()
             raise
         return time.time() - t0
 
+    def upload_stream(self, source_cmd, archive_name, expected_size_bytes):
+        '''Uploads the stdout of source_cmd to deep archive without storing it.
 
-def package_and_upload(snapshot_path, set_path, buffer_path, uploader, tar_extra_args):  # pylint: disable=too-many-statements
+        expected_size_bytes must not be too low, as the chunk size is chosen from it.
+        Returns (duration, size of the stream).
+        '''
+        key = self.get_key(archive_name)
+        print(f"Uploading output of '{' '.join(source_cmd)}'"
+              f' to s3://{self.s3_bucket}/{key}')
+        t0 = time.time()
+        try:
+            with CommandOutput(source_cmd) as stream:
+                self.s3_client.upload_stream(stream, key, expected_size_bytes,
+                                             'DEEP_ARCHIVE')
+        except UPLOAD_ERRORS:
+            self._wait_for_internet()
+            raise
+        return time.time() - t0, stream.num_bytes
+
+
+def get_expected_stream_size(set_size_bytes):
+    # Archives of incompressible sets get slightly larger by tar headers and
+    # compression and encryption overhead
+    return set_size_bytes + set_size_bytes // 10 + 1024 * 1024
+
+
+def package_and_upload(snapshot_path, set_path, manifest, buffer_path, uploader,
+                       tar_extra_args, set_index, num_builders=1, num_uploaders=1,
+                       streaming=False, adaptive_compression=False, codec=None):
+    # pylint: disable=too-many-statements
+    codec = DEFAULT_CODEC if codec is None else codec
     num_errors = 0
-    list_files = get_list_files(set_path)
+    list_files = reuse_unchanged_sets(manifest,
+                                      get_pending_list_files(set_path, manifest),
+                                      set_index, uploader, codec)
 
-    total_size_bytes = 0
+    total_size_bytes = manifest.get_pending_size()
+    set_sizes = {}
+    codecs = {}
     for list_file in list_files:
-        info = get_set_info_for(list_file)
-        total_size_bytes += info['size_bytes']
+        info = manifest.get_info(get_set_name(list_file))
+        set_sizes[list_file] = info['size_bytes']
+        codecs[list_file] = get_set_codec(codec, info)
 
     archived_bytes = 0  # uncompressed
     archive_size_bytes = 0  # compressed
@@ -234,87 +543,237 @@ def package_and_upload(snapshot_path, set_path, buffer_path, uploader, tar_extra
 
     # Upload will usually be slower than archive building. So build the archives in the
     # background, so that we will always have an archive ready for upload.
-    # At most two archives will exist in parallel (one of it in process of being uploaded).
-    archive_queue = queue.Queue(maxsize=1)
+    # How many archives are built ahead is limited by the space in buffer_path.
+    # When streaming, archives are built while uploading them instead.
+    archive_queue = queue.Queue()
+    controller = None
+    if adaptive_compression and codec['compressor'] != 'zstd':
+        print(f"Adaptive compression needs zstd, not {codec['compressor']}, disabled")
+    elif adaptive_compression and not streaming:
+        controller = CompressionController(num_builders, num_uploaders)
     archive_thread = threading.Thread(target=archiver,
                                       args=(archive_queue, snapshot_path, list_files,
-                                            buffer_path, tar_extra_args))
+                                            set_sizes, buffer_path, tar_extra_args,
+                                            num_builders, streaming, controller,
+                                            codecs))
 
     archive_thread.daemon = True
     archive_thread.start()
 
+    # Guards the status and the manifest and index updates of the upload workers
+    lock = threading.Lock()
     archive_index = 0
+    num_uploads_running = 0
+    upload_mark_sec = None  # Since when uploads are running, without time accounted
+    exceptions = []
+
+    def account_upload_time(num_uploads_delta):
+        # Wall time with uploads running, so parallel uploads are not counted
+        # multiple times
+        nonlocal num_uploads_running, upload_mark_sec, upload_time_sec
+        now = time.time()
+        if num_uploads_running > 0:
+            upload_time_sec += now - upload_mark_sec
+        upload_mark_sec = now
+        num_uploads_running += num_uploads_delta
+
+    def upload_objects(result, codec_manifest_name, codec_manifest_file):
+        '''Uploads all objects of a set once, returns the size of the archive.'''
+        (list_file, archive_name, archive_file, _, archive_size_bytes_job,
+         archived_bytes_job, _, contents_archive_name, contents_archive_file,
+         archive_codec) = result
+        uploader.upload(contents_archive_file, contents_archive_name,
+                        deep_archive=False)
+        # Readable without restoring from deep archive
+        uploader.upload(codec_manifest_file, codec_manifest_name, deep_archive=False)
+        if streaming:
+            cmd = get_build_archive_cmd(snapshot_path, list_file, '-', tar_extra_args,
+                                        get_codec_env(archive_codec))
+            _, archive_size_bytes_job = uploader.upload_stream(
+                cmd, archive_name, get_expected_stream_size(archived_bytes_job))
+        else:
+            upload_time_sec_job = uploader.upload(archive_file, archive_name,
+                                                  deep_archive=True)
+            if controller is not None:
+                controller.add_upload(archive_size_bytes_job, upload_time_sec_job)
+        return archive_size_bytes_job
+
+    def finish_set(result, upload_success):
+        '''Removes the files of a set after its upload, successful or not.'''
+        nonlocal num_errors
+        (list_file, archive_name, archive_file, _, _, _, list_list_filepath, _,
+         contents_archive_file, archive_codec) = result
+        # Delete archive unless its upload can be resumed, retry will recreate it
+        # and we need the space. Its codec manifest is kept with it.
+        codec_manifest_file = os.path.join(buffer_path,
+                                           get_codec_manifest_name(archive_name))
+        if (archive_file is not None and not upload_success
+                and uploader.is_resumable(archive_name)):
+            print(f'Keeping {archive_file} to resume its upload')
+        else:
+            if archive_file is not None:
+                os.unlink(archive_file)
+            os.unlink(codec_manifest_file)
+        if upload_success:
+            # Only now all objects of the set are uploaded
+            set_name = get_set_name(list_file)
+            with lock:
+                fingerprint = manifest.get_info(set_name).get('fingerprint')
+                if fingerprint is not None:
+                    set_index.add(fingerprint, archive_codec,
+                                  uploader.get_key(archive_name))
+                manifest.set_status(set_name, SET_UPLOADED)
+            remove_set_files(list_file)
+
+        # We will return, clean up
+        exception_pending = sys.exc_info()[0] is not None
+        if upload_success or exception_pending:
+            os.unlink(list_list_filepath)
+            os.unlink(contents_archive_file)
 
-    while True:
-        result = archive_queue.get()
-        if result in (True, False):
-            archive_thread.join()
-            if result is False:
+        if not upload_success:
+            # When upload failed, backup_resume will have to be run.
+            with lock:
                 num_errors += 1
-            break
-        archive_index += 1
-        (list_file, archive_name, archive_file, archive_time_sec_job,
-         archive_size_bytes_job, archived_bytes_job, list_list_filepath,
-         contents_archive_name, contents_archive_file) = result
+
+    def upload_set(result):
+        nonlocal archive_index, archive_time_sec, archive_size_bytes, archived_bytes
+        nonlocal net_uploaded_bytes, gross_uploaded_bytes
+        (_, archive_name, _, archive_time_sec_job, archive_size_bytes_job,
+         archived_bytes_job, _, _, _, _) = result
         upload_success = False
+        # Written next to the archive by build_set()
+        codec_manifest_name = get_codec_manifest_name(archive_name)
+        codec_manifest_file = os.path.join(buffer_path, codec_manifest_name)
 
         try:
-            archive_time_sec += archive_time_sec_job
-            archive_size_bytes += archive_size_bytes_job
-            archived_bytes += archived_bytes_job
-            print_status()
+            with lock:
+                archive_index += 1
+                set_number = archive_index
+                if not streaming:
+                    archive_time_sec += archive_time_sec_job
+                    archive_size_bytes += archive_size_bytes_job
+                    archived_bytes += archived_bytes_job
+                print_status()
 
             for i in range(NUM_UPLOAD_RETRIES):
-                print(f'Set {archive_index}/{len(list_files)}: Uploading {archive_name}'
+                print(f'Set {set_number}/{len(list_files)}: Uploading {archive_name}'
                       f', attempt {i+1}')
 
+                with lock:
+                    account_upload_time(1)
                 try:
-                    uploader.upload(contents_archive_file, contents_archive_name,
-                                    deep_archive=False)
-                    file_upload_time_sec = uploader.upload(archive_file, archive_name,
-                                                           deep_archive=True)
-
+                    archive_size_bytes_job = upload_objects(result, codec_manifest_name,
+                                                            codec_manifest_file)
                     upload_success = True
-                    net_uploaded_bytes += os.path.getsize(archive_file)
-                    gross_uploaded_bytes += archived_bytes_job
-                    upload_time_sec += file_upload_time_sec
                     break
-                except subprocess.CalledProcessError as e:
+                except UPLOAD_ERRORS as e:
                     print(f'Error during upload: {e}')
                 finally:
-                    print_status()
+                    with lock:
+                        account_upload_time(-1)
+                        if upload_success:
+                            if streaming:
+                                # Archiving and upload are the same pipeline
+                                archive_size_bytes += archive_size_bytes_job
+                                archived_bytes += archived_bytes_job
+                                archive_time_sec = upload_time_sec
+                            net_uploaded_bytes += archive_size_bytes_job
+                            gross_uploaded_bytes += archived_bytes_job
+                        print_status()
         finally:
-            # Delete archive in any case, retry will recreate it and we need the space
-            os.unlink(archive_file)
-            if upload_success:
-                os.unlink(list_file)
-                os.unlink(make_set_info_filename(list_file))
-
-            # We will return, clean up
-            exception_pending = sys.exc_info()[0] is not None
-            if upload_success or exception_pending:
-                os.unlink(list_list_filepath)
-                os.unlink(contents_archive_file)
+            finish_set(result, upload_success)
+
+    def upload_worker():
+        try:
+            while not exceptions:
+                result = archive_queue.get()
+                if exceptions or result in (True, False):
+                    # For the other workers, or for the clean up of the queued files
+                    archive_queue.put(result)
+                    return
+                upload_set(result)
+        except Exception as e:  # pylint: disable=broad-except
+            exceptions.append(e)
+        except BaseException as e:
+            exceptions.append(e)  # Stops the other workers
+            raise
 
-            if exception_pending:
-                # Clean up files in queue. This is not totally clean, since the archiver thread
-                # is still running and producing, so there can be leftovers.
-                result = archive_queue.get(block=False)
-                if result not in (True, False):
-                    archive_file = result[2]
-                    list_list_filepath = result[6]
-                    contents_archive_file = result[8]
+    upload_threads = [threading.Thread(target=upload_worker, daemon=True)
+                      for _ in range(num_uploaders)]
+    for upload_thread in upload_threads:
+        upload_thread.start()
+    try:
+        for upload_thread in upload_threads:
+            upload_thread.join()
+        if exceptions:
+            raise exceptions[0]
+    except:
+        # Clean up files in queue. This is not totally clean, since the archiver thread
+        # and other upload workers may still be running, so there can be leftovers.
+        while not archive_queue.empty():
+            result = archive_queue.get(block=False)
+            if result not in (True, False):
+                archive_file = result[2]
+                list_list_filepath = result[6]
+                contents_archive_file = result[8]
+                if archive_file is not None:
                     os.unlink(archive_file)
-                    os.unlink(list_list_filepath)
-                    os.unlink(contents_archive_file)
+                os.unlink(os.path.join(buffer_path, get_codec_manifest_name(result[1])))
+                os.unlink(list_list_filepath)
+                os.unlink(contents_archive_file)
+        raise
 
-            if not upload_success:
-                # When upload failed, backup_resume will have to be run.
-                num_errors += 1
+    result = archive_queue.get()
+    archive_thread.join()
+    if result is False:
+        num_errors += 1
 
     return num_errors
 
 
+def clean_buffer(buffer_path, upload_state_path):
+    '''Removes the files left in buffer_path by an interrupted backup, except the
+    archives of resumable uploads with their codec manifests, and the state of uploads
+    without archive.'''
+    names = os.listdir(buffer_path)
+    kept_names = {name for name in names
+                  if os.path.exists(os.path.join(upload_state_path, f'{name}.json'))}
+    kept_names.update([get_codec_manifest_name(name) for name in kept_names])
+    for name in names:
+        if name not in kept_names:
+            os.unlink(os.path.join(buffer_path, name))
+    for name in os.listdir(upload_state_path):
+        if not os.path.exists(os.path.join(buffer_path, name.removesuffix('.json'))):
+            os.unlink(os.path.join(upload_state_path, name))
+
+
+def upload_references(set_path, manifest, buffer_path, uploader, codec=None):
+    '''Uploads the mapping of archive names to the archives referenced instead.'''
+    codec = DEFAULT_CODEC if codec is None else codec
+    references = {get_archive_name(make_set_list_filename(set_path, name),
+                                   get_set_codec(codec, manifest.get_info(name))): key
+                  for name, key in manifest.get_references().items()}
+    if not references:
+        return 0
+    references_file = os.path.join(buffer_path, REFERENCES_FILENAME)
+    with open(references_file, 'wt') as f:
+        json.dump(references, f)
+
+    try:
+        for i in range(NUM_UPLOAD_RETRIES):
+            print(f'Uploading {REFERENCES_FILENAME}, attempt {i+1}')
+            try:
+                uploader.upload(references_file, REFERENCES_FILENAME,
+                                deep_archive=False)
+                return 0
+            except UPLOAD_ERRORS as e:
+                print(f'Error during upload: {e}')
+        return 1
+    finally:
+        os.unlink(references_file)
+
+
 def upload_restore_config(s3_bucket, bucket_dir, timestamp, settings, buffer_path,
                           uploader):
     buffer_path_base = os.path.dirname(buffer_path)
@@ -341,7 +800,7 @@ def upload_restore_config(s3_bucket, bucket_dir, timestamp, settings, buffer_pat
         try:
             uploader.upload(restore_file, restore_filename, deep_archive=False)
             break
-        except subprocess.CalledProcessError as e:
+        except UPLOAD_ERRORS as e:
             print(f'Error during upload: {e}')
     else:
         os.unlink(restore_file)
@@ -360,22 +819,45 @@ if __name__ == '__main__':
     timestamp = os.environ['TIMESTAMP']
     settings = os.environ['SETTINGS']
     upload_limit = int(os.environ['UPLOAD_LIMIT_MB']) * 1024 * 1024
+    set_index = SetIndex(os.environ['SET_INDEX_FILE'], f'{s3_bucket}/{bucket_dir}',
+                         PASSPHRASE_FILE)
+    num_builders = int(os.environ.get('NUM_ARCHIVE_BUILDERS', 1))
+    num_uploaders = int(os.environ.get('NUM_UPLOADERS', 1))
+    streaming = os.environ.get('STREAMING_UPLOAD') == '1'
+    adaptive_compression = os.environ.get('ADAPTIVE_COMPRESSION') == '1'
+    upload_state_path = os.environ['UPLOAD_STATE_PATH']
+    try:
+        codec = get_codec_from_env()
+    except ValueError as e:
+        raise BackupException(f'Invalid archive codec: {e}') from e
     seal_action = SealAction()
     if seal_action.is_skip_sealed():
         extra_args = ('--exclude=*/.GDAB_SEALED', '--exclude=*/.GDAB_SEALED/*')
     else:
         extra_args = ()
+    os.makedirs(upload_state_path, exist_ok=True)
+    clean_buffer(buffer_path, upload_state_path)
+
     _, _, bytes_free = shutil.disk_usage(buffer_path)
-    if bytes_free < upload_limit:
+    if not streaming and bytes_free < upload_limit:
         raise BackupException(f'Not enough disk space in buffer path {buffer_path} '
                               f'(upload_limit={size_to_string(upload_limit)}, '
                               f'bytes_free={size_to_string(bytes_free)})')
 
-    with Uploader(s3_bucket, bucket_dir, timestamp) as uploader:
-        num_errors = package_and_upload(snapshot_path, set_path, buffer_path, uploader,
-                                        extra_args)
-
-        num_errors += upload_restore_config(s3_bucket, bucket_dir.rstrip('/'),
-                                            timestamp, settings, buffer_path, uploader)
+    manifest = SetManifest(set_path)
+    try:
+        with Uploader(s3_bucket, bucket_dir, timestamp, upload_state_path) as uploader:
+            num_errors = package_and_upload(snapshot_path, set_path, manifest,
+                                            buffer_path, uploader, extra_args,
+                                            set_index, num_builders, num_uploaders,
+                                            streaming, adaptive_compression, codec)
+            num_errors += upload_references(set_path, manifest, buffer_path, uploader,
+                                            codec)
+
+            num_errors += upload_restore_config(s3_bucket, bucket_dir.rstrip('/'),
+                                                timestamp, settings, buffer_path,
+                                                uploader)
+    finally:
+        manifest.close()
 
     sys.exit(0 if num_errors == 0 else 1)
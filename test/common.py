@@ -0,0 +1,62 @@
+import os
+import random
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+WORK_PATH = os.path.join(SCRIPT_PATH, 'work')
+os.makedirs(WORK_PATH, exist_ok=True)
+
+POOL_PATH = os.path.join(WORK_PATH, 'pool')
+ZFS_POOL = 'tank'
+SET_PATH = os.path.join(WORK_PATH, 'sets')
+
+# Letters: directories, numbers: files
+# Trailing slash means directory
+SIZE_SMALL = 10
+
+thread_pool = ThreadPoolExecutor(max_workers=2 * os.cpu_count())
+
+
+def setup():
+    subprocess.run(('sudo', 'mount', '-t', 'tmpfs', '-o', 'size=1024m',
+                    'glacier_deep_archive_backup_test', WORK_PATH), check=True)
+
+
+def teardown():
+    subprocess.run(('sudo', 'umount', WORK_PATH), check=True)
+
+
+class TestException(Exception):
+    pass
+
+
+def reset_work_path(*paths):
+    '''Empties the work dir, then creates paths.'''
+    for item in os.listdir(WORK_PATH):
+        shutil.rmtree(os.path.join(WORK_PATH, item), ignore_errors=True)
+    for path in paths:
+        os.makedirs(path)
+
+
+def create_files(items):
+    '''A size of (length, data_size) creates a sparse file with data in the middle.'''
+    for item_path, size in items:
+        if item_path.endswith('/'):
+            os.makedirs(os.path.join(POOL_PATH, item_path), exist_ok=True)
+        else:
+            path, _ = os.path.split(item_path)
+            os.makedirs(os.path.join(POOL_PATH, path), exist_ok=True)
+            with open(os.path.join(POOL_PATH, item_path), 'wb') as f:
+                if isinstance(size, tuple):
+                    length, data_size = size
+                    f.seek(length // 2)
+                    f.write(random.randbytes(data_size))
+                    f.truncate(length)
+                else:
+                    f.write(random.randbytes(size))
+
+
+def run_cmd(cmd):
+    subprocess.run(cmd, check=True)
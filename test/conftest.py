@@ -0,0 +1,10 @@
+import pytest
+
+from common import setup, teardown
+
+
+@pytest.fixture(scope='session', autouse=True)
+def setup_teardown():
+    setup()
+    yield
+    teardown()
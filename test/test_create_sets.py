@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import itertools
+import json
 import os
+import pathlib
 import pickle
 import random
 import shutil
@@ -8,61 +11,28 @@ import string
 import subprocess
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
-from impl.create_sets import Path, SetWriter, crawl
-from impl.tools import BackupException, SealAction, glob_backup_paths
+from common import (POOL_PATH, SCRIPT_PATH, SET_PATH, SIZE_SMALL, WORK_PATH, ZFS_POOL,
+                    TestException, create_files, reset_work_path, run_cmd, setup,
+                    teardown, thread_pool)
+from impl.compression_estimate import CompressionEstimator
+from impl.crawl_tree import ITEM_FILE, DbPath, MemoryPath, Path
+from impl.crawler import CrawlProgress, crawl, is_immutable, is_sparse_candidate
+from impl.create_sets import SetWriter, crawl_and_write, get_set_fingerprint, load
+from impl.set_manifest import SET_UPLOADED, SetManifest
+from impl.state_db import StateDb
+from impl.tools import BackupException, BackupPathTrie, SealAction, glob_backup_paths
 from impl.upload_sets import build_archive, get_list_files
 
-SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
-WORK_PATH = os.path.join(SCRIPT_PATH, 'work')
-os.makedirs(WORK_PATH, exist_ok=True)
-
-POOL_PATH = os.path.join(WORK_PATH, 'pool')
-ZFS_POOL = 'tank'
-
 # Test two different kinds of snapshot paths
 SNAPSHOT_PATHS = ('/glacier_deep_archive_backup_test',
                   '/mnt/glacier_deep_archive_backup_test')
-SET_PATH = os.path.join(WORK_PATH, 'sets')
+STATE_DB_PATH = os.path.join(WORK_PATH, 'fs.state')
 REPRO_PATH = os.path.join(SCRIPT_PATH, 'state', 'repro.pickle')
 os.makedirs(os.path.dirname(REPRO_PATH), exist_ok=True)
 
-thread_pool = ThreadPoolExecutor(max_workers=2 * os.cpu_count())
-
-
-def setup():
-    subprocess.run(('sudo', 'mount', '-t', 'tmpfs', '-o', 'size=1024m',
-                    'glacier_deep_archive_backup_test', WORK_PATH), check=True)
-
-
-def teardown():
-    subprocess.run(('sudo', 'umount', WORK_PATH), check=True)
-
-
-@pytest.fixture(scope='session', autouse=True)
-def setup_teardown():
-    setup()
-    yield
-    teardown()
-
-
-class TestException(Exception):
-    pass
-
-
-def create_files(items):
-    for item_path, size in items:
-        if item_path.endswith('/'):
-            os.makedirs(os.path.join(POOL_PATH, item_path), exist_ok=True)
-        else:
-            path, _ = os.path.split(item_path)
-            os.makedirs(os.path.join(POOL_PATH, path), exist_ok=True)
-            with open(os.path.join(POOL_PATH, item_path), 'wb') as f:
-                f.write(random.randbytes(size))
-
 
 class ArchiveBuilder:
     def __init__(self, snapshot_path, work_path):
@@ -74,23 +44,38 @@ class ArchiveBuilder:
         return buffer_file
 
 
-def run_cmd(cmd):
-    subprocess.run(cmd, check=True)
+def dump_tree(node):
+    return (node.name, sorted(node.files),
+            [dump_tree(dir_node) for dir_node in node.dirs.values()])
+
+
+def crawl_and_compare(snapshot_path, backup_paths):
+    root_node = crawl(snapshot_path, backup_paths, SealAction())
+    root_node_parallel = crawl(snapshot_path, backup_paths, SealAction(), num_workers=4,
+                               verify_mode='sample')
+    if dump_tree(root_node) != dump_tree(root_node_parallel):
+        raise TestException('Mismatch between sequential and parallel crawl')
+
+    db = StateDb(STATE_DB_PATH, create=True)
+    try:
+        root_node_db = crawl(snapshot_path, backup_paths, SealAction(), num_workers=4,
+                             root_node=DbPath.create_root(db, snapshot_path))
+        if dump_tree(root_node) != dump_tree(root_node_db):
+            raise TestException('Mismatch between in-memory and database crawl')
+    finally:
+        db.close()
+    return root_node
 
 
 # pylint: disable=too-many-statements
 def run_test_for_snapshot_paths(snapshot_path, pool_files, backup_paths,
                                 num_expected_warnings, num_expected_sets,
-                                num_expected_files):
+                                num_expected_files, packing_strategy='binpacking'):
     snapshot_path = os.path.normpath(snapshot_path)
     backup_paths_unglobbed = tuple(map(os.path.normpath, backup_paths))
 
-    print('Cleaning work dir')
-    for item in os.listdir(WORK_PATH):
-        shutil.rmtree(os.path.join(WORK_PATH, item), ignore_errors=True)
-    print('Creating pool')
-    os.makedirs(POOL_PATH)
-    os.makedirs(SET_PATH)
+    print('Cleaning work dir, creating pool')
+    reset_work_path(POOL_PATH, SET_PATH)
     create_files(pool_files)
 
     subprocess.run(('sudo', 'rm', '-f', snapshot_path), check=True)
@@ -104,8 +89,8 @@ def run_test_for_snapshot_paths(snapshot_path, pool_files, backup_paths,
                             f', num_warnings={num_warnings}')
 
     set_writer = SetWriter(snapshot_path, SET_PATH, ZFS_POOL)
-    root_node = crawl(snapshot_path, backup_paths, SealAction())
-    root_node.create_backup_sets(set_writer, backup_paths)
+    root_node = crawl_and_compare(snapshot_path, backup_paths)
+    root_node.create_backup_sets(set_writer, backup_paths, packing_strategy)
 
     list_files = get_list_files(SET_PATH)
     if len(list_files) == 0:
@@ -187,13 +172,14 @@ def run_test_for_snapshot_paths(snapshot_path, pool_files, backup_paths,
 
 
 def run_test(pool_files, backup_paths, upload_limit, num_expected_warnings=None,
-             num_expected_sets=None, num_expected_files=None, is_fuzz_run=False):
+             num_expected_sets=None, num_expected_files=None, is_fuzz_run=False,
+             packing_strategy='binpacking'):
     Path.UPLOAD_LIMIT = upload_limit
     for snapshot_path in SNAPSHOT_PATHS:
         try:
             run_test_for_snapshot_paths(snapshot_path, pool_files, backup_paths,
                                         num_expected_warnings, num_expected_sets,
-                                        num_expected_files)
+                                        num_expected_files, packing_strategy)
         except:
             if is_fuzz_run:
                 i = 0
@@ -210,9 +196,12 @@ def run_test(pool_files, backup_paths, upload_limit, num_expected_warnings=None,
             raise
 
 
-# Letters: directories, numbers: files
-# Trailing slash means directory
-SIZE_SMALL = 10
+class CollectingSetWriter:
+    def __init__(self):
+        self.sets = []
+
+    def write_set(self, *args):
+        self.sets.append(args)
 
 
 def test_empty():
@@ -505,6 +494,426 @@ def test_no_match():
              num_expected_files=0)
 
 
+def test_glob_matches_pathlib():
+    pool_files = (
+        ('a/1', 0),
+        ('a/b/2', 0),
+        ('a/b/c/test.py', 0),
+        ('a/bc/test.py', 0),
+        ('a/.hidden/x', 0),
+        ('d/e/f/g', 0),
+        ('d/test.py', 0),
+        ('empty/', 0),
+        ('x', 0),
+    )
+
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+    os.symlink('a', os.path.join(POOL_PATH, 'link'))
+    os.symlink('missing', os.path.join(POOL_PATH, 'broken'))
+
+    def collapse(paths):
+        paths = set(paths)
+        return {path for path in paths
+                if not any(path.startswith(other + '/') or other == '.'
+                           for other in paths if other != path)}
+
+    patterns = ('**/?', 'a/**/test.py', '*', 'a', 'a/b', '**', 'a/**', '*/b*', 'link/b',
+                'link/*/c', 'broken', '[ad]/*/*', 'a/.hidden', 'xyz', '**/xyz',
+                '*/*/*/*/*')
+    base_path = pathlib.Path(POOL_PATH)
+    for num_patterns in range(1, 4):
+        for combination in itertools.combinations(patterns, num_patterns):
+            backup_paths, num_warnings = glob_backup_paths(combination, POOL_PATH)
+            expected = []
+            num_expected_warnings = 0
+            for pattern in combination:
+                paths = [os.fspath(path.relative_to(base_path))
+                         for path in base_path.glob(pattern)]
+                num_expected_warnings += len(paths) == 0
+                expected.extend(paths)
+            if len(backup_paths) != len(set(backup_paths)) or \
+                    set(backup_paths) != collapse(expected):
+                raise TestException(f'Mismatch for {combination}: {backup_paths}')
+            if num_warnings != num_expected_warnings:
+                raise TestException(f'Wrong number of warnings for {combination}')
+
+
+def test_no_backup_marker():
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    pool_files = (
+        ('a/1', SIZE_SMALL),
+        ('a/b/.NO_BACKUP', 0),
+        ('a/b/2', SIZE_SMALL),
+        ('a/bc/4', SIZE_SMALL),
+        ('a/c/d/.NO_BACKUP', 0),
+        ('a/c/3', SIZE_SMALL),
+    )
+
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+
+    root_node = crawl_and_compare(POOL_PATH, ('a',))
+    node = root_node.get_node(os.path.join(POOL_PATH, 'a'))
+    if set(node.dirs) != {'bc', 'c'} or set(node.dirs['c'].dirs) != set():
+        raise TestException(f'Excluded directories were crawled: {dump_tree(node)}')
+
+
+def test_sealed_marker(monkeypatch):
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    pool_files = (
+        ('a/1', SIZE_SMALL),
+        ('a/b/2', SIZE_SMALL),
+        ('a/c/.GDAB_SEALED', 0),  # Not a symlink, so not a marker
+        ('a/c/3', SIZE_SMALL),
+    )
+
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+    os.symlink('/', os.path.join(POOL_PATH, 'a/b/.GDAB_SEALED'))
+    if is_immutable(os.path.join(POOL_PATH, 'a/b')):
+        raise TestException('Directory reported as immutable')
+
+    monkeypatch.setenv('SEAL_ACTION', 'skip_sealed')
+    root_node = crawl(POOL_PATH, ('a',), SealAction())
+    node = root_node.get_node(os.path.join(POOL_PATH, 'a'))
+    if set(node.dirs) != {'c'} or node.dirs['c'].get_num_files() != 2:
+        raise TestException(f'Sealed directory was crawled: {dump_tree(node)}')
+
+
+def test_crawl_progress():
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    pool_files = (
+        ('a/1', SIZE_SMALL),
+        ('a/b/2', SIZE_SMALL),
+        ('a/b/c/3', SIZE_SMALL),
+    )
+
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+
+    stats_file = os.path.join(WORK_PATH, 'crawl_stats.jsonl')
+    with CrawlProgress(POOL_PATH, 0.001, stats_file=stats_file) as progress:
+        crawl(POOL_PATH, ('a',), SealAction(), progress=progress)
+    with open(stats_file, encoding='utf-8') as f:
+        stats = [json.loads(line) for line in f]
+    if not stats[-1]['final'] or stats[-1]['eta_sec'] is not None:
+        raise TestException(f'Wrong final stats {stats[-1]}')
+    if (stats[-1]['dirs'], stats[-1]['files'], stats[-1]['bytes'],
+            stats[-1]['max_depth']) != (3, 3, 3 * SIZE_SMALL, 3):
+        raise TestException(f'Wrong final stats {stats[-1]}')
+
+
+def test_path_files_compact():
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    root_node = MemoryPath('/snapshot', None)
+    node = root_node.get_dir('a')
+    node.add_files([('1', 1), ('2', 2)])
+    node.add_file('3', 3)
+    node.add_files([('1', 1), ('2', 2)])  # Path crawled twice
+    if sorted(node.files) != [('1', 1), ('2', 2), ('3', 3)]:
+        raise TestException(f'Wrong files {node.files}')
+
+    root_node_loaded = pickle.loads(pickle.dumps(root_node))
+    if dump_tree(root_node_loaded) != dump_tree(root_node):
+        raise TestException('Mismatch after pickling')
+    if root_node_loaded.get_size() != 6:
+        raise TestException(f'Wrong size {root_node_loaded.get_size()}')
+
+    for name in ('', '.', '..', 'b/c'):
+        with pytest.raises(BackupException):
+            node.add_file(name, 1)
+
+
+def test_backup_path_trie():
+    trie = BackupPathTrie(('a/b/c', 'a/b', 'd/e', 'f', 'f/g', 'h/i/j'))
+
+    def is_inside(path):
+        position = trie.root
+        for comp in path.split('/'):
+            position = trie.descend(position, comp)
+        return trie.is_inside(position)
+
+    for path in ('a/b', 'a/b/c', 'a/b/x', 'd/e', 'd/e/x/y', 'f', 'f/g', 'h/i/j'):
+        if not is_inside(path):
+            raise TestException(f'{path} should be inside')
+    for path in ('a', 'a/bc', 'd', 'd/ee', 'ff', 'h/i', 'x', 'x/a/b'):
+        if is_inside(path):
+            raise TestException(f'{path} should not be inside')
+
+
+def test_hardlinks():
+    pool_files = (
+        ('a/1', SIZE_SMALL),
+        ('a/b/', 0),
+        ('c/', 0),
+        ('d/2', SIZE_SMALL),
+        ('d/e/', 0),
+    )
+    backup_paths = ('a', 'c', 'd')
+    Path.UPLOAD_LIMIT = SIZE_SMALL * 3 // 2
+
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+    for target, link in (('a/1', 'a/b/1'), ('a/1', 'c/1'), ('d/2', 'd/e/2')):
+        os.link(os.path.join(POOL_PATH, target), os.path.join(POOL_PATH, link))
+
+    # Sized once per inode, all links to an inode are in the same set
+    root_node = crawl_and_compare(POOL_PATH, backup_paths)
+    if root_node.get_size() != 2 * SIZE_SMALL:
+        raise TestException(f'Wrong size {root_node.get_size()}')
+    set_writer = CollectingSetWriter()
+    root_node.create_backup_sets(set_writer, backup_paths)
+    sets = sorted(sorted(os.path.relpath(path, POOL_PATH) for path in set_[2])
+                  for set_ in set_writer.sets)
+    sizes = {set_[3] for set_ in set_writer.sets}
+    if sets != [['a', 'c'], ['d']] or sizes != {SIZE_SMALL}:
+        raise TestException(f'Wrong sets {set_writer.sets}')
+    num_files = sum(set_[5] for set_ in set_writer.sets)
+    if num_files != 5:
+        raise TestException(f'Wrong number of files {num_files}')
+
+
+def test_sparse_file():
+    # Only the data is sized, the file fits although its length exceeds the limit
+    pool_files = (
+        ('a/1', SIZE_SMALL),
+        ('a/vm.img', (16 * 1024 * 1024, 100)),
+    )
+    upload_limit = 1024 * 1024
+    run_test(pool_files, ('a',), upload_limit, num_expected_sets=1,
+             num_expected_files=2)
+
+    root_node = crawl_and_compare(POOL_PATH, ('a',))
+    size = dict(root_node.get_node(os.path.join(POOL_PATH, 'a')).files)['vm.img']
+    if not 100 <= size < upload_limit:
+        raise TestException(f'Wrong size of sparse file {size}')
+
+    # A file compressed by the file system is not scanned for holes
+    if is_sparse_candidate(16 * 1024 * 1024, 16 * 1024 * 1024 // 512 // 3):
+        raise TestException('Compressed file considered sparse')
+
+
+def test_locality_packing():
+    pool_files = (
+        ('a/1', SIZE_SMALL),
+        ('a/2', SIZE_SMALL),
+        ('a/3', SIZE_SMALL),
+        ('b/4', SIZE_SMALL),
+        ('b/5', SIZE_SMALL),
+        ('c/6', SIZE_SMALL),
+    )
+    upload_limit = SIZE_SMALL * 4
+    run_test(pool_files, ('a', 'b', 'c'), upload_limit, num_expected_sets=2,
+             num_expected_files=6, packing_strategy='locality')
+
+    # Sets follow the crawl order and are filled up by splitting directories
+    root_node = crawl(POOL_PATH, ('a', 'b', 'c'), SealAction())
+    set_writer = CollectingSetWriter()
+    root_node.create_backup_sets(set_writer, ('a', 'b', 'c'), 'locality')
+    paths = [os.path.relpath(path, POOL_PATH)
+             for set_ in set_writer.sets for path in set_[2]]
+    dir_order = list(root_node.dirs)
+    if sorted(paths, key=lambda path: dir_order.index(path.split('/')[0])) != paths:
+        raise TestException(f'Sets not in crawl order: {paths}')
+    if [set_[3] for set_ in set_writer.sets] != [upload_limit, SIZE_SMALL * 2]:
+        raise TestException(f'Wrong set sizes: {set_writer.sets}')
+
+    # A unit heavier than the limit gets a set of its own, also as the first unit
+    units = [([(name, weight, ITEM_FILE, None, weight)], weight, weight)
+             for name, weight in (('1', upload_limit + 1), ('2', 1),
+                                  ('3', upload_limit + 1))]
+    bins = Path._pack_locality(units, None)  # pylint: disable=protected-access
+    if [[unit[0][0][0] for unit in bin_] for bin_ in bins] != [['1'], ['2'], ['3']]:
+        raise TestException(f'Wrong bins: {bins}')
+
+
+def test_compression_aware_sizing():
+    reset_work_path(POOL_PATH)
+    create_files((('a/', 0), ('b/5.bin', 1000)))
+    for index in range(4):
+        with open(os.path.join(POOL_PATH, 'a', f'{index}.txt'), 'w',
+                  encoding='utf-8') as f:
+            f.write('compressible ' * 77)
+    Path.UPLOAD_LIMIT = 1001
+
+    # The text files fit into one set, the random data does not compress
+    root_node = crawl(POOL_PATH, ('a', 'b'), SealAction())
+    estimator = CompressionEstimator(1.25)
+    set_writer = CollectingSetWriter()
+    root_node.create_backup_sets(set_writer, ('a', 'b'), estimator=estimator)
+    sets = sorted((os.path.relpath(set_[2][0], POOL_PATH), set_[3], set_[6])
+                  for set_ in set_writer.sets)
+    if [set_[:2] for set_ in sets] != [('a', 4 * 1001), ('b', 1000)]:
+        raise TestException(f'Wrong sets {sets}')
+    if not sets[0][2] < 1001 / 2 or sets[1][2] != 1000:
+        raise TestException(f'Wrong predicted sizes {sets}')
+
+
+def test_mixed_directory():
+    reset_work_path(POOL_PATH, SET_PATH)
+    # A sidecar file stays with the photos, a larger minority is split off
+    create_files([(f'a/{index}.jpg', 1000) for index in range(5)]
+                 + [('b/thumb.jpg', 1000)])
+    for path in ('a/photo.xmp', 'b/0.txt', 'b/1.txt', 'b/2.txt'):
+        with open(os.path.join(POOL_PATH, path), 'w', encoding='utf-8') as f:
+            f.write('compressible ' * (4 if path.endswith('.xmp') else 77))
+
+    Path.UPLOAD_LIMIT = 10**6
+    root_node = crawl(POOL_PATH, ('a', 'b'), SealAction())
+    set_writer = CollectingSetWriter()
+    root_node.create_backup_sets(set_writer, ('a', 'b'),
+                                 classifier=CompressionEstimator(1.0))
+    sets = sorted((sorted(os.path.relpath(path, POOL_PATH)
+                          for path in set_[2]), set_[8])
+                  for set_ in set_writer.sets)
+    expected_sets = [(['a', 'b/thumb.jpg'], True),
+                     (['b/0.txt', 'b/1.txt', 'b/2.txt'], False)]
+    if sets != expected_sets:
+        raise TestException(f'Wrong sets {sets}')
+
+
+def test_split_large_files(monkeypatch):
+    monkeypatch.setattr(Path, 'SPLIT_LARGE_FILES', True)
+    pool_files = (
+        ('a/1', SIZE_SMALL * 2 + 5),
+        ('a/2', 5),
+        ('b/3', 3),
+    )
+
+    # Parts of 10, 10 and 5 bytes, extract_archive joins them into a/1 again
+    run_test(pool_files, ('a', 'b'), SIZE_SMALL, num_expected_sets=4,
+             num_expected_files=3)
+
+
+def test_split_sparse_file(monkeypatch):
+    # The data exceeds the limit, the parts cover the full length including holes
+    monkeypatch.setattr(Path, 'SPLIT_LARGE_FILES', True)
+    pool_files = (('a/vm.img', (16 * 1024 * 1024, 1536 * 1024)),)
+    run_test(pool_files, ('a',), 1024 * 1024, num_expected_sets=16,
+             num_expected_files=1)
+
+
+def test_set_fingerprint():
+    reset_work_path(POOL_PATH, SET_PATH)
+    create_files((('a/1', SIZE_SMALL), ('a/b/2', SIZE_SMALL), ('c/3', SIZE_SMALL),
+                  ('a/.NO_BACKUP/4', SIZE_SMALL)))
+    items = [os.path.join(POOL_PATH, 'a'), os.path.join(POOL_PATH, 'c', '3')]
+    file_path = os.path.join(POOL_PATH, 'a', 'b', '2')
+    st = os.stat(file_path)
+
+    fingerprint = get_set_fingerprint(POOL_PATH, items, ())
+    if get_set_fingerprint(POOL_PATH, list(reversed(items)), ()) != fingerprint:
+        raise TestException('Fingerprint depends on item order')
+    os.utime(file_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    if get_set_fingerprint(POOL_PATH, items, ()) == fingerprint:
+        raise TestException('Fingerprint misses a modified file')
+    os.utime(file_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    if get_set_fingerprint(POOL_PATH, items, ()) != fingerprint:
+        raise TestException('Fingerprint not reproducible')
+    os.utime(os.path.join(POOL_PATH, 'a', '.NO_BACKUP', '4'), ns=(0, 0))
+    if get_set_fingerprint(POOL_PATH, items, ()) != fingerprint:
+        raise TestException('Fingerprint covers content excluded from the archive')
+
+    set_writer = SetWriter(POOL_PATH, SET_PATH, ZFS_POOL, fingerprint=True)
+    set_writer.write_set(0, 1, items, 3 * SIZE_SMALL, 2, 3)
+    manifest = SetManifest(SET_PATH)
+    try:
+        if manifest.get_info('tank_000').get('fingerprint') != fingerprint:
+            raise TestException('Fingerprint not written to set info')
+    finally:
+        manifest.close()
+
+
+def test_set_manifest():
+    reset_work_path(POOL_PATH, SET_PATH)
+    create_files((('a/1', SIZE_SMALL), ('b/2', SIZE_SMALL)))
+
+    # Sets with the same name get the next free index
+    set_writer = SetWriter(POOL_PATH, SET_PATH, ZFS_POOL)
+    for index in range(3):
+        set_writer.write_set(index, 3, [os.path.join(POOL_PATH, 'a', '1')],
+                             SIZE_SMALL * (index + 1), 0, 1)
+    set_writer.write_set(0, 1, [os.path.join(POOL_PATH, 'b')], SIZE_SMALL, 1, 1)
+    list_files = get_list_files(SET_PATH)
+    names = [os.path.basename(list_file) for list_file in list_files]
+    if names != ['tank_a_1_000.list', 'tank_a_1_001.list', 'tank_a_1_002.list',
+                 'tank_b_000.list']:
+        raise TestException(f'Wrong list files {names}')
+
+    manifest = SetManifest(SET_PATH)
+    try:
+        if manifest.get_pending_size() != SIZE_SMALL * 7:
+            raise TestException(f'Wrong pending size {manifest.get_pending_size()}')
+        manifest.set_status('tank_a_1_001', SET_UPLOADED)
+        if (manifest.get_pending_size() != SIZE_SMALL * 5
+                or 'tank_a_1_001' in manifest.get_pending()):
+            raise TestException('Uploaded set still pending')
+        info = manifest.get_info('tank_b_000')
+        counts = (info['size_bytes'], info['num_dirs'], info['num_files'])
+        if counts != (SIZE_SMALL, 1, 1):
+            raise TestException(f'Wrong set info {info}')
+    finally:
+        manifest.close()
+
+
+def test_deep_tree_stats():
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    depth = 3 * sys.getrecursionlimit()
+    root_node = MemoryPath('/snapshot', None)
+    node = root_node
+    for _ in range(depth):
+        node = node.get_dir('a')
+        node.add_file('1', 1)
+    if root_node.get_num_dirs_files() != (depth + 1, depth):
+        raise TestException(f'Wrong stats {root_node.get_num_dirs_files()}')
+    if node.get_full_path() != os.path.join('/snapshot', *(['a'] * depth)):
+        raise TestException('Wrong path')
+
+    set_writer = CollectingSetWriter()
+    root_node.create_backup_sets(set_writer, ('a',))
+    num_files = sum(set_[5] for set_ in set_writer.sets)
+    if len(set_writer.sets) != depth // SIZE_SMALL or num_files != depth:
+        raise TestException(f'Wrong sets: {len(set_writer.sets)}, {num_files}')
+
+
+def test_state_backends_create_same_sets():
+    pool_files = (
+        ('1', SIZE_SMALL),
+        ('a/2', SIZE_SMALL),
+        ('a/b/3', SIZE_SMALL),
+        ('a/b/4', SIZE_SMALL),
+        ('a/c/5', SIZE_SMALL * 2),
+        ('d/', 0),
+        # Not valid UTF-8
+        (os.path.join('d', os.fsdecode(b'caf\xe9.txt')), SIZE_SMALL),
+    )
+    backup_paths = ('1', 'a', 'd')
+    Path.UPLOAD_LIMIT = SIZE_SMALL * 2
+
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+
+    # Also with the sizes estimated per node
+    for estimated in (False, True):
+        sets = {}
+        for state_backend in ('pickle', 'sqlite'):
+            estimator = CompressionEstimator(1.25) if estimated else None
+            set_path = os.path.join(WORK_PATH, f'sets_{state_backend}')
+            shutil.rmtree(set_path, ignore_errors=True)
+            os.makedirs(set_path)
+            crawl_and_write(POOL_PATH, backup_paths, SealAction(), STATE_DB_PATH,
+                            state_backend=state_backend)
+            load(STATE_DB_PATH, SetWriter(POOL_PATH, set_path, ZFS_POOL), backup_paths,
+                 estimator=estimator, classifier=estimator)
+            sets[state_backend] = {}
+            for list_file in get_list_files(set_path):
+                with open(list_file, 'rt') as f:
+                    sets[state_backend][os.path.basename(list_file)] = f.read()
+        if len(sets['pickle']) == 0 or sets['pickle'] != sets['sqlite']:
+            raise TestException(f'Sets differ: {sets}')
+
+
 def do_test_fuzz():
     MAX_FILES = 1000
     MAX_FILE_LENGTH = 40
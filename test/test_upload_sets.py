@@ -0,0 +1,500 @@
+import json
+import os
+import queue
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from common import (POOL_PATH, SCRIPT_PATH, SET_PATH, SIZE_SMALL, WORK_PATH, ZFS_POOL,
+                    TestException, create_files, reset_work_path, run_cmd, thread_pool)
+from impl.archive_codec import (CODEC_MANIFEST_SUFFIX, DEFAULT_CODEC,
+                                get_codec_manifest_name, write_codec_manifest)
+from impl.compression_controller import (DEFAULT_STEP, CompressionController,
+                                         apply_settings)
+from impl import compression_estimate
+from impl.compression_estimate import DEFAULT_TYPE, CompressionEstimator
+from impl.crawl_tree import Path
+from impl.crawler import crawl
+from impl.create_sets import SetWriter
+from impl.s3_client import S3Client
+from impl.set_manifest import SetManifest
+from impl.tools import SealAction
+from impl.upload_sets import (CommandOutput, SetIndex, Uploader, archiver,
+                              build_archive, build_set, clean_buffer, get_list_files,
+                              package_and_upload)
+
+
+class CopyingUploader:
+    '''Stands in for Uploader, copies the files to bucket_path.'''
+    def __init__(self, bucket_path):
+        self.bucket_path = bucket_path
+        os.makedirs(bucket_path, exist_ok=True)
+
+    def get_key(self, archive_name):
+        return os.path.join(self.bucket_path, archive_name)
+
+    def exists(self, key):
+        return os.path.exists(key)
+
+    def upload(self, file_, archive_name, deep_archive):  # pylint: disable=unused-argument
+        shutil.copy(file_, self.get_key(archive_name))
+        return 0
+
+    def upload_stream(self, source_cmd, archive_name, expected_size_bytes):  # pylint: disable=unused-argument
+        with CommandOutput(source_cmd) as stream, \
+                open(self.get_key(archive_name), 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        return 0, stream.num_bytes
+
+
+def get_uploaded_archives(bucket_path):
+    '''Returns the names of the archives of the sets, without contents archives and
+    codec manifests.'''
+    return sorted(name for name in os.listdir(bucket_path)
+                  if '_contents.tar' not in name
+                  and not name.endswith(CODEC_MANIFEST_SUFFIX))
+
+
+def test_compression_estimate_rare_types(monkeypatch):
+    # Only the type with the most data is sampled on its own, the others share the
+    # default type
+    monkeypatch.setattr(compression_estimate, 'MAX_SAMPLED_TYPES', 1)
+    Path.UPLOAD_LIMIT = 10**6
+    reset_work_path(POOL_PATH)
+    create_files((('a/0.bin', 2000), ('a/1.x', 100), ('a/2.y', 100)))
+    with open(os.path.join(POOL_PATH, 'a', '3.txt'), 'w', encoding='utf-8') as f:
+        f.write('compressible ' * 77)
+
+    root_node = crawl(POOL_PATH, ('a',), SealAction())
+    estimator = CompressionEstimator(1.0)
+    estimator.sample(root_node)
+    if sorted(estimator.factors) != [DEFAULT_TYPE, '.bin']:
+        raise TestException(f'Wrong sampled types {estimator.factors}')
+    if (estimator.get_size('b/4.txt', 1000) != estimator.get_size('b/5.z', 1000)
+            or estimator.is_incompressible('b/4.txt')
+            or not estimator.is_incompressible('b/6.bin')):
+        raise TestException(f'Wrong estimate {estimator.factors}')
+
+
+def test_separate_incompressible():
+    backup_paths = ('a', 'b')
+    extract_archive_path = os.path.join(SCRIPT_PATH, '..', 'extract_archive')
+    Path.UPLOAD_LIMIT = 10**6
+    for streaming in (False, True):
+        buffer_path = os.path.join(WORK_PATH, 'buffer')
+        reset_work_path(POOL_PATH, SET_PATH, buffer_path)
+        # By extension and by compressing a sample
+        create_files((('a/photo.jpg', 1000), ('b/random.bin', 5000)))
+        for index in range(3):
+            with open(os.path.join(POOL_PATH, 'a', f'{index}.txt'), 'w',
+                      encoding='utf-8') as f:
+                f.write('compressible ' * 77)
+
+        root_node = crawl(POOL_PATH, backup_paths, SealAction())
+        root_node.create_backup_sets(SetWriter(POOL_PATH, SET_PATH, ZFS_POOL),
+                                     backup_paths, classifier=CompressionEstimator(1.0))
+        manifest = SetManifest(SET_PATH)
+        try:
+            store_only = sorted((manifest.get_info(name)['num_files'],
+                                 manifest.get_info(name).get('store_only', False))
+                                for name in manifest.get_pending())
+            if store_only != [(2, True), (3, False)]:
+                raise TestException(f'Wrong sets {store_only}')
+            uploader = CopyingUploader(os.path.join(WORK_PATH, 'bucket'))
+            set_index = SetIndex(os.path.join(WORK_PATH, 'set_index.json'))
+            num_errors = package_and_upload(POOL_PATH, SET_PATH, manifest, buffer_path,
+                                            uploader, (), set_index,
+                                            streaming=streaming)
+            if num_errors != 0 or manifest.get_pending():
+                raise TestException(f'Upload failed: {manifest.get_pending()}')
+        finally:
+            manifest.close()
+
+        archives = get_uploaded_archives(uploader.bucket_path)
+        if sorted(name.endswith('.tar.gpg') for name in archives) != [False, True]:
+            raise TestException(f'Wrong archives {archives}')
+        # The contents archives are built with the codec of their set
+        contents_archives = sorted(name for name in os.listdir(uploader.bucket_path)
+                                   if '_contents.tar' in name)
+        if contents_archives != sorted(name.replace('.tar', '.list_contents.tar', 1)
+                                       for name in archives):
+            raise TestException(f'Wrong contents archives {contents_archives}')
+        extract_path = os.path.join(WORK_PATH, 'extract')
+        os.makedirs(extract_path)
+        for name in archives:
+            archive_path = os.path.join(uploader.bucket_path, name)
+            run_cmd((extract_archive_path, archive_path, extract_path))
+        for backup_path in backup_paths:
+            run_cmd(('diff', '-r', os.path.join(POOL_PATH, backup_path),
+                     os.path.join(extract_path, backup_path)))
+
+
+def test_parallel_archive_builders():
+    pool_files = tuple((f'{name}/1', SIZE_SMALL) for name in 'abcd')
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    buffer_path = os.path.join(WORK_PATH, 'buffer')
+    reset_work_path(POOL_PATH, SET_PATH, buffer_path)
+    create_files(pool_files)
+
+    root_node = crawl(POOL_PATH, tuple('abcd'), SealAction())
+    root_node.create_backup_sets(SetWriter(POOL_PATH, SET_PATH, ZFS_POOL),
+                                 tuple('abcd'))
+    list_files = get_list_files(SET_PATH)
+
+    # Without buffer space for more, an archive is only built once the previous one
+    # has been consumed, as upload deletes it
+    for set_size in (SIZE_SMALL, 2**60):
+        archive_queue = queue.Queue()
+        set_sizes = {list_file: set_size for list_file in list_files}
+        future = thread_pool.submit(archiver, archive_queue, POOL_PATH, list_files,
+                                    set_sizes, buffer_path, (), 3)
+        archives = []
+        while (result := archive_queue.get()) not in (True, False):
+            archives.append(result)
+            if os.path.getsize(result[2]) != result[4]:
+                raise TestException(f'Wrong archive size {result}')
+            for file_ in (result[2], result[6], result[8]):
+                os.unlink(file_)
+        future.result()
+        archived_list_files = sorted(archive[0] for archive in archives)
+        if result is not True or archived_list_files != list_files:
+            raise TestException(f'Wrong archiver results {result}, {archives}')
+
+    # A failure outside of the builds still ends the queue
+    archive_queue = queue.Queue()
+    future = thread_pool.submit(archiver, archive_queue, POOL_PATH, list_files, {},
+                                buffer_path, (), 3)
+    result = archive_queue.get(timeout=60)
+    if result is not False or not isinstance(future.exception(), KeyError):
+        raise TestException('Archiver did not report its failure')
+
+
+def test_concurrent_uploads():
+    pool_files = tuple((f'{name}/1', SIZE_SMALL) for name in 'abcde')
+    backup_paths = tuple('abcde')
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    buffer_path = os.path.join(WORK_PATH, 'buffer')
+    reset_work_path(POOL_PATH, SET_PATH, buffer_path)
+    create_files(pool_files)
+
+    root_node = crawl(POOL_PATH, backup_paths, SealAction())
+    root_node.create_backup_sets(SetWriter(POOL_PATH, SET_PATH, ZFS_POOL, True),
+                                 backup_paths)
+    list_files = get_list_files(SET_PATH)
+    uploader = CopyingUploader(os.path.join(WORK_PATH, 'bucket'))
+    set_index = SetIndex(os.path.join(WORK_PATH, 'set_index.json'))
+    manifest = SetManifest(SET_PATH)
+    try:
+        num_errors = package_and_upload(POOL_PATH, SET_PATH, manifest, buffer_path,
+                                        uploader, (), set_index, 2, 3)
+        if num_errors != 0 or manifest.get_pending():
+            raise TestException(f'Upload failed: {manifest.get_pending()}')
+    finally:
+        manifest.close()
+    if any(os.path.exists(list_file) for list_file in list_files):
+        raise TestException('List files not removed after upload')
+    if os.listdir(buffer_path):
+        raise TestException(f'Buffer not cleaned up: {os.listdir(buffer_path)}')
+    archives = get_uploaded_archives(uploader.bucket_path)
+    if len(archives) != len(list_files) or len(set_index.keys) != len(list_files):
+        raise TestException(f'Wrong archives uploaded: {archives}')
+
+
+def test_reuse_unchanged_sets():
+    backup_paths = ('a', 'b')
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    buffer_path = os.path.join(WORK_PATH, 'buffer')
+    reset_work_path(POOL_PATH, buffer_path)
+    create_files((('a/1', SIZE_SMALL), ('b/1', SIZE_SMALL)))
+    root_node = crawl(POOL_PATH, backup_paths, SealAction())
+    index_file = os.path.join(WORK_PATH, 'set_index.json')
+    passphrase_file = os.path.join(WORK_PATH, 'passphrase.txt')
+    bucket_paths = []
+
+    def upload(scope, passphrase='secret', codec=None):
+        '''Returns the number of sets referencing an earlier archive.'''
+        shutil.rmtree(SET_PATH, ignore_errors=True)
+        os.makedirs(SET_PATH)
+        root_node.create_backup_sets(SetWriter(POOL_PATH, SET_PATH, ZFS_POOL, True),
+                                     backup_paths)
+        with open(passphrase_file, 'wt', encoding='utf-8') as f:
+            f.write(passphrase)
+        bucket_paths.append(os.path.join(WORK_PATH, 'bucket', scope,
+                                         str(len(bucket_paths))))
+        manifest = SetManifest(SET_PATH)
+        try:
+            num_errors = package_and_upload(
+                POOL_PATH, SET_PATH, manifest, buffer_path,
+                CopyingUploader(bucket_paths[-1]), (),
+                SetIndex(index_file, scope, passphrase_file), codec=codec)
+            if num_errors != 0 or manifest.get_pending():
+                raise TestException(f'Upload failed: {manifest.get_pending()}')
+            return len(manifest.get_references())
+        finally:
+            manifest.close()
+
+    # Only archives of the same bucket dir, codec and passphrase are referenced
+    num_referenced = (upload('x'), upload('x'), upload('y'), upload('x', 'other'),
+                      upload('x', codec=dict(DEFAULT_CODEC, compressor='gzip')))
+    if num_referenced != (0, 2, 0, 0, 0):
+        raise TestException(f'Wrong number of referenced sets: {num_referenced}')
+
+
+def test_streaming_upload():
+    pool_files = (('a/1', SIZE_SMALL), ('a/2', 5), ('b/1', SIZE_SMALL))
+    backup_paths = ('a', 'b')
+    Path.UPLOAD_LIMIT = SIZE_SMALL
+    buffer_path = os.path.join(WORK_PATH, 'buffer')
+    reset_work_path(POOL_PATH, SET_PATH, buffer_path)
+    create_files(pool_files)
+
+    root_node = crawl(POOL_PATH, backup_paths, SealAction())
+    root_node.create_backup_sets(SetWriter(POOL_PATH, SET_PATH, ZFS_POOL), backup_paths)
+    uploader = CopyingUploader(os.path.join(WORK_PATH, 'bucket'))
+    set_index = SetIndex(os.path.join(WORK_PATH, 'set_index.json'))
+    manifest = SetManifest(SET_PATH)
+    try:
+        num_errors = package_and_upload(POOL_PATH, SET_PATH, manifest, buffer_path,
+                                        uploader, (), set_index, 1, 2, streaming=True)
+        if num_errors != 0 or manifest.get_pending():
+            raise TestException(f'Upload failed: {manifest.get_pending()}')
+    finally:
+        manifest.close()
+    if os.listdir(buffer_path):
+        raise TestException(f'Buffer not cleaned up: {os.listdir(buffer_path)}')
+
+    extract_path = os.path.join(WORK_PATH, 'extract')
+    os.makedirs(extract_path)
+    extract_archive_path = os.path.join(SCRIPT_PATH, '..', 'extract_archive')
+    for name in get_uploaded_archives(uploader.bucket_path):
+        archive_path = os.path.join(uploader.bucket_path, name)
+        run_cmd((extract_archive_path, archive_path, extract_path))
+    for backup_path in backup_paths:
+        run_cmd(('diff', '-r', os.path.join(POOL_PATH, backup_path),
+                 os.path.join(extract_path, backup_path)))
+
+    # The end of the output of a failed build must not complete the upload
+    with pytest.raises(subprocess.CalledProcessError):
+        with CommandOutput(('sh', '-c', 'echo partial; exit 1')) as stream:
+            stream.read()
+            stream.read()
+
+
+def test_s3_client(monkeypatch):
+    moto = pytest.importorskip('moto')
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    reset_work_path()
+    file_ = os.path.join(WORK_PATH, 'file')
+    data = random.randbytes(12 * 1024 * 1024)
+    with open(file_, 'wb') as f:
+        f.write(data)
+
+    with moto.mock_aws():
+        s3_client = S3Client('gdab-test', chunk_size_bytes=5 * 1024 * 1024)
+        s3_client.client.create_bucket(Bucket='gdab-test')
+        if not s3_client.is_reachable() or s3_client.exists('backup/file'):
+            raise TestException('Wrong state of empty bucket')
+
+        # Multipart uploads of a file and of a stream
+        s3_client.upload_file(file_, 'backup/file', 'DEEP_ARCHIVE')
+        with CommandOutput(('cat', file_)) as stream:
+            s3_client.upload_stream(stream, 'backup/stream', len(data))
+        if (s3_client.get_object('backup/stream') != data
+                or s3_client.get_object('backup/missing') is not None):
+            raise TestException('Wrong objects read')
+        objects = sorted((object_['Key'], object_['Size'], object_['StorageClass'])
+                         for object_ in s3_client.list_objects('backup'))
+        if objects != [('backup/file', len(data), 'DEEP_ARCHIVE'),
+                       ('backup/stream', len(data), 'STANDARD')]:
+            raise TestException(f'Wrong objects listed: {objects}')
+        s3_client.download_file('backup/stream', f'{file_}.downloaded')
+        run_cmd(('cmp', file_, f'{file_}.downloaded'))
+
+        with Uploader('gdab-test', 'backup/', 'ts') as uploader:
+            uploader.upload(file_, 'archive', deep_archive=False)
+            _, size = uploader.upload_stream(('cat', file_), 'streamed', len(data))
+            s3_client.client.create_multipart_upload(Bucket='gdab-test', Key='partial')
+        if (size != len(data) or not uploader.exists('backup/ts/archive')
+                or not uploader.exists(uploader.get_key('streamed'))):
+            raise TestException('Uploader did not upload')
+        # Cleaned up on exit of the uploader
+        if list(s3_client.list_multipart_uploads()):
+            raise TestException('Multipart uploads not aborted')
+
+
+def test_resumable_upload(monkeypatch):
+    moto = pytest.importorskip('moto')
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    monkeypatch.setenv('S3_MULTIPART_CHUNK_MB', '5')
+    monkeypatch.setenv('S3_MAX_CONCURRENCY', '1')
+    upload_state_path = os.path.join(WORK_PATH, 'uploads')
+    reset_work_path(upload_state_path)
+    file_ = os.path.join(WORK_PATH, 'archive')
+    data = random.randbytes(17 * 1024 * 1024)
+    with open(file_, 'wb') as f:
+        f.write(data)
+
+    with moto.mock_aws():
+        with Uploader('gdab-resume', '', 'ts', upload_state_path) as uploader:
+            client = uploader.s3_client.client
+            client.create_bucket(Bucket='gdab-resume')
+            upload_part = client.upload_part
+            part_numbers = []
+
+            def failing_upload_part(**kwargs):
+                if len(part_numbers) == 2:
+                    raise TestException('Connection lost')
+                part_numbers.append(kwargs['PartNumber'])
+                return upload_part(**kwargs)
+
+            monkeypatch.setattr(client, 'upload_part', failing_upload_part)
+            with pytest.raises(TestException):
+                uploader.upload(file_, 'archive', deep_archive=False)
+            if not uploader.is_resumable('archive'):
+                raise TestException('Failed upload not resumable')
+        # Kept on exit of the uploader
+        if len(list(uploader.s3_client.list_multipart_uploads())) != 1:
+            raise TestException('Multipart upload of failed upload not kept')
+
+        part_numbers.clear()
+        monkeypatch.setattr(client, 'upload_part',
+                            lambda **kwargs: part_numbers.append(kwargs['PartNumber'])
+                            or upload_part(**kwargs))
+        with Uploader('gdab-resume', '', 'ts', upload_state_path) as uploader:
+            uploader.upload(file_, 'archive', deep_archive=False)
+        if part_numbers != [3, 4] or os.listdir(upload_state_path):
+            raise TestException(f'Upload not resumed: {part_numbers}')
+        if uploader.s3_client.get_object('ts/archive') != data:
+            raise TestException('Resumed upload differs')
+
+
+def test_resume_kept_archive():
+    buffer_path = os.path.join(WORK_PATH, 'buffer')
+    upload_state_path = os.path.join(WORK_PATH, 'uploads')
+    reset_work_path(POOL_PATH, buffer_path, upload_state_path)
+    create_files((('a/1', 1000),))
+    list_file = os.path.join(WORK_PATH, 'a.list')
+    with open(list_file, 'wt') as f:
+        print('a', file=f)
+
+    codec = dict(DEFAULT_CODEC, level=5)
+    (archive_name, archive_file, _, list_list_filepath, _, contents_archive_file,
+     built_codec) = build_set(POOL_PATH, list_file, buffer_path, (), codec=codec)
+    codec_manifest_name = get_codec_manifest_name(archive_name)
+    with open(os.path.join(buffer_path, codec_manifest_name), 'rt') as f:
+        if built_codec != codec or json.load(f) != codec:
+            raise TestException(f'Wrong codec {built_codec}')
+    # Upload failed resumably
+    with open(os.path.join(upload_state_path, f'{archive_name}.json'), 'wt') as f:
+        json.dump({}, f)
+    clean_buffer(buffer_path, upload_state_path)
+    if sorted(os.listdir(buffer_path)) != sorted((archive_name, codec_manifest_name)):
+        raise TestException(f'Wrong files kept {os.listdir(buffer_path)}')
+    if any(map(os.path.exists, (list_list_filepath, contents_archive_file))):
+        raise TestException('Contents archive kept')
+
+    # Reused with the codec it was built with, not the current one
+    mtime = os.path.getmtime(archive_file)
+    result = build_set(POOL_PATH, list_file, buffer_path, (),
+                       codec=dict(DEFAULT_CODEC, level=19))
+    if result[1] != archive_file or os.path.getmtime(archive_file) != mtime:
+        raise TestException(f'Kept archive not reused {result}')
+    if result[6] != codec:
+        raise TestException(f'Wrong codec of kept archive {result[6]}')
+    for file_ in (result[3], result[5]):
+        os.unlink(file_)
+
+    # The adaptive compression does not learn from reusing it
+    class RecordingController(CompressionController):
+        def __init__(self):
+            super().__init__(1, 1)
+            self.builds = []
+
+        def add_build(self, settings, archive_size_bytes, duration_sec):
+            self.builds.append(settings)
+            super().add_build(settings, archive_size_bytes, duration_sec)
+
+    controller = RecordingController()
+    archive_queue = queue.Queue()
+    archiver(archive_queue, POOL_PATH, [list_file], {list_file: 2**60}, buffer_path, (),
+             1, controller=controller)
+    result = archive_queue.get()
+    if archive_queue.get() is not True or result[9] != codec or controller.builds:
+        raise TestException(f'Kept archive not reused {result}, {controller.builds}')
+
+
+def test_compression_controller():
+    controller = CompressionController(num_builders=1, num_uploaders=1)
+    first_settings = controller.get_settings()
+    # Uploads are the bottleneck, one step stronger per build with the latest settings
+    controller.add_upload(10, 1.0)
+    for _ in range(3):
+        controller.add_build(first_settings, 100, 1.0)
+    settings = controller.get_settings()
+    controller.add_build(settings, 100, 1.0)
+    if controller.step != DEFAULT_STEP + 2:
+        raise TestException(f'Wrong step {controller.step} for slow uploads')
+    # Builds are the bottleneck
+    for _ in range(4):
+        controller.add_build(controller.get_settings(), 1, 1.0)
+    if controller.step != 0:
+        raise TestException(f'Wrong step {controller.step} for slow builds')
+
+    # Archives of the strongest settings are extracted as all others
+    pool_files = (('a/1', 1000), ('a/2', (10**6, 1000)))
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+    list_file = os.path.join(WORK_PATH, 'a.list')
+    with open(list_file, 'wt') as f:
+        print('a', file=f)
+    codec = apply_settings(DEFAULT_CODEC, (19, 2, True))
+    _, archive_file = build_archive(POOL_PATH, list_file, WORK_PATH, codec=codec)
+    extract_path = os.path.join(WORK_PATH, 'extract')
+    os.makedirs(extract_path)
+    extract_archive_path = os.path.join(SCRIPT_PATH, '..', 'extract_archive')
+    run_cmd((extract_archive_path, archive_file, extract_path))
+    run_cmd(('diff', '-r', f'{POOL_PATH}/a', f'{extract_path}/a'))
+
+
+def test_archive_codecs():
+    pool_files = (('a/1', 1000), ('a/2', (10**6, 1000)))
+    reset_work_path(POOL_PATH)
+    create_files(pool_files)
+    with open(os.path.join(POOL_PATH, 'a', '3.txt'), 'w', encoding='utf-8') as f:
+        f.write('compressible ' * 1000)
+    list_file = os.path.join(WORK_PATH, 'a.list')
+    with open(list_file, 'wt') as f:
+        print('a', file=f)
+    extract_archive_path = os.path.join(SCRIPT_PATH, '..', 'extract_archive')
+
+    codecs = (({}, '.tar.zstd.gpg'),
+              ({'compressor': 'gzip', 'level': 1}, '.tar.gz.gpg'),
+              ({'compressor': 'xz', 'threads': 2}, '.tar.xz.gpg'),
+              ({'compressor': 'lz4', 'encryption': 'none'}, '.tar.lz4'),
+              ({'compressor': 'none', 'encryption': 'none'}, '.tar'))
+    for index, (codec_args, suffix) in enumerate(codecs):
+        codec = dict(DEFAULT_CODEC, **codec_args)
+        _, archive_file = build_archive(POOL_PATH, list_file, WORK_PATH, codec=codec)
+        if not archive_file.endswith(suffix):
+            raise TestException(f'Wrong archive name {archive_file} for {codec}')
+        # Detected by the manifest when the name does not tell the codec
+        if index % 2 == 1:
+            renamed_file = os.path.join(WORK_PATH, 'renamed.tar.bin')
+            os.rename(archive_file, renamed_file)
+            archive_file = renamed_file
+            with pytest.raises(subprocess.CalledProcessError):
+                run_cmd((extract_archive_path, archive_file, WORK_PATH))
+            write_codec_manifest(get_codec_manifest_name(archive_file), codec)
+        extract_path = os.path.join(WORK_PATH, f'extract_{index}')
+        os.makedirs(extract_path)
+        run_cmd((extract_archive_path, archive_file, extract_path))
+        run_cmd(('diff', '-r', f'{POOL_PATH}/a', f'{extract_path}/a'))
+        os.unlink(archive_file)